@@ -0,0 +1,492 @@
+'''
+Benchmarks for the message hot path of desk-signaller.
+
+Run with either interpreter:
+    micropython benchmarks.py [options]
+    python benchmarks.py [options]
+
+Options:
+    --output <file>       write results as JSON
+    --compare <file>      compare against earlier results, exits 1 on regression
+    --threshold <percent> slowdown allowed before flagging, default 10
+    --batch-size <n>      TD messages per generated frame, default 30
+    --hit-rate <0-1>      share of messages for configured blocks, default 0.1
+    --area-mix <mix>      weights of the areas other messages are spread over,
+                          i.e. Y2:5,N2:3,XY:2, the default
+    --iterations <n>      repetitions per benchmark, default 500
+
+Results ending _us are microseconds and _bytes heap
+bytes, both are compared against the baseline.
+
+On hosts without machine.Pin the signal modules are
+run against machine_stub, which only counts pin writes.
+'''
+import sys
+import gc
+import json
+import random
+import time
+
+try:
+    import machine
+    if not hasattr(machine, 'Pin'):
+        raise ImportError
+except ImportError:
+    import machine_stub
+    sys.modules['machine'] = machine_stub
+
+from microstomp import Frame, MicroSTOMPClient
+
+import common
+import config_compiler
+import parser_utils
+import pin_drivers
+import signal_feed
+import web_server
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    def ticks_us():
+        '''
+        CPython stand-in for time.ticks_us
+        '''
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        '''
+        CPython stand-in for time.ticks_diff
+        '''
+        return end - start
+
+TD_MESSAGE_TYPES = ('CA_MSG', 'CB_MSG', 'CC_MSG', 'SF_MSG')
+DEFAULT_AREA_MIX = {'Y2': 5, 'N2': 3, 'XY': 2}
+#command line options and their defaults
+DEFAULT_OPTIONS = {'output': None, 'compare': None, 'threshold': '10', 'batch-size': '30',
+                   'hit-rate': '0.1', 'area-mix': None, 'iterations': '500'}
+
+SAMPLE_MESSAGE_FRAME = (
+    'MESSAGE\n'
+    'message-id:ID\\cdesk-signaller-1\\c1\\c1\\c1\\c1\n'
+    'destination:/topic/TD_LNE_NE_SIG_AREA\n'
+    'subscription:desk-signaller\n'
+    'ack:ID\\cdesk-signaller-1\\c1\n'
+    '\n'
+    + '[' + ','.join(['{"SF_MSG":{"time":"1741800445000","area_id":"Y2",'
+                      '"address":"71","msg_type":"SF","data":"ED"}}'] * 20) + ']'
+    + '\x00'
+)
+
+def legacy_parse_frame(frame):
+    '''
+    The str based parser that Frame.parse_frame replaced,
+    including the decode the receive loop used to do, kept
+    only as the baseline for the comparison below.
+    '''
+    frame = bytes(frame).decode("utf-8")
+    first_newline_index = frame.index('\n')
+    last_newline_index = frame.rindex('\n')
+    null_terminator_index = frame.rindex('\x00')
+
+    if last_newline_index >= null_terminator_index:
+        _ = frame[:last_newline_index-1]
+        last_newline_index = _.rindex('\n')
+
+    parsed_command = frame[:first_newline_index+1].rstrip()
+    headers = frame[first_newline_index+1:last_newline_index+1].split('\n')
+    body_content = frame[last_newline_index+1:null_terminator_index]
+
+    parsed_headers = {}
+    for header in headers:
+        if ':' in str(header) and len(header) > 1:
+            header = header.rstrip().split(':')
+            parsed_headers[header[0]] = header[1]
+
+    return Frame(
+        command = str(parsed_command),
+        headers = parsed_headers,
+        body = str(body_content)
+    ).built_frame
+
+def time_function(function, argument, iterations: int) -> float:
+    '''
+    Returns the mean time in microseconds of
+    calling function(argument).
+    '''
+    return time_calls(function, [argument], iterations)
+
+def benchmark_parse_frame(iterations: int = 2000) -> dict:
+    '''
+    Compares the legacy str parser against Frame.parse_frame
+    on a frame as handed over by the stream decoder, reading
+    the message-id as the ACK path does.
+    '''
+    raw_frame = memoryview(SAMPLE_MESSAGE_FRAME.encode('utf-8'))
+
+    def parse_and_read_id(frame):
+        return Frame.parse_frame(frame).get_header('message-id')
+
+    legacy = time_function(legacy_parse_frame, raw_frame, iterations)
+    current = time_function(parse_and_read_id, raw_frame, iterations)
+    return {
+        'legacy_parse_frame_us': legacy,
+        'parse_frame_us': current,
+        'parse_frame_speedup': legacy / current if current else 0
+    }
+
+class NullSocket:
+    '''
+    Accepts every send without doing anything
+    '''
+    def send(self, data):
+        '''
+        Reports the whole of data as sent
+        '''
+        return len(data)
+
+def benchmark_ack_frame(iterations: int = 2000) -> dict:
+    '''
+    Compares building an ACK through Frame against
+    splicing it into the client's cached template.
+    '''
+    client = MicroSTOMPClient('localhost', 61618, 'desk-signaller', '', '', None)
+    client.cx_socket.close()
+    client.cx_socket = NullSocket()
+    client.connected_to_broker = True
+    ack_id = 'ID:desk-signaller-1:1:1:1:1'
+
+    def frame_ack(transaction_id):
+        return Frame(
+            command = 'ACK',
+            headers = {'subscription': 'desk-signaller', 'id': transaction_id},
+            body = ''
+        ).built_frame
+
+    built = time_function(frame_ack, ack_id, iterations)
+    spliced = time_function(client.send_ack_frame, ack_id, iterations)
+    return {
+        'frame_ack_us': built,
+        'template_ack_us': spliced,
+        'ack_speedup': built / spliced if spliced else 0
+    }
+
+def generate_configuration(area_ids, blocks_per_area: int = 8) -> dict:
+    '''
+    Returns a configuration of fully populated
+    blocks, in the form read_configuration_file returns
+    '''
+    configuration = {}
+    pin = 0
+    for area_id in area_ids:
+        blocks = {}
+        for block in range(blocks_per_area):
+            elements = []
+            for position in range(8):
+                elements.append({'platform': str(position), 'element_position': position,
+                                 'green_pin': pin, 'red_pin': pin + 1})
+                pin += 2
+            blocks[f'{block:02X}'] = elements
+        configuration[area_id] = blocks
+    return configuration
+
+def generate_td_message(message_type: str, area_id: str, address: str, data: str) -> dict:
+    '''
+    Returns a single TD message as found in a feed batch
+    '''
+    if message_type == 'SF_MSG':
+        return {message_type: {'time': '1741800445000', 'area_id': area_id,
+                               'address': address, 'msg_type': 'SF', 'data': data}}
+    return {message_type: {'time': '1741800445000', 'area_id': area_id,
+                           'msg_type': message_type[:2], 'from': '0101',
+                           'to': '0103', 'descr': '1A23'}}
+
+def generate_td_batch(configuration: dict,
+                      batch_size: int = 30,
+                      area_mix: dict | None = None,
+                      hit_rate: float = 0.1,
+                      generator=None) -> list:
+    '''
+    Returns a batch of TD messages where hit_rate of them
+    are SF messages for configured blocks and the rest
+    are berth messages or SF messages for other addresses,
+    spread over areas by the weights in area_mix.
+    '''
+    generator = generator or random
+    area_mix = area_mix or DEFAULT_AREA_MIX
+    weighted_areas = [area_id for area_id, weight in area_mix.items() for _ in range(weight)]
+    configured = [(area_id, address) for area_id in configuration for address in configuration[area_id]]
+    batch = []
+    for _ in range(batch_size):
+        data = f'{generator.getrandbits(8):02X}'
+        if configured and generator.random() < hit_rate:
+            area_id, address = generator.choice(configured)
+            batch.append(generate_td_message('SF_MSG', area_id, address, data))
+            continue
+        area_id = generator.choice(weighted_areas)
+        message_type = generator.choice(TD_MESSAGE_TYPES)
+        # unconfigured addresses, configured ones are all below 0x80
+        address = f'{0x80 + generator.getrandbits(7):02X}'
+        batch.append(generate_td_message(message_type, area_id, address, data))
+    return batch
+
+def td_frame(batch: list, message_id: int = 1) -> bytes:
+    '''
+    Wraps a TD batch in a MESSAGE frame as the broker sends it
+    '''
+    return (f'MESSAGE\nmessage-id:ID\\cdesk-signaller-1\\c{message_id}\n'
+            f'destination:/topic/TD_LNE_NE_SIG_AREA\nsubscription:desk-signaller\n'
+            f'ack:ID\\cdesk-signaller-1\\c{message_id}\n\n').encode() + json.dumps(batch).encode() + b'\x00'
+
+def time_calls(function, arguments: list, iterations: int, repeats: int = 3) -> float:
+    '''
+    Returns the mean time in microseconds of calling
+    function with each of arguments in turn, taking the
+    fastest of several runs to keep noise out
+    '''
+    count = len(arguments)
+    fastest = None
+    for _ in range(repeats):
+        start = ticks_us()
+        for i in range(iterations):
+            function(arguments[i % count])
+        elapsed = ticks_diff(ticks_us(), start)
+        if fastest is None or elapsed < fastest:
+            fastest = elapsed
+    return fastest / iterations
+
+def benchmark_frame_build(iterations: int = 2000) -> dict:
+    '''
+    Times encoding a SUBSCRIBE frame through Frame
+    '''
+    headers = {'id': 'desk-signaller', 'destination': '/topic/TD_LNE_NE_SIG_AREA', 'ack': 'client'}
+
+    def build(frame_headers):
+        return Frame(command='SUBSCRIBE', headers=frame_headers, body='').built_frame
+
+    return {'frame_build_us': time_calls(build, [headers], iterations)}
+
+def benchmark_message_path(batch_size: int = 30,
+                           hit_rate: float = 0.1,
+                           iterations: int = 500,
+                           area_mix: dict | None = None) -> dict:
+    '''
+    Times each stage of the message path, and the
+    whole of it, over generated TD batches with the
+    area weights of area_mix, by default DEFAULT_AREA_MIX
+    '''
+    generator = random.Random(1) if hasattr(random, 'Random') else random
+    configuration = generate_configuration(('Y2', 'XY'))
+    signal_feed.load_configuration(configuration)
+    batches = [generate_td_batch(configuration, batch_size, area_mix=area_mix,
+                                 hit_rate=hit_rate, generator=generator)
+               for _ in range(16)]
+    frames = [td_frame(batch, i) for i, batch in enumerate(batches)]
+    messages = [message for batch in batches for message in batch]
+    message_iterations = iterations * batch_size
+
+    def filter_message(message):
+        for area_id in common.area_container:
+            if 'SF_MSG' in message and parser_utils.message_filtering_pass(
+                    message, 'SF_MSG', area_id, common.area_container[area_id]):
+                return True
+        return False
+
+    def route(message):
+        return parser_utils.route_message(message, common.routing_table)
+
+    block = common.area_container['Y2']['00']
+    # consecutive SF bytes for one address mostly differ by a single bit
+    sf_bytes = []
+    byte = 0
+    for _ in range(64):
+        byte ^= 1 << generator.getrandbits(3)
+        sf_bytes.append(f'{byte:02X}')
+
+    return {
+        'parse_td_frame_us': time_calls(Frame.parse_frame, frames, iterations),
+        'message_filtering_pass_us': time_calls(filter_message, messages, message_iterations),
+        'route_message_us': time_calls(route, messages, message_iterations),
+        'update_from_hex_us': time_calls(block.update_from_hex, sf_bytes, iterations),
+        'return_area_signal_states_us': time_calls(web_server.return_area_signal_states,
+                                                   [common.area_container], iterations),
+        'handle_frame_us': time_calls(signal_feed.handle_frame, frames, iterations)
+    }
+
+def allocated_during(function, arguments: list) -> float:
+    '''
+    Returns the mean bytes of heap allocated by calling
+    function with each of arguments in turn, from
+    gc.mem_alloc on MicroPython and tracemalloc elsewhere
+    '''
+    gc.collect()
+    if hasattr(gc, 'mem_alloc'):
+        gc.disable()
+        before = gc.mem_alloc()
+        for argument in arguments:
+            function(argument)
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+        return allocated / len(arguments)
+
+    import tracemalloc
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for argument in arguments:
+        function(argument)
+    allocated = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return allocated / len(arguments)
+
+def benchmark_heap(blocks_per_area: int = 32) -> dict:
+    '''
+    Measures the heap held by a loaded configuration of
+    fully populated blocks, and allocated per SF update
+    '''
+    configuration = generate_configuration(('Y2', 'XY', 'N2', 'Q1'), blocks_per_area)
+    common.area_container = common.routing_table = None
+    boot_bytes = allocated_during(signal_feed.load_configuration, [configuration])
+    block = common.area_container['Y2']['00']
+    sf_bytes = [f'{byte:02X}' for byte in range(256)]
+    return {
+        'boot_heap_bytes': boot_bytes,
+        'update_from_hex_heap_bytes': allocated_during(block.update_from_hex, sf_bytes)
+    }
+
+def benchmark_boot_configuration(blocks_per_area: int = 32, iterations: int = 20) -> dict:
+    '''
+    Times reading the boot configuration from JSON,
+    validated, against reading it compiled
+    '''
+    configuration = generate_configuration(('Y2', 'XY', 'N2', 'Q1'), blocks_per_area)
+    source = json.dumps(configuration)
+    compiled = config_compiler.compile_configuration(configuration)
+    return {
+        'parse_configuration_us': time_calls(parser_utils.parse_configuration, [source], iterations),
+        'load_compiled_configuration_us': time_calls(config_compiler.decompile_configuration,
+                                                     [compiled], iterations),
+        'config_json_bytes': len(source),
+        'compiled_config_bytes': len(compiled)
+    }
+
+def benchmark_pin_writes(batch_size: int = 30, frames: int = 50) -> dict:
+    '''
+    Counts, under the fake pin driver, the pin sets a
+    frame makes, each a GPIO call under the gpio driver,
+    against the bulk writes the other drivers make
+    '''
+    generator = random.Random(2) if hasattr(random, 'Random') else random
+    previous_driver = pin_drivers.driver
+    driver = pin_drivers.FakeDriver()
+    pin_drivers.set_driver(driver)
+    configuration = generate_configuration(('Y2', 'XY'))
+    signal_feed.load_configuration(configuration)
+    batches = [generate_td_batch(configuration, batch_size, hit_rate=1.0, generator=generator)
+               for _ in range(frames)]
+    driver.pin_writes = driver.write_count = 0
+    for i, batch in enumerate(batches):
+        signal_feed.handle_frame(td_frame(batch, i))
+    pin_drivers.set_driver(previous_driver)
+    return {
+        'gpio_calls_per_frame': driver.pin_writes / frames,
+        'bulk_writes_per_frame': driver.write_count / frames
+    }
+
+def run_benchmarks(batch_size: int, hit_rate: float, iterations: int,
+                   area_mix: dict | None = None) -> dict:
+    '''
+    Runs every benchmark and returns the results
+    '''
+    area_mix = area_mix or DEFAULT_AREA_MIX
+    results = {}
+    results.update(benchmark_parse_frame(iterations))
+    results.update(benchmark_ack_frame(iterations))
+    results.update(benchmark_frame_build(iterations))
+    results.update(benchmark_message_path(batch_size, hit_rate, iterations, area_mix))
+    results.update(benchmark_heap())
+    results.update(benchmark_boot_configuration())
+    results.update(benchmark_pin_writes(batch_size))
+    return {
+        'interpreter': sys.implementation.name,
+        'batch_size': batch_size,
+        'hit_rate': hit_rate,
+        'area_mix': area_mix,
+        'results': results
+    }
+
+def compare_results(current: dict, baseline: dict, threshold: float) -> list:
+    '''
+    Returns the timings and heap sizes that are more
+    than threshold percent above the baseline. Speedup
+    ratios are neither and are skipped.
+    '''
+    regressions = []
+    for name, baseline_value in baseline['results'].items():
+        if name.split('_')[-1] not in ('us', 'bytes'):
+            continue
+        if name not in current['results'] or not baseline_value:
+            continue
+        change = (current['results'][name] - baseline_value) * 100 / baseline_value
+        if change > threshold:
+            regressions.append((name, baseline_value, current['results'][name], change))
+    return regressions
+
+def parse_arguments(arguments: list, defaults: dict | None = None) -> dict:
+    '''
+    Reads --name value pairs into a dict of options,
+    accepting only the names defaults has, by default
+    the options of this suite
+    '''
+    options = dict(defaults or DEFAULT_OPTIONS)
+    for i in range(0, len(arguments), 2):
+        name = arguments[i][2:]
+        if not arguments[i].startswith('--') or name not in options:
+            raise ValueError('unknown option', arguments[i])
+        if i + 1 == len(arguments):
+            raise ValueError('option has no value', arguments[i])
+        options[name] = arguments[i + 1]
+    return options
+
+def parse_area_mix(area_mix: str) -> dict:
+    '''
+    Reads area weights written as Y2:5,N2:3,XY:2
+    '''
+    weights = {}
+    for entry in area_mix.split(','):
+        area_id, _, weight = entry.partition(':')
+        if not area_id or not weight.isdigit() or not int(weight):
+            raise ValueError('area mix entries are area:weight', entry)
+        weights[area_id.strip().upper()] = int(weight)
+    return weights
+
+def main(arguments: list) -> int:
+    '''
+    Runs the suite, writing and comparing results as asked
+
+    returns:
+        int: 1 if a regression was flagged else 0
+    '''
+    options = parse_arguments(arguments)
+    area_mix = parse_area_mix(options['area-mix']) if options['area-mix'] else None
+    current = run_benchmarks(int(options['batch-size']),
+                             float(options['hit-rate']),
+                             int(options['iterations']),
+                             area_mix)
+    for name, value in current['results'].items():
+        print(f'{name}: {value:.2f}')
+
+    if options['output']:
+        with open(options['output'], 'w') as output_file:
+            json.dump(current, output_file)
+
+    if not options['compare']:
+        return 0
+    with open(options['compare']) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare_results(current, baseline, float(options['threshold']))
+    for name, before, after, change in regressions:
+        print(f'(regression): {name} {before:.2f} -> {after:.2f} (+{change:.1f}%)')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,8 +5,35 @@ across modules and within threads.
 
 areas_of_interest = None
 area_container = None
+routing_table = None
+routed_area_ids = None
 appliance_name = None
 stat_last_message_received = None
 stat_last_block_change = None
 config_current_configuration = None
-logs_last_five = []
\ No newline at end of file
+#set by main.py so metrics.py can read their counters
+stomp_client = None
+connection_supervisor = None
+#incremented whenever a signal element changes state,
+#blocks record the version of their last change
+state_version = 0
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    allocate_lock = None
+
+class _UnsharedLock:
+    '''
+    Stands in for a lock on ports without _thread,
+    where everything runs on the one event loop
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        return False
+
+#held while a frame is applied, the configuration reloaded or the
+#block states saved, as the web server reloads from its own thread
+feed_lock = allocate_lock() if allocate_lock else _UnsharedLock()
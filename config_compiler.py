@@ -0,0 +1,232 @@
+'''
+Config Compiler packs a validated config.json into
+a small binary file at deploy time, so the appliance
+boots without parsing or validating JSON.
+
+Usage:
+    python config_compiler.py [config.json] [config.bin]
+
+File layout, after the CONFIG_MAGIC line, with every
+count and pin 2 bytes and every string prefixed by its length
+in 1 byte:
+    source CRC-32 (4 bytes), area count, then per area:
+        area, address count, then per address:
+            address, light count, then per light:
+                element position (1 byte), green pin, red pin, platform
+
+The source CRC-32 is the checksum of the config.json the
+file was compiled from, a config.json with another checksum
+is taken to have been edited since and is read instead.
+Only the keys the signal blocks use are kept.
+'''
+import logger
+import parser_utils
+
+import os
+import sys
+
+try:
+    import binascii
+except ImportError:
+    import ubinascii as binascii
+
+CONFIG_MAGIC = b'DSCF2\n'
+#bytes of config.json read at a time while checksumming it
+CHECKSUM_CHUNK_SIZE = 512
+
+def pack_string(value) -> bytes:
+    '''
+    Returns a string prefixed by its length
+    '''
+    value = str(value).encode('utf-8')
+    if len(value) > 0xFF:
+        raise ValueError('string is too long to pack', value)
+    return bytes((len(value),)) + value
+
+def pack_count(count: int) -> bytes:
+    '''
+    Returns a count or pin as 2 bytes
+    '''
+    if not 0 <= count <= 0xFFFF:
+        raise ValueError('value does not fit in 2 bytes', count)
+    return bytes((count >> 8, count & 0xFF))
+
+def compile_configuration(configuration: dict, source_crc: int = 0) -> bytes:
+    '''
+    Packs a validated configuration in the compiled layout
+
+    args:
+        configuration: dict: as returned by parse_configuration
+        source_crc: int: CRC-32 of the config.json it came from
+    returns:
+        bytes: the compiled file, empty if a position, pin
+            or count does not fit its field
+    '''
+    parts = [CONFIG_MAGIC, source_crc.to_bytes(4, 'big'), pack_count(len(configuration))]
+    try:
+        for area, area_data in configuration.items():
+            parts.append(pack_string(area))
+            parts.append(pack_count(len(area_data)))
+            for address, light_configurations in area_data.items():
+                parts.append(pack_string(address))
+                parts.append(pack_count(len(light_configurations)))
+                for light in light_configurations:
+                    parts.append(bytes((light['element_position'],)))
+                    parts.append(pack_count(light['green_pin']))
+                    parts.append(pack_count(light['red_pin']))
+                    parts.append(pack_string(light['platform']))
+    except (TypeError, ValueError) as e:
+        logger.error('configuration cannot be compiled %s', e)
+        return b''
+    return b''.join(parts)
+
+def decompile_configuration(data: bytes) -> dict:
+    '''
+    Reads a compiled configuration back into the
+    dict read_configuration_file would return
+
+    returns:
+        dict: of configuration, empty if the data is
+            not a compiled configuration or is truncated
+    '''
+    if not data.startswith(CONFIG_MAGIC):
+        return {}
+    position = len(CONFIG_MAGIC) + 4
+
+    def read_count():
+        nonlocal position
+        position += 2
+        return (data[position - 2] << 8) | data[position - 1]
+
+    def read_string():
+        nonlocal position
+        end = position + 1 + data[position]
+        if end > len(data):
+            raise IndexError('string is truncated')
+        value = data[position + 1:end].decode('utf-8')
+        position = end
+        return value
+
+    configuration = {}
+    try:
+        for _ in range(read_count()):
+            area = read_string()
+            area_data = {}
+            for _ in range(read_count()):
+                address = read_string()
+                light_configurations = []
+                for _ in range(read_count()):
+                    element_position = data[position]
+                    position += 1
+                    green_pin = read_count()
+                    red_pin = read_count()
+                    light_configurations.append({'platform': read_string(),
+                                                 'element_position': element_position,
+                                                 'green_pin': green_pin,
+                                                 'red_pin': red_pin})
+                area_data[address] = light_configurations
+            configuration[area] = area_data
+        if position != len(data):
+            raise IndexError('unexpected bytes after the configuration')
+    except (IndexError, UnicodeError):
+        logger.warn('compiled configuration is malformed, ignoring it')
+        return {}
+    return configuration
+
+def source_crc(data: bytes) -> int:
+    '''
+    Returns the CRC-32 of the config.json a compiled
+    configuration was made from, 0 if unknown
+    '''
+    if not data.startswith(CONFIG_MAGIC) or len(data) < len(CONFIG_MAGIC) + 4:
+        return 0
+    return int.from_bytes(data[len(CONFIG_MAGIC):len(CONFIG_MAGIC) + 4], 'big')
+
+def file_size(file_location: str):
+    '''
+    Returns the size of a file, None if there is none
+    '''
+    try:
+        return os.stat(file_location)[6]
+    except OSError:
+        return None
+
+def file_crc(file_location: str):
+    '''
+    Returns the CRC-32 of a file's contents, read in
+    chunks, None if there is none
+    '''
+    crc = 0
+    try:
+        with open(file_location, 'rb') as source_file:
+            while True:
+                chunk = source_file.read(CHECKSUM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = binascii.crc32(chunk, crc)
+    except OSError:
+        return None
+    return crc & 0xFFFFFFFF
+
+def load_compiled_configuration(file_location: str, source_location: str | None = None) -> dict:
+    '''
+    Reads a compiled configuration, ignoring it if the
+    contents of source_location changed since it was compiled
+
+    args:
+        file_location: str: compiled configuration path
+        source_location: optional str: the config.json it was compiled from
+    returns:
+        dict: of configuration, empty if there is none or it is stale
+    '''
+    try:
+        with open(file_location, 'rb') as compiled_file:
+            data = compiled_file.read()
+    except OSError:
+        return {}
+    if source_location is not None:
+        crc = file_crc(source_location)
+        if crc is not None and crc != source_crc(data):
+            logger.warn('%s was compiled from another %s, reading the JSON', file_location, source_location)
+            return {}
+    return decompile_configuration(data)
+
+def save_compiled_configuration(configuration: dict, file_location: str,
+                                source_location: str | None = None) -> bool:
+    '''
+    Compiles a configuration to file_location
+
+    returns:
+        bool: True if the file was written
+    '''
+    crc = file_crc(source_location) if source_location else None
+    data = compile_configuration(configuration, crc or 0)
+    if not data:
+        return False
+    try:
+        with open(file_location, 'wb') as compiled_file:
+            compiled_file.write(data)
+    except OSError as e:
+        logger.error('could not save the compiled configuration %s', e)
+        return False
+    return True
+
+def main(arguments: list) -> int:
+    '''
+    Compiles a config.json, validating it first
+
+    returns:
+        int: 0 on success, 1 if the configuration is invalid
+    '''
+    source_location = arguments[0] if arguments else './config.json'
+    file_location = arguments[1] if len(arguments) > 1 else './config.bin'
+    configuration = parser_utils.read_configuration_file(source_location)
+    if not configuration:
+        return 1
+    if not save_compiled_configuration(configuration, file_location, source_location):
+        return 1
+    print(f'compiled {source_location} to {file_location}, {file_size(file_location)} bytes')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
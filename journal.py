@@ -0,0 +1,93 @@
+'''
+Journal records every signal block change in a fixed
+size ring, preallocated so recording a change never
+allocates, for the /api/history endpoint.
+
+Each entry is (sequence, time, block, old byte, new byte).
+Sequences count up from 1 across the life of the ring,
+so a reader can page through with since= and can tell
+from the oldest sequence when entries have been overwritten.
+'''
+import time
+
+from array import array
+
+JOURNAL_SIZE = 256
+#old byte recorded for a block's first update
+NO_BYTE = -1
+
+size = 0
+entry_count = 0
+entry_times = None
+entry_blocks = None
+entry_old_bytes = None
+entry_new_bytes = None
+
+def allocate(journal_size: int = JOURNAL_SIZE) -> None:
+    '''
+    Allocates an empty ring of journal_size entries
+    '''
+    global size, entry_count, entry_times, entry_blocks, entry_old_bytes, entry_new_bytes
+    size = journal_size
+    entry_count = 0
+    entry_times = array('L', [0] * journal_size)
+    entry_blocks = [None] * journal_size
+    entry_old_bytes = array('h', [0] * journal_size)
+    entry_new_bytes = bytearray(journal_size)
+
+def record(block, old_byte, new_byte: int) -> None:
+    '''
+    Records a block's change from old_byte, None
+    for its first update, to new_byte
+    '''
+    global entry_count
+    slot = entry_count % size
+    entry_times[slot] = int(time.time())
+    entry_blocks[slot] = block
+    entry_old_bytes[slot] = NO_BYTE if old_byte is None else old_byte
+    entry_new_bytes[slot] = new_byte
+    entry_count += 1
+
+def oldest_sequence() -> int:
+    '''
+    Returns the sequence of the oldest entry still held
+    '''
+    return max(1, entry_count - size + 1)
+
+def entries(since: int = 0, limit: int = 50, area_container: dict | None = None) -> list:
+    '''
+    Returns up to limit entries after the since sequence,
+    oldest first, naming blocks by their area and address
+
+    args:
+        since: int: sequence of the last entry already seen, 0 for all
+        limit: int: most entries to return
+        area_container: dict: {area_id: {address: SignalBlock}} to
+            find each block's area, blocks not in it have area None
+    returns:
+        list: of dicts with seq, time, area, address, old and new
+    '''
+    names = {}
+    for area_id, blocks in (area_container or {}).items():
+        for address, block in blocks.items():
+            names[id(block)] = (area_id, address)
+
+    page = []
+    for sequence in range(max(since + 1, oldest_sequence()), entry_count + 1):
+        if len(page) >= limit:
+            break
+        slot = (sequence - 1) % size
+        block = entry_blocks[slot]
+        area_id, address = names.get(id(block), (None, getattr(block, 'signal_block_address', None)))
+        old_byte = entry_old_bytes[slot]
+        page.append({
+            'seq': sequence,
+            'time': entry_times[slot],
+            'area': area_id,
+            'address': address,
+            'old': None if old_byte == NO_BYTE else f'{old_byte:02X}',
+            'new': f'{entry_new_bytes[slot]:02X}'
+        })
+    return page
+
+allocate()
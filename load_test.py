@@ -0,0 +1,153 @@
+'''
+Load tests the feed path against stub_broker.py,
+publishing generated TD batches at a set rate while
+the real MicroSTOMPClient connect, subscribe and
+listen_for_messages path applies them through
+signal_feed.handle_frame.
+
+Usage:
+    micropython load_test.py [options]
+    python load_test.py [options]
+
+Options:
+    --rate <n>            frames published per second, default 50
+    --duration <ms>       time spent publishing, default 5000
+    --batch-size <n>      TD messages per frame, default 30
+    --hit-rate <0-1>      share of messages for configured blocks, default 0.1
+    --fragment <0|1>      split and merge frames across writes, default 1
+    --ack-every <n>       frames per cumulative ACK, default 1
+    --output <file>       write the report as JSON
+
+Reports sustained frames and messages per second,
+ACK round trips and frames the client never received.
+ACK round trips run from the write completing each
+message, so with --fragment 1 they exclude the time
+its tail was held back for the next publish.
+'''
+import sys
+import json
+import random
+
+# installs machine_stub on hosts without GPIO
+from benchmarks import generate_configuration, generate_td_batch, parse_arguments
+from microstomp import MicroSTOMPClient, ticks_ms, ticks_diff, sleep_ms
+from stub_broker import StubBroker
+
+import signal_feed
+
+import _thread
+
+TOPIC = '/topic/TD_LNE_NE_SIG_AREA'
+BATCH_POOL_SIZE = 16
+DRAIN_MS = 500
+#command line options and their defaults
+DEFAULT_OPTIONS = {'rate': '50', 'duration': '5000', 'batch-size': '30', 'hit-rate': '0.1',
+                   'fragment': '1', 'ack-every': '1', 'output': None}
+
+def publish_load(broker: StubBroker, bodies: list, rate: int, duration_ms: int,
+                 progress: dict) -> None:
+    '''
+    Publishes bodies in turn at rate frames per second for
+    duration_ms, then flushes and closes the connection
+    '''
+    interval_ms = 1000 / rate
+    started = ticks_ms()
+    published = 0
+    try:
+        while ticks_diff(ticks_ms(), started) < duration_ms:
+            due_ms = int(published * interval_ms) - ticks_diff(ticks_ms(), started)
+            if due_ms > 0:
+                sleep_ms(due_ms)
+            broker.publish(TOPIC, {}, bodies[published % len(bodies)])
+            published += 1
+        broker.flush()
+        sleep_ms(DRAIN_MS)
+    except OSError as e:
+        progress['error'] = str(e)
+    progress['published'] = published
+    progress['publish_ms'] = ticks_diff(ticks_ms(), started)
+    broker.close()
+    progress['done'] = True
+
+def run_load(rate: int = 50,
+             duration_ms: int = 5000,
+             batch_size: int = 30,
+             hit_rate: float = 0.1,
+             fragment_writes: bool = True,
+             ack_every_frames: int = 1) -> dict:
+    '''
+    Runs one load test and returns its report
+    '''
+    generator = random.Random(1) if hasattr(random, 'Random') else random
+    configuration = generate_configuration(('Y2', 'XY'))
+    signal_feed.load_configuration(configuration)
+    bodies = [json.dumps(generate_td_batch(configuration, batch_size, hit_rate=hit_rate,
+                                           generator=generator)).encode()
+              for _ in range(BATCH_POOL_SIZE)]
+
+    broker = StubBroker(fragment_writes=fragment_writes, generator=generator)
+    broker.start()
+    counts = {'messages': 0, 'last_frame_ticks': None}
+
+    def on_frame(frame_data):
+        counts['messages'] += signal_feed.handle_frame(frame_data, client.acknowledge)
+        counts['last_frame_ticks'] = ticks_ms()
+
+    client = MicroSTOMPClient('127.0.0.1', broker.port, 'load-test', 'user', 'pass',
+                              on_message_callback=on_frame, ack_every_frames=ack_every_frames)
+    if not client.connect():
+        broker.close()
+        return {}
+    client.subscribe(TOPIC, ack='client')
+    broker.wait_for_subscriptions()
+
+    progress = {'done': False}
+    started = ticks_ms()
+    _thread.start_new_thread(publish_load, (broker, bodies, rate, duration_ms, progress))
+    client.listen_for_messages()
+    client.cx_socket.close()
+    while not progress['done']:
+        sleep_ms(10)
+
+    elapsed_ms = max(1, ticks_diff(counts['last_frame_ticks'] or ticks_ms(), started))
+    round_trips = broker.ack_round_trips_us
+    return {
+        'rate': rate,
+        'batch_size': batch_size,
+        'fragment_writes': fragment_writes,
+        'frames_published': broker.messages_sent,
+        'frames_received': client.frames_received,
+        'dropped_frames': broker.messages_sent - client.frames_received,
+        'socket_writes': broker.write_count,
+        'messages_applied': counts['messages'],
+        'elapsed_ms': elapsed_ms,
+        'frames_per_second': client.frames_received * 1000 / elapsed_ms,
+        'messages_per_second': client.frames_received * batch_size * 1000 / elapsed_ms,
+        'applied_per_second': counts['messages'] * 1000 / elapsed_ms,
+        'acks_sent': client.acks_sent,
+        'ack_round_trips': len(round_trips),
+        'ack_round_trip_mean_us': sum(round_trips) / len(round_trips) if round_trips else 0,
+        'ack_round_trip_max_us': max(round_trips) if round_trips else 0,
+        'publish_error': progress.get('error')
+    }
+
+def main(arguments: list) -> dict:
+    '''
+    Runs a load test from command line options and prints the report
+    '''
+    options = parse_arguments(arguments, DEFAULT_OPTIONS)
+    report = run_load(rate=int(options['rate']),
+                      duration_ms=int(options['duration']),
+                      batch_size=int(options['batch-size']),
+                      hit_rate=float(options['hit-rate']),
+                      fragment_writes=options['fragment'] != '0',
+                      ack_every_frames=int(options['ack-every']))
+    for name, value in report.items():
+        print(f'{name}: {value}')
+    if options['output']:
+        with open(options['output'], 'w') as output_file:
+            json.dump(report, output_file)
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
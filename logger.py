@@ -0,0 +1,127 @@
+'''
+Logger keeps the most recent log entries in a
+fixed size ring buffer, shown on the web interface,
+and only writes to the console at or above
+console_level as each print is a blocking UART write.
+
+Levels below both thresholds are bound to a function
+that does nothing and messages are only %-formatted
+once their level is enabled, so a disabled call in
+the hot path costs one function call:
+
+    logger.debug('msg routed to block %s', address)
+'''
+import time
+
+try:
+    ticks_ms = time.ticks_ms
+except AttributeError:
+    def ticks_ms():
+        '''
+        CPython stand-in for time.ticks_ms
+        '''
+        return time.monotonic_ns() // 1000000
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+CRITICAL = 50
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARN: 'warn', ERROR: 'error', CRITICAL: 'critical'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+RING_SIZE = 32
+
+#the ring is allocated once, each entry is a slot in the three lists
+ring_ticks = [0] * RING_SIZE
+ring_levels = bytearray(RING_SIZE)
+ring_messages = [''] * RING_SIZE
+ring_next = 0
+ring_count = 0
+
+ring_level = INFO
+console_level = WARN
+
+def log(level: int, message: str, *args) -> None:
+    '''
+    Formats and records a message at the given
+    level, whether or not the level is enabled
+    '''
+    global ring_next, ring_count
+    if args:
+        message = message % args
+    if level >= ring_level:
+        ring_ticks[ring_next] = ticks_ms()
+        ring_levels[ring_next] = level
+        ring_messages[ring_next] = message
+        ring_next = (ring_next + 1) % RING_SIZE
+        if ring_count < RING_SIZE:
+            ring_count += 1
+    if level >= console_level:
+        print(f'({LEVEL_NAMES[level]}): {message}')
+
+def _discard(message, *args) -> None:
+    '''
+    Stands in for a disabled level
+    '''
+
+def _level_function(level: int):
+    '''
+    Returns the function to bind for a level,
+    _discard when neither output wants it
+    '''
+    if level < ring_level and level < console_level:
+        return _discard
+
+    def log_at_level(message, *args):
+        log(level, message, *args)
+    return log_at_level
+
+def level_value(level) -> int:
+    '''
+    Returns the numeric level for a level or its name
+    '''
+    if isinstance(level, str):
+        return LEVELS[level.lower()]
+    return level
+
+def configure(new_ring_level=INFO, new_console_level=WARN) -> None:
+    '''
+    Sets the lowest level kept in the ring and
+    printed to the console, by number or name, and
+    rebinds the level functions to match
+
+    args:
+        new_ring_level: int or str: i.e. INFO or 'info'
+        new_console_level: int or str: i.e. WARN or 'warn'
+    '''
+    global ring_level, console_level, debug, info, warn, error, critical
+    ring_level = level_value(new_ring_level)
+    console_level = level_value(new_console_level)
+    debug = _level_function(DEBUG)
+    info = _level_function(INFO)
+    warn = _level_function(WARN)
+    error = _level_function(ERROR)
+    critical = _level_function(CRITICAL)
+
+def entries() -> list:
+    '''
+    Returns the entries in the ring, oldest first
+
+    returns:
+        list: of (ticks_ms, level name, message)
+    '''
+    first = (ring_next - ring_count) % RING_SIZE
+    return [(ring_ticks[i], LEVEL_NAMES[ring_levels[i]], ring_messages[i])
+            for i in ((first + offset) % RING_SIZE for offset in range(ring_count))]
+
+def clear() -> None:
+    '''
+    Empties the ring
+    '''
+    global ring_next, ring_count
+    ring_next = 0
+    ring_count = 0
+
+debug = info = warn = error = critical = _discard
+configure()
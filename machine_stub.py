@@ -0,0 +1,33 @@
+'''
+A stand-in for the MicroPython machine module
+so the signal modules can be benchmarked on
+hosts without GPIO. Pins only count their writes.
+
+Installed by benchmarks.py in place of machine
+when the interpreter has no machine.Pin.
+'''
+
+class Pin:
+    '''
+    Records writes in place of driving a GPIO pin
+    '''
+    OUT = 1
+    IN = 0
+    writes = 0
+
+    def __init__(self, pin_id, mode=None, value=None):
+        self.pin_id = pin_id
+        self.mode = mode
+        self.pin_value = 0
+        if value is not None:
+            self.value(value)
+
+    def value(self, new_value=None):
+        '''
+        Returns the pin value, or sets it and counts the write
+        '''
+        if new_value is None:
+            return self.pin_value
+        self.pin_value = new_value
+        Pin.writes += 1
+        return None
@@ -5,51 +5,126 @@ STOMP messaging queue and
 updates individual element objects
 and LEDs.
 '''
-from microstomp import MicroSTOMPClient, Frame
-from signal_handler import SignalObject
-from signal_block import SignalBlock
-from signal_element import SignalElement
+from microstomp import MicroSTOMPClient, ConnectionSupervisor, ticks_ms, ticks_diff, sleep_ms
+from state_store import StateSnapshotter
 
 import common
+import config_compiler
+import journal
+import logger
+import metrics
 import web_server
 import parser_utils
+import pin_drivers
+import signal_feed
 import settings
 
-import _thread
-import machine
 import json
-import time
+import socket
+import _thread
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+DEFAULT_TD_TOPIC = '/topic/TD_LNE_NE_SIG_AREA'
+CONFIG_FILE_LOCATION = './config.json'
 
+metrics.start_boot_timing()
 
-common.config_current_configuration = parser_utils.read_configuration_file('./config.json')
+logger.configure(getattr(settings, 'LOG_LEVEL', 'info'),
+                 getattr(settings, 'CONSOLE_LOG_LEVEL', 'warn'))
 
-if not common.config_current_configuration:
-    print('(critical): configuration is empty')
+#config.json compiled by config_compiler.py loads without parsing JSON
+compiled_config_location = getattr(settings, 'COMPILED_CONFIG_LOCATION', './config.bin')
+configuration = {}
+if compiled_config_location:
+    configuration = config_compiler.load_compiled_configuration(compiled_config_location,
+                                                                CONFIG_FILE_LOCATION)
+if not configuration:
+    configuration = parser_utils.read_configuration_file(CONFIG_FILE_LOCATION)
+
+if not configuration:
+    logger.critical('configuration is empty')
     exit(0)
 
 common.appliance_name = settings.APPLIANCE_NAME
-common.areas_of_interest = common.config_current_configuration.keys()
-common.area_container = {}
 common.stat_last_message_received = None
 common.stat_last_block_change = None
 
-for area in common.areas_of_interest:
-    print(f'(info): enumerating area {area}')
-    area_data = common.config_current_configuration[area]
-    block_map = {}
-    for block_address in area_data:
-        print(f'(info): enumerating block address {block_address}')
-        _ = area_data[block_address]
-        _block = SignalBlock(signal_block_address=block_address) 
-        [_block.modify_signal_in_block(signal_position = _s['element_position'],
-                                      signal_platform = _s['platform'],
-                                      signal_green_pin = _s['green_pin'],
-                                      signal_red_pin = _s['red_pin']) for _s in _]
-        block_map[block_address] = _block
-    common.area_container[area] = block_map
-    print(f'(info): area container is now {common.area_container}')
-
-web_thread = _thread.start_new_thread(web_server.web_server, tuple([]))
+journal.allocate(getattr(settings, 'JOURNAL_SIZE', journal.JOURNAL_SIZE))
+
+pin_driver_name = getattr(settings, 'PIN_DRIVER', 'gpio')
+pin_driver = pin_drivers.build_driver(pin_driver_name, getattr(settings, 'PIN_DRIVER_OPTIONS', None))
+if pin_driver is None:
+    logger.critical('unknown pin driver %s', pin_driver_name)
+    exit(0)
+pin_drivers.set_driver(pin_driver)
+
+signal_feed.streaming_json_decode = getattr(settings, 'STREAMING_JSON_DECODE', True)
+signal_feed.load_configuration(configuration, initialise_pins=False)
+metrics.mark_boot_phase('config')
+
+signal_feed.initialise_area_pins(common.area_container)
+#show the last known aspects before the feed is connected
+state_file_location = getattr(settings, 'STATE_FILE_LOCATION', './block_states.bin')
+snapshotter = None
+if state_file_location:
+    snapshotter = StateSnapshotter(state_file_location,
+                                   getattr(settings, 'STATE_SNAPSHOT_INTERVAL_MS', 60000))
+    snapshotter.restore()
+metrics.mark_boot_phase('pins')
+
+def reload_configuration(new_configuration: dict) -> dict:
+    '''
+    Applies a configuration uploaded to the web
+    server and keeps it for the next boot
+    '''
+    summary = signal_feed.reload_configuration(new_configuration)
+    try:
+        with open(CONFIG_FILE_LOCATION, 'w') as config_file:
+            json.dump(new_configuration, config_file)
+    except OSError as e:
+        logger.error('could not save the uploaded configuration %s', e)
+    if compiled_config_location:
+        config_compiler.save_compiled_configuration(new_configuration, compiled_config_location,
+                                                    CONFIG_FILE_LOCATION)
+    if snapshotter:
+        snapshotter.maybe_save()
+    return summary
+
+web_server.configuration_reloader = reload_configuration
+
+async_event_loop = getattr(settings, 'ASYNC_EVENT_LOOP', False)
+awaiting_first_frame = True
+
+def wait_for_network(timeout_ms: int) -> bool:
+    '''
+    Waits for the WLAN to connect, on boards that have
+    one, and resolves the broker so connect does not wait
+    on DNS
+
+    returns:
+        bool: False if the network did not come up in time
+    '''
+    try:
+        import network
+    except ImportError:
+        network = None
+    if network:
+        wlan = network.WLAN(network.STA_IF)
+        started = ticks_ms()
+        while not wlan.isconnected():
+            if ticks_diff(ticks_ms(), started) > timeout_ms:
+                return False
+            sleep_ms(50)
+    try:
+        socket.getaddrinfo(settings.NETWORK_RAIL_STOMP_HOST, settings.NETWORK_RAIL_STOMP_PORT)
+    except OSError as e:
+        logger.warn('could not resolve the broker %s', e)
+        return False
+    return True
 
 def new_callback_method(frame_data):
     '''
@@ -57,35 +132,12 @@ def new_callback_method(frame_data):
     data frame is received from
     the STOMP subscription
     '''
-    print('(info): frame received')
-    frame = Frame.parse_frame(frame_data)
-    client.send_ack_frame(transaction_id=str(frame.headers["message-id"]))
-
-    if frame.is_error():
-        print('(error):', frame_data)
-        return
-
-    frame_body = json.loads(frame.body)
-    common.stat_last_message_received = str(time.localtime())
-    for message in frame_body:
-        for area in common.area_container:
-            if parser_utils.message_filtering_pass(message=message,
-                                                   message_type='SF_MSG',
-                                                   message_area_code='Y2',
-                                                   signals_of_interest = common.area_container[area]):
-                print('(info): message passed filtering')
-                message_address = parser_utils.get_signal_area_code(message['SF_MSG']['address'])
-                message_data = message['SF_MSG']['data']
-
-                print(f'(info): msg address {message_address} and data is {message_data}')
-                if message_address in common.area_container[area]:
-                    print(common.area_container[area][message_address])
-                    common.area_container[area][message_address].update_from_hex(message_data)
-                    print('(info): updated the address block within the container')
-                    common.stat_last_block_change = str(time.localtime())
-
-
-
+    global awaiting_first_frame
+    signal_feed.handle_frame(frame_data, client.acknowledge)
+    if awaiting_first_frame:
+        awaiting_first_frame = False
+        metrics.mark_boot_phase('first_frame')
+        logger.info('boot phases in ms %s', metrics.boot_phases_ms)
 
 client = MicroSTOMPClient(
     host=settings.NETWORK_RAIL_STOMP_HOST,
@@ -93,10 +145,66 @@ client = MicroSTOMPClient(
     client_id= settings.NETWORK_RAIL_STOMP_CLIENT_ID,
     username= settings.NETWORK_RAIL_USERNAME,
     password= settings.NETWORK_RAIL_PASSWORD,
-    on_message_callback=new_callback_method
+    on_message_callback=new_callback_method,
+    ack_every_frames=getattr(settings, 'ACK_EVERY_FRAMES', 1),
+    ack_every_ms=getattr(settings, 'ACK_EVERY_MS', 0),
+    heart_beat=(getattr(settings, 'HEARTBEAT_SEND_MS', 15000),
+                getattr(settings, 'HEARTBEAT_RECEIVE_MS', 15000)),
+    capture_file_location=getattr(settings, 'CAPTURE_FILE_LOCATION', None),
+    connect_timeout_ms=getattr(settings, 'CONNECT_TIMEOUT_MS', 10000),
+    #saved whenever the listen loop wakes, frame or not, so the last change
+    #before the feed goes quiet is still saved once the interval has passed
+    on_idle_callback=snapshotter.maybe_save if snapshotter else None,
+    idle_poll_ms=snapshotter.min_interval_ms if snapshotter else 0
 )
+supervisor = ConnectionSupervisor(client)
+common.stomp_client = client
+common.connection_supervisor = supervisor
+
+async def run_event_loop():
+    '''
+    Serves the web interface and consumes the
+    feed as cooperative tasks on a single loop
+    '''
+    await web_server.web_server_async()
+    await supervisor.run_async()
+
+if not async_event_loop:
+    web_thread = _thread.start_new_thread(web_server.web_server, tuple([]))
+
+broker_selectors = getattr(settings, 'TD_BROKER_SELECTORS', False)
+
+#TD topics and the areas each carries, every topic shares the connection,
+#the default topic follows areas added by a reload unless a broker
+#selector fixed its areas when it subscribed
+td_subscriptions = getattr(settings, 'TD_SUBSCRIPTIONS', None)
+follow_configuration = not td_subscriptions and not broker_selectors
+if not td_subscriptions:
+    td_subscriptions = {DEFAULT_TD_TOPIC: list(configuration)}
+extra_subscription_headers = getattr(settings, 'TD_SUBSCRIPTION_HEADERS', None)
+
+if not wait_for_network(getattr(settings, 'NETWORK_WAIT_MS', 10000)):
+    logger.warn('network is not ready, connecting anyway')
+metrics.mark_boot_phase('network')
 
 client.connect()
-client.subscribe('/topic/TD_LNE_NE_SIG_AREA', ack='client')
-client.listen_for_messages()
-print('INFO LISTENING FOR MESSAGES')
+metrics.mark_boot_phase('connect')
+for topic, area_ids in td_subscriptions.items():
+    subscription_id = client.subscription_id_for(topic)
+    signal_feed.register_subscription(subscription_id, None if follow_configuration else area_ids)
+    if broker_selectors:
+        subscription_headers = signal_feed.td_subscription_headers(area_ids, extra_subscription_headers)
+    else:
+        subscription_headers = extra_subscription_headers
+    client.subscribe(topic, ack='client', subscription_id=subscription_id,
+                     headers=subscription_headers)
+metrics.mark_boot_phase('subscribe')
+logger.info('listening for messages, boot phases in ms %s', metrics.boot_phases_ms)
+try:
+    if async_event_loop:
+        asyncio.run(run_event_loop())
+    else:
+        supervisor.run()
+finally:
+    if client.capture:
+        client.capture.close()
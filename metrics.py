@@ -0,0 +1,169 @@
+'''
+Metrics holds the counters and fixed bucket
+histograms for the message hot path and renders
+them, with the STOMP client and signal block
+counters, in the Prometheus text format.
+
+Every value is only ever written by the code
+consuming the feed, the web server only reads,
+so nothing needs a lock.
+'''
+import common
+import pin_drivers
+
+import time
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    def ticks_us():
+        '''
+        CPython stand-in for time.ticks_us
+        '''
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        '''
+        CPython stand-in for time.ticks_diff
+        '''
+        return end - start
+
+LATENCY_BUCKETS_US = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+METRIC_PREFIX = 'desk_signaller_'
+
+class Histogram:
+    '''
+    A histogram over fixed bucket bounds, the
+    counts are preallocated so observing never allocates
+    '''
+    def __init__(self, name: str, help_text: str, bounds: tuple = LATENCY_BUCKETS_US):
+        self.name = name
+        self.help_text = help_text
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value: int) -> None:
+        '''
+        Records a single value
+        '''
+        bucket = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            bucket += 1
+        self.bucket_counts[bucket] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, lines: list) -> None:
+        '''
+        Appends the histogram in Prometheus text format
+        '''
+        name = METRIC_PREFIX + self.name
+        lines.append(f'# HELP {name} {self.help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, self.bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.total}')
+        lines.append(f'{name}_count {self.count}')
+
+#TD messages received, of every type, counted before any filtering
+messages_received = 0
+#SF messages applied to a configured block
+messages_routed = 0
+#SF messages dropped for being in another area or for an unconfigured address
+messages_filtered = 0
+parse_latency_us = Histogram('parse_latency_us', 'Time to parse a STOMP frame in microseconds.')
+apply_latency_us = Histogram('apply_latency_us',
+                             'Time to filter and apply the messages of a frame in microseconds.')
+
+#(phase, ms) in the order the boot phases completed
+boot_phases_ms = []
+_boot_phase_started_us = None
+
+def start_boot_timing() -> None:
+    '''
+    Starts timing the first boot phase
+    '''
+    global _boot_phase_started_us
+    boot_phases_ms.clear()
+    _boot_phase_started_us = ticks_us()
+
+def mark_boot_phase(phase: str) -> int:
+    '''
+    Records the time since the previous phase ended,
+    or since start_boot_timing, as the named phase
+
+    returns:
+        int: milliseconds the phase took
+    '''
+    global _boot_phase_started_us
+    now = ticks_us()
+    if _boot_phase_started_us is None:
+        _boot_phase_started_us = now
+    elapsed_ms = ticks_diff(now, _boot_phase_started_us) // 1000
+    boot_phases_ms.append((phase, elapsed_ms))
+    _boot_phase_started_us = now
+    return elapsed_ms
+
+def render_counter(lines: list, name: str, help_text: str, value, labels: str = '') -> None:
+    '''
+    Appends a counter with its HELP and TYPE lines
+    '''
+    name = METRIC_PREFIX + name
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} counter')
+    lines.append(f'{name}{labels} {value}')
+
+def render_prometheus() -> bytes:
+    '''
+    Returns every metric in the Prometheus text format
+    '''
+    lines = []
+    client = common.stomp_client
+    if client:
+        render_counter(lines, 'frames_received_total', 'STOMP frames received.', client.frames_received)
+        render_counter(lines, 'bytes_received_total', 'Bytes received from the broker.',
+                       client.bytes_received)
+        render_counter(lines, 'acks_sent_total', 'ACK frames sent.', client.acks_sent)
+    supervisor = common.connection_supervisor
+    if supervisor:
+        stats = supervisor.stats()
+        render_counter(lines, 'reconnects_total', 'Reconnections to the broker.',
+                       stats['reconnect_count'])
+        render_counter(lines, 'disconnected_ms_total', 'Time spent disconnected in milliseconds.',
+                       stats['disconnected_ms'])
+
+    render_counter(lines, 'td_messages_received_total', 'TD messages received, of every type.',
+                   messages_received)
+    render_counter(lines, 'messages_routed_total', 'SF messages applied to a signal block.',
+                   messages_routed)
+    render_counter(lines, 'messages_filtered_total', 'SF messages not for a configured block.',
+                   messages_filtered)
+    parse_latency_us.render(lines)
+    apply_latency_us.render(lines)
+    render_counter(lines, 'pin_driver_writes_total', 'Writes made by the pin driver.',
+                   pin_drivers.driver.write_count)
+
+    if boot_phases_ms:
+        name = METRIC_PREFIX + 'boot_phase_ms'
+        lines.append(f'# HELP {name} Time spent in each boot phase in milliseconds.')
+        lines.append(f'# TYPE {name} gauge')
+        for phase, elapsed_ms in boot_phases_ms:
+            lines.append(f'{name}{{phase="{phase}"}} {elapsed_ms}')
+
+    name = METRIC_PREFIX + 'element_changes_total'
+    lines.append(f'# HELP {name} Signal element state changes per block.')
+    lines.append(f'# TYPE {name} counter')
+    for area, blocks in (common.area_container or {}).items():
+        for address, block in blocks.items():
+            lines.append(f'{name}{{area="{area}",block="{address}"}} {block.element_changes}')
+
+    lines.append('')
+    return '\n'.join(lines).encode()
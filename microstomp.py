@@ -2,8 +2,197 @@
 Written as a patch-in for Stomp.py for Micropython.
 '''
 
+import logger
+
 import socket as usocket
 import time as utime
+import random
+import struct
+
+try:
+    import select
+except ImportError:
+    import uselect as select
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+try:
+    ticks_ms = utime.ticks_ms
+    ticks_diff = utime.ticks_diff
+except AttributeError:
+    def ticks_ms():
+        '''
+        CPython stand-in for utime.ticks_ms
+        '''
+        return int(utime.monotonic() * 1000)
+
+    def ticks_diff(end, start):
+        '''
+        CPython stand-in for utime.ticks_diff
+        '''
+        return end - start
+
+try:
+    sleep_ms = utime.sleep_ms
+except AttributeError:
+    def sleep_ms(period):
+        '''
+        CPython stand-in for utime.sleep_ms
+        '''
+        utime.sleep(period / 1000)
+
+STREAM_BUFFER_SIZE = 16384
+OUTBOUND_BUFFER_SIZE = 1024
+HEARTBEAT_FRAME = b'\n'
+ACK_FRAME_SUFFIX = b'\r\ncontent-length:0\r\n\r\n\x00'
+CAPTURE_MAGIC = b'DSCAP2\n'
+# per chunk: ms since the previous chunk, which unlike ms since the
+# capture started stays small as ticks_ms wraps, chunk length
+CAPTURE_RECORD = '<IH'
+CAPTURE_RECORD_SIZE = 6
+CAPTURE_MAX_CHUNK = 0xFFFF
+ACK_MODES = ('auto', 'client', 'client-individual')
+# a link is dead once this many server heart-beat intervals pass in silence
+HEARTBEAT_GRACE = 2
+# ETIMEDOUT and EAGAIN, how MicroPython reports a socket timeout
+SOCKET_TIMEOUT_ERRNOS = (110, 11)
+HEADER_SCAN_SIZE = 512
+# MicroPython's bytearray has no find, bytes does
+BYTEARRAY_HAS_FIND = hasattr(bytearray, 'find')
+# bytes copied out of the buffer at a time to search where it has no find
+FIND_CHUNK_SIZE = 256
+# longest connect and wait for CONNECTED before an attempt fails
+CONNECT_TIMEOUT_MS = 10000
+# how often the event loop polls a socket connecting without blocking
+CONNECT_POLL_MS = 20
+# EINPROGRESS, as CPython and lwIP number it, and EAGAIN from a connect
+# that has started on a non-blocking socket
+CONNECT_IN_PROGRESS_ERRNOS = (115, 119, 11)
+
+VALID_COMMANDS = (
+    'ERROR',
+    'MESSAGE',
+    'RECEIPT',
+    'CONNECTED',
+    'CONNECT',
+    'ACK',
+    'NACK',
+    'STOMP',
+    'SUBSCRIBE',
+    'UNSUBSCRIBE',
+    'DISCONNECT'
+)
+
+# STOMP 1.2 header escapes, CONNECT and CONNECTED frames are never escaped
+HEADER_ESCAPES = {
+    'r': '\r',
+    'n': '\n',
+    'c': ':',
+    '\\': '\\'
+}
+
+def unescape_header_value(value: str) -> str:
+    '''
+    Reverses STOMP 1.2 header value escaping.
+    Unknown escape sequences are kept as received.
+
+    :params:
+    :value: str - raw header value
+
+    :returns:
+    :str: unescaped header value
+    '''
+    if '\\' not in value:
+        return value
+    if '\\\\' not in value:
+        return value.replace('\\c', ':').replace('\\n', '\n').replace('\\r', '\r')
+    parts = []
+    position = 0
+    while True:
+        escape_index = value.find('\\', position)
+        if escape_index < 0:
+            parts.append(value[position:])
+            break
+        parts.append(value[position:escape_index])
+        escaped = value[escape_index + 1:escape_index + 2]
+        parts.append(HEADER_ESCAPES.get(escaped, '\\' + escaped))
+        position = escape_index + 2
+    return ''.join(parts)
+
+def escape_header_value(value: str) -> str:
+    '''
+    Applies STOMP 1.2 header value escaping
+
+    :params:
+    :value: str - header value
+
+    :returns:
+    :str: escaped header value
+    '''
+    for character in ('\\', '\r', '\n', ':'):
+        if character in value:
+            break
+    else:
+        return value
+    return value.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n').replace(':', '\\c')
+
+def encode_frame(command: str, headers: dict, body: bytes = b'', escape: bool = True) -> bytes:
+    '''
+    Encodes a frame in a single join, always
+    adding the content-length header.
+
+    :params:
+    :command: str - STOMP command
+    :headers: dict - header values
+    :body: bytes - frame body
+    :escape: bool - apply header escaping, not used for CONNECT frames
+
+    :returns:
+    :bytes: the encoded frame including its NUL terminator
+    '''
+    parts = [command, '\r\n']
+    if headers:
+        for header, value in headers.items():
+            value = str(value)
+            if escape:
+                value = escape_header_value(value)
+            parts.append(f'{header}:{value}\r\n')
+    parts.append(f'content-length:{len(body)}\r\n\r\n')
+    return ''.join(parts).encode("utf-8") + body + b'\x00'
+
+def is_socket_timeout(error: OSError) -> bool:
+    '''
+    Returns True if the error is a receive timing
+    out rather than the connection failing
+    '''
+    timeout_type = getattr(usocket, 'timeout', None)
+    if timeout_type and isinstance(error, timeout_type):
+        return True
+    return bool(error.args) and error.args[0] in SOCKET_TIMEOUT_ERRNOS
+
+def send_all(cx_socket, data) -> int:
+    '''
+    Sends all of data, resending the remainder after
+    a short write.
+
+    :params:
+    :cx_socket: socket to send on
+    :data: bytes, bytearray or memoryview to send
+
+    :returns:
+    :int: number of bytes sent
+    '''
+    data = memoryview(data)
+    total = len(data)
+    while data:
+        sent = cx_socket.send(data)
+        if not sent:
+            raise OSError('connection closed during send')
+        data = data[sent:]
+    return total
 
 class Frame:
     '''
@@ -13,32 +202,89 @@ class Frame:
     def __init__(
             self,
             command: str,
-            headers: dict,
-            body: str
+            headers: dict | None,
+            body,
+            raw_headers: bytes | None = None
     ):
         '''
         Initialises the Frame
         :params:
         :command: must be string of CONNECT, STOMP, SUBSCRIBE, UNSUBSCRIBE, DISCONNECT
+        :headers: dict - header values, None when raw_headers are given
+        :body: str for outbound frames, memoryview for parsed frames
+        :raw_headers: bytes - undecoded header block, decoded on first access
         '''
-        if command.upper() not in [
-            'ERROR',
-            'MESSAGE',
-            'CONNECT',
-            'ACK',
-            'STOMP',
-            'SUBSCRIBE',
-            'UNSUBSCRIBE',
-            'DISCONNECT'
-        ]:
+        command = command.upper().strip()
+        if command not in VALID_COMMANDS:
             raise ValueError('Invalid STOMP COMMAND supplied.', command)
 
-        self.command = command.upper().rstrip().strip()
-        self.headers = headers
+        self.command = command
+        self._headers = headers
+        self._raw_headers = raw_headers
         self.body = body
-        self.built_frame = self.__build_frame()
+        self._built_frame = None
+
+    @property
+    def headers(self) -> dict:
+        '''
+        Header dictionary, decoded from the raw header
+        block the first time it is accessed.
+        '''
+        if self._headers is None:
+            self._headers = {}
+            if self._raw_headers:
+                for line in self._raw_headers.decode('utf-8').split('\n'):
+                    separator = line.find(':')
+                    if separator < 1:
+                        continue
+                    key = line[:separator]
+                    value = line[separator + 1:].rstrip('\r')
+                    if self.command not in ('CONNECT', 'CONNECTED'):
+                        key = unescape_header_value(key)
+                        value = unescape_header_value(value)
+                    # STOMP 1.2: the first occurrence of a repeated header wins
+                    if key not in self._headers:
+                        self._headers[key] = value
+        return self._headers
+
+    def get_header(self, key: str, default=None):
+        '''
+        Returns a single header value. When the header block
+        has not been decoded yet only the matching line is,
+        so the full dictionary is never built.
+
+        :params:
+        :key: str - header name
+        :default: returned when the header is absent
+        '''
+        if self._headers is not None or not self._raw_headers:
+            return self.headers.get(key, default)
+        prefix = key.encode('utf-8') + b':'
+        raw = self._raw_headers
+        position = 0 if raw.startswith(prefix) else raw.find(b'\n' + prefix)
+        if position < 0:
+            return default
+        if position:
+            position += 1
+        line_end = raw.find(b'\n', position)
+        if line_end < 0:
+            line_end = len(raw)
+        value = raw[position + len(prefix):line_end].decode('utf-8').rstrip('\r')
+        if self.command in ('CONNECT', 'CONNECTED'):
+            return value
+        return unescape_header_value(value)
+
+    @property
+    def built_frame(self) -> bytes:
+        '''
+        The encoded frame, only built when first requested
+        so parsed inbound frames never pay for it.
+        '''
+        if self._built_frame is None:
+            self._built_frame = self.__build_frame()
+        return self._built_frame
 
-    def __build_frame(self) -> str:
+    def __build_frame(self) -> bytes:
         '''
         Builds frame by concatenating values provided with required encoding.
         Calculates length of BODY content in bytes.
@@ -47,19 +293,12 @@ class Frame:
         :returns:
         : _: utf-8 encoded string conforming to STOMP 1.2
         '''
-        std_terminator = '''\r\n'''
-        _ = self.command + std_terminator
-        body_length = len(self.body.encode("utf-8"))
-
-        if self.headers:
-            for header, value in self.headers.items():
-                _ += f'''{header}:{value}{std_terminator}'''
-
-        _ += f'''content-length:{body_length}{std_terminator}'''
-        _ += std_terminator
-        _ += self.body + '''\x00'''
-
-        return _.encode("utf-8")
+        if isinstance(self.body, str):
+            body = self.body.encode("utf-8")
+        else:
+            body = bytes(self.body)
+        return encode_frame(self.command, self.headers, body,
+                            escape=self.command not in ('CONNECT', 'CONNECTED'))
 
     def is_error(self):
         '''
@@ -74,51 +313,346 @@ class Frame:
         A class method to take a frame and parse it
         into a Frame object.
 
+        Only the header block is copied, the body is a
+        memoryview over the frame passed in so it is only
+        valid for as long as that buffer is.
+
         :params:
-        :frame: bytes representation of frame
+        :frame: bytes, bytearray or memoryview of the frame,
+            str is accepted and encoded first
 
         :returns:
-        : : Frame
+        : : Frame or False if the frame cannot be parsed
         '''
-        frame = str(frame)
-        body_content = None
-        parsed_command = None
-        parsed_headers = {}
-        first_newline_index = frame.index('\n')
-        last_newline_index = frame.rindex('\n')
-        null_terminator_index = frame.rindex('\x00')
+        if isinstance(frame, str):
+            frame = frame.encode("utf-8")
+        frame = memoryview(frame)
+        frame_size = len(frame)
 
-        if last_newline_index >= null_terminator_index:
-            _ = frame[:last_newline_index-1]
-            last_newline_index = _.rindex('\n')
+        # headers are small, copy only as much as is needed to find their end
+        scan_size = HEADER_SCAN_SIZE
+        while True:
+            head = bytes(frame[:scan_size])
+            header_end = head.find(b'\n\n')
+            crlf_header_end = head.find(b'\n\r\n', 0, header_end if header_end >= 0 else len(head))
+            if crlf_header_end >= 0:
+                header_end = crlf_header_end
+                body_start = header_end + 3
+            else:
+                body_start = header_end + 2
+            if header_end >= 0 or scan_size >= frame_size:
+                break
+            scan_size *= 2
 
-        try:
-            parsed_command = frame[:first_newline_index+1].rstrip()
-            headers = frame[first_newline_index+1:last_newline_index+1]
-            headers = headers.split('\n')
-            body_content = frame[last_newline_index+1:null_terminator_index]
-        except Exception as e:
-            print("(critical): could not parse frame ", e)
+        if header_end < 0:
+            logger.critical('could not parse frame, no end of headers')
             return False
 
-        for header in headers:
-            if ':' in str(header) and len(header) > 1:
-                header = header.rstrip().split(':')
-                parsed_headers[header[0]] = header[1]
-            else:
-                #print('(warn): header could not be parsed', header)
-                pass
+        command_end = head.find(b'\n')
+        body_end = frame_size
+        while body_end > body_start and frame[body_end - 1] in (10, 13):
+            body_end -= 1
+        if body_end > body_start and frame[body_end - 1] == 0:
+            body_end -= 1
 
         try:
             return cls(
-                command = str(parsed_command),
-                headers = parsed_headers,
-                body = str(body_content)
+                command = head[:command_end].decode("utf-8"),
+                headers = None,
+                body = frame[body_start:body_end],
+                raw_headers = head[command_end + 1:header_end]
             )
         except Exception as e:
-            print('(critical): ', e)
+            logger.critical('could not parse frame %s', e)
             return False
 
+class FrameDecoder:
+    '''
+    Incrementally cuts complete STOMP frames out of a
+    byte stream. Bytes are received straight into a
+    preallocated buffer so memory stays bounded however
+    the broker splits or merges frames across recvs.
+    '''
+    def __init__(self, buffer_size: int = STREAM_BUFFER_SIZE):
+        '''
+        :params:
+        :buffer_size: int - largest frame (in bytes) that can be held
+        '''
+        self.buffer = bytearray(buffer_size)
+        self.buffer_view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.discarding = False
+        #where searches of the partial frame at start resume, so a frame
+        #arriving over many receives has each byte searched about once
+        self.scan_offset = 0
+        #body start and NUL index of the partial frame, -1 until known
+        self.body_start = -1
+        self.terminator = -1
+
+    def _make_space(self) -> None:
+        '''
+        Moves unconsumed bytes to the front of the buffer.
+        If the buffer is full of a single partial frame then
+        it is dropped and the decoder resyncs on the next NUL.
+        '''
+        if self.start:
+            shift = self.start
+            pending = self.end - shift
+            self.buffer[:pending] = self.buffer_view[shift:self.end]
+            self.start = 0
+            self.end = pending
+            self.scan_offset = max(0, self.scan_offset - shift)
+            if self.body_start >= 0:
+                self.body_start -= shift
+            if self.terminator >= 0:
+                self.terminator -= shift
+        if self.end == len(self.buffer):
+            logger.error('frame exceeds stream buffer, discarding')
+            self.reset()
+            self.discarding = True
+
+    def reset(self) -> None:
+        '''
+        Drops any partial frame, used when the
+        connection the bytes came from is replaced
+        '''
+        self.start = self.end = 0
+        self.discarding = False
+        self.scan_offset = 0
+        self.body_start = self.terminator = -1
+
+    def free_space(self) -> memoryview:
+        '''
+        Returns a view of the free space at the end of the
+        buffer to receive into, making room first if needed.
+        Follow with commit() once bytes have been written to it.
+        '''
+        if self.end == len(self.buffer):
+            self._make_space()
+        return self.buffer_view[self.end:]
+
+    def commit(self, received: int) -> None:
+        '''
+        Marks bytes written into free_space() as received.
+
+        :params:
+        :received: int - number of bytes written
+        '''
+        self.end += received
+
+    def receive_from(self, source) -> int:
+        '''
+        Receives directly into the free space of the buffer.
+
+        :params:
+        :source: socket or stream with recv_into/readinto
+
+        :returns:
+        :int: number of bytes received, 0 when closed
+        '''
+        reader = getattr(source, 'recv_into', None) or source.readinto
+        received = reader(self.free_space()) or 0
+        self.commit(received)
+        return received
+
+    def decode(self, data):
+        '''
+        Generator that copies bytes which did not come from a
+        socket into the buffer and yields each completed frame,
+        exactly as receive_from() followed by frames() would.
+
+        :params:
+        :data: bytes - raw bytes from the stream
+        '''
+        data = memoryview(data)
+        while data:
+            if self.end == len(self.buffer):
+                self._make_space()
+            count = min(len(data), len(self.buffer) - self.end)
+            self.buffer[self.end:self.end + count] = data[:count]
+            self.end += count
+            data = data[count:]
+            yield from self.frames()
+
+    def find(self, pattern: bytes, start: int, end: int) -> int:
+        '''
+        Returns the index of pattern in the buffer between
+        start and end, -1 if absent. Where bytearray has no
+        find the span is copied and searched a chunk at a
+        time, so only the bytes up to a match are copied.
+        '''
+        if BYTEARRAY_HAS_FIND:
+            return self.buffer.find(pattern, start, end)
+        overlap = len(pattern) - 1
+        while end - start > overlap:
+            stop = min(end, start + FIND_CHUNK_SIZE)
+            index = bytes(self.buffer_view[start:stop]).find(pattern)
+            if index >= 0:
+                return start + index
+            if stop == end:
+                break
+            start = stop - overlap
+        return -1
+
+    def frames(self):
+        '''
+        Generator yielding each complete frame held in the buffer
+        as a memoryview including its NUL terminator. A yielded
+        view is only valid until the next receive_from() or decode().
+
+        A partial frame's header end, body start and how far its
+        body has been searched are kept between calls, so each
+        call only searches the bytes received since the last.
+        '''
+        buffer = self.buffer
+        find = self.find
+
+        while self.start < self.end:
+            if self.discarding:
+                terminator = find(b'\x00', max(self.start, self.scan_offset), self.end)
+                if terminator < 0:
+                    self.start = self.end
+                    break
+                self.start = self.scan_offset = terminator + 1
+                self.discarding = False
+                continue
+
+            if self.body_start < 0:
+                # heart-beats are bare EOLs between frames
+                if buffer[self.start] in (10, 13):
+                    self.start += 1
+                    continue
+
+                # the terminators may straddle the bytes already searched
+                scan_from = max(self.start, self.scan_offset - 3)
+                header_end = find(b'\n\n', scan_from, self.end)
+                crlf_header_end = find(b'\r\n\r\n', scan_from, self.end)
+                if crlf_header_end >= 0 and (header_end < 0 or crlf_header_end < header_end):
+                    body_start = crlf_header_end + 4
+                elif header_end >= 0:
+                    body_start = header_end + 2
+                else:
+                    self.scan_offset = self.end
+                    break
+
+                self.body_start = self.scan_offset = body_start
+                length_index = find(b'\ncontent-length:', self.start, body_start)
+                if length_index >= 0:
+                    length_index += 16
+                    length_end = find(b'\n', length_index, body_start)
+                    try:
+                        content_length = int(bytes(self.buffer_view[length_index:length_end]).strip())
+                    except ValueError:
+                        content_length = -1
+                    if content_length >= 0:
+                        self.terminator = body_start + content_length
+
+            terminator = self.terminator
+            if terminator >= 0:
+                if terminator >= self.end:
+                    break
+                if buffer[terminator] != 0:
+                    logger.error('frame body does not match content-length, resyncing')
+                    self.body_start = self.terminator = -1
+                    self.discarding = True
+                    continue
+            else:
+                terminator = find(b'\x00', self.scan_offset, self.end)
+                if terminator < 0:
+                    self.scan_offset = self.end
+                    break
+
+            frame_start = self.start
+            self.start = self.scan_offset = terminator + 1
+            self.body_start = self.terminator = -1
+            yield self.buffer_view[frame_start:self.start]
+
+        if self.start == self.end:
+            self.start = self.end = self.scan_offset = 0
+
+def ack_frame_prefix(subscription_id: str) -> bytes:
+    '''
+    Returns the start of an ACK frame for a subscription,
+    up to where the ack id is spliced in
+    '''
+    return ('ACK\r\nsubscription:' + escape_header_value(subscription_id)
+            + '\r\nid:').encode("utf-8")
+
+class Subscription:
+    '''
+    A subscription multiplexed over the client's
+    connection, holding back its own ACKs
+    '''
+    def __init__(self, subscription_id: str, topic: str, ack: str, headers: dict | None = None):
+        '''
+        :params:
+        :subscription_id: str - id the broker returns in each MESSAGE's subscription header
+        :topic: str - the destination of the topic
+        :ack: str - auto, client or client-individual
+        :headers: dict - extra SUBSCRIBE headers, i.e. a selector
+        '''
+        self.subscription_id = subscription_id
+        self.topic = topic
+        self.ack_mode = ack
+        subscribe_headers = {
+            'id': subscription_id,
+            'destination': topic,
+            'ack': ack
+        }
+        if headers:
+            subscribe_headers.update(headers)
+        self.frame = encode_frame('SUBSCRIBE', subscribe_headers)
+        self.ack_frame_prefix = ack_frame_prefix(subscription_id)
+        self.pending_ack_ids = []
+
+class CaptureWriter:
+    '''
+    Records raw received bytes to a capture file, each
+    chunk prefixed by its arrival time and length, so
+    traffic can be replayed later without a broker.
+    '''
+    def __init__(self, file_location: str):
+        '''
+        :params:
+        :file_location: str - capture file to create, replaced if present
+        '''
+        self.capture_file = open(file_location, 'wb')
+        self.capture_file.write(CAPTURE_MAGIC)
+        self.record_header = bytearray(CAPTURE_RECORD_SIZE)
+        self.last_ticks = ticks_ms()
+
+    def write(self, data) -> None:
+        '''
+        Appends received bytes to the capture
+
+        :params:
+        :data: bytes or memoryview as received
+        '''
+        data = memoryview(data)
+        now = ticks_ms()
+        interval_ms = max(0, ticks_diff(now, self.last_ticks))
+        self.last_ticks = now
+        while data:
+            chunk = data[:CAPTURE_MAX_CHUNK]
+            struct.pack_into(CAPTURE_RECORD, self.record_header, 0, interval_ms, len(chunk))
+            self.capture_file.write(self.record_header)
+            self.capture_file.write(chunk)
+            data = data[CAPTURE_MAX_CHUNK:]
+            interval_ms = 0
+
+    def flush(self) -> None:
+        '''
+        Writes buffered records through to the file
+        '''
+        self.capture_file.flush()
+
+    def close(self) -> None:
+        '''
+        Flushes and closes the capture file
+        '''
+        self.capture_file.close()
+
 class MicroSTOMPClient:
     '''
     A client for sending and receiving messages to a STOMP server.
@@ -129,7 +663,14 @@ class MicroSTOMPClient:
                  client_id,
                  username,
                  password,
-                 on_message_callback
+                 on_message_callback,
+                 ack_every_frames: int = 1,
+                 ack_every_ms: int = 0,
+                 heart_beat: tuple = (0, 0),
+                 capture_file_location: str | None = None,
+                 connect_timeout_ms: int = CONNECT_TIMEOUT_MS,
+                 on_idle_callback=None,
+                 idle_poll_ms: int = 0
                 ):
         '''
         :params:
@@ -139,6 +680,18 @@ class MicroSTOMPClient:
         :username: str -  auth username
         :password: str - auth password
         :on_message_callback: function - callback function
+        :ack_every_frames: int - send ACKs once this many messages are unacknowledged
+        :ack_every_ms: int - or once this long has passed since the last ACK, 0 to disable
+        :heart_beat: tuple - (send, receive) heart-beat periods in ms to offer
+            the server, 0 for none
+        :capture_file_location: str - if given, every byte received is recorded
+            there for replay.py
+        :connect_timeout_ms: int - longest a connect may wait on the socket
+            connecting or on the CONNECTED frame
+        :on_idle_callback: function - called each time the listen loop wakes,
+            whether or not a frame arrived
+        :idle_poll_ms: int - longest a receive may wait before the loop wakes
+            for on_idle_callback, 0 to only wake as heart-beats and ACKs need
         '''
         self.cx_socket = usocket.socket(usocket.AF_INET, usocket.SOCK_STREAM)
         self.cx_host = host
@@ -148,51 +701,278 @@ class MicroSTOMPClient:
         self.cx_password = password
         self.on_message_callback = on_message_callback
         self.connected_to_broker = False
-        self.exponential_backoff_period = 0
-        self.topic_subscribed_to = None
-        self.send_acknowledgment_frame = True
+        #Subscription by id, all share the one connection
+        self.subscriptions = {}
+        self.frame_decoder = FrameDecoder()
+        self.cx_stream = None
+        self.ack_queue = None
+        self.ack_event = None
+        self.ack_every_frames = max(1, ack_every_frames)
+        self.ack_every_ms = ack_every_ms
+        self.frames_since_ack = 0
+        self.last_ack_ticks = ticks_ms()
+        self.outbound_buffer = bytearray(OUTBOUND_BUFFER_SIZE)
+        self.outbound_view = memoryview(self.outbound_buffer)
+        self.ack_frame_prefix = ack_frame_prefix(client_id)
+        self.heart_beat = heart_beat
+        self.connect_timeout_ms = connect_timeout_ms
+        self.on_idle_callback = on_idle_callback
+        self.idle_poll_ms = idle_poll_ms
+        self.heartbeat_send_ms = 0
+        self.heartbeat_receive_ms = 0
+        self.last_sent_ticks = ticks_ms()
+        self.last_received_ticks = ticks_ms()
+        self.capture = CaptureWriter(capture_file_location) if capture_file_location else None
+        # running totals read by metrics.py, only written here
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.acks_sent = 0
 
     def connect(self):
         '''
-        Connects to server provided and returns socket
+        Connects to server provided and returns socket. Neither
+        the connect nor the wait for CONNECTED blocks for longer
+        than connect_timeout_ms, so a broker that accepts but
+        never answers fails the attempt.
         '''
 
-        print("(info): beginning connection to server")
+        logger.info('beginning connection to server')
 
-        connect_frame = Frame(
+        started = ticks_ms()
+        try:
+            self.cx_socket.settimeout(self.connect_timeout_ms / 1000)
+            self.cx_socket.connect((self.cx_host, self.cx_port))
+        except Exception as e:
+            logger.critical('cannot connect to specified host - %s', e)
+            return False
+
+        try:
+            self.send_bytes(self.connect_frame())
+            server_response = self.receive_connected_frame(started)
+        except OSError as e:
+            logger.critical('no response from server to connect - %s', e)
+            return False
+
+        return self.complete_connect(server_response)
+
+    async def connect_async(self):
+        '''
+        Event loop version of connect. The socket connects
+        without blocking and is polled until it is writable
+        and the CONNECTED frame has arrived, so other tasks
+        keep running, within the same connect_timeout_ms.
+        '''
+        logger.info('beginning connection to server')
+
+        started = ticks_ms()
+        try:
+            self.cx_socket.setblocking(False)
+            try:
+                self.cx_socket.connect((self.cx_host, self.cx_port))
+            except OSError as e:
+                if not (e.args and e.args[0] in CONNECT_IN_PROGRESS_ERRNOS):
+                    raise
+            ready = await self.wait_for_socket(select.POLLOUT, started)
+            if ready & (select.POLLERR | select.POLLHUP):
+                raise OSError('connection refused')
+        except Exception as e:
+            logger.critical('cannot connect to specified host - %s', e)
+            return False
+
+        try:
+            data = memoryview(self.connect_frame())
+            while data:
+                await self.wait_for_socket(select.POLLOUT, started)
+                data = data[self.cx_socket.send(data):]
+            self.last_sent_ticks = ticks_ms()
+            server_response = await self.receive_connected_frame_async(started)
+        except OSError as e:
+            logger.critical('no response from server to connect - %s', e)
+            return False
+
+        return self.complete_connect(server_response)
+
+    async def wait_for_socket(self, event: int, started: int) -> int:
+        '''
+        Polls the socket every CONNECT_POLL_MS until it is
+        ready for event, giving up connect_timeout_ms after
+        started
+
+        :params:
+        :event: int - select.POLLIN or select.POLLOUT
+        :started: int - ticks_ms when the connect began
+
+        :returns:
+        :int: the poll flags the socket is ready with
+        '''
+        poller = select.poll()
+        poller.register(self.cx_socket, event)
+        try:
+            while True:
+                for ready in poller.poll(0):
+                    return ready[1]
+                if ticks_diff(ticks_ms(), started) >= self.connect_timeout_ms:
+                    raise OSError(110, 'timed out connecting')
+                await asyncio.sleep(CONNECT_POLL_MS / 1000)
+        finally:
+            poller.unregister(self.cx_socket)
+
+    def connect_frame(self) -> bytes:
+        '''
+        Returns the CONNECT frame for this client
+        '''
+        return Frame(
             command = 'CONNECT',
             headers = {
                 'accept-version':'1.2',
                 'host':self.cx_host,
                 'login':self.cx_username,
-                'passcode':self.cx_password
+                'passcode':self.cx_password,
+                'heart-beat':f'{self.heart_beat[0]},{self.heart_beat[1]}'
             },
             body=''
         ).built_frame
 
-        try:
-            self.cx_socket.connect((self.cx_host, self.cx_port))
-        except Exception as e:
-            print('(fatal): cannot connect to specified host - ', e)
-            return False
+    def complete_connect(self, server_response) -> bool:
+        '''
+        Checks the broker's answer to CONNECT and, if it
+        accepted, negotiates heart-beats and marks the
+        client connected
+
+        :params:
+        :server_response: Frame | False - the first frame received
 
-        self.cx_socket.send(connect_frame)
-        server_response = self.cx_socket.recv(1024).decode("utf-8")
+        :returns:
+        :bool: True if connected
+        '''
+        if not server_response or server_response.command != 'CONNECTED':
+            logger.critical('server refused connection - %s',
+                            server_response and server_response.headers)
+            return False
 
-        print('(info): server responded to connect with ', server_response)
+        logger.info('server responded to connect with %s', server_response.headers)
 
+        self.negotiate_heartbeats(server_response.get_header('heart-beat', '0,0'))
+        self.cx_socket.settimeout(self.heartbeat_poll_seconds())
+        self.last_received_ticks = ticks_ms()
         self.connected_to_broker = True
         return True
 
+    def receive_connected_frame(self, started: int):
+        '''
+        Receives through the frame decoder until the first
+        frame is complete, however the broker splits it,
+        giving up connect_timeout_ms after started
+
+        :params:
+        :started: int - ticks_ms when the connect began
+
+        :returns:
+        :Frame | False: the parsed frame, False if the connection closed
+        '''
+        while True:
+            for frame_data in self.frame_decoder.frames():
+                return Frame.parse_frame(bytes(frame_data))
+            remaining_ms = self.connect_timeout_ms - ticks_diff(ticks_ms(), started)
+            if remaining_ms <= 0:
+                raise OSError(110, 'timed out waiting for CONNECTED')
+            self.cx_socket.settimeout(remaining_ms / 1000)
+            if not self.frame_decoder.receive_from(self.cx_socket):
+                return False
+
+    async def receive_connected_frame_async(self, started: int):
+        '''
+        Event loop version of receive_connected_frame,
+        receiving only once the socket polls readable
+        '''
+        while True:
+            for frame_data in self.frame_decoder.frames():
+                return Frame.parse_frame(bytes(frame_data))
+            await self.wait_for_socket(select.POLLIN, started)
+            if not self.frame_decoder.receive_from(self.cx_socket):
+                return False
+
+    def negotiate_heartbeats(self, server_heart_beat: str) -> None:
+        '''
+        Sets the heart-beat periods from the CONNECTED frame,
+        each side uses the slower of what was offered and what
+        the other side can do, or none if either offered 0.
+
+        :params:
+        :server_heart_beat: str - the server's heart-beat header, i.e. 0,10000
+        '''
+        try:
+            server_send, server_receive = (int(period) for period in server_heart_beat.split(','))
+        except ValueError:
+            server_send = server_receive = 0
+        client_send, client_receive = self.heart_beat
+        self.heartbeat_send_ms = max(client_send, server_receive) if client_send and server_receive else 0
+        self.heartbeat_receive_ms = max(client_receive, server_send) if client_receive and server_send else 0
+
+    def reconnect(self) -> bool:
+        '''
+        Replaces the socket, connects again and replays
+        every subscription. ACKs held back for the old
+        connection are dropped as they cannot apply to it.
+
+        :returns:
+        :bool: True if connected
+        '''
+        self.replace_socket()
+        if not self.connect():
+            return False
+        self.resubscribe()
+        return True
+
+    async def reconnect_async(self) -> bool:
+        '''
+        Event loop version of reconnect, connecting
+        through connect_async
+
+        :returns:
+        :bool: True if connected
+        '''
+        self.replace_socket()
+        if not await self.connect_async():
+            return False
+        self.resubscribe()
+        return True
+
+    def replace_socket(self) -> None:
+        '''
+        Closes the socket and opens a new one, dropping
+        anything received or held back for the old connection
+        '''
+        try:
+            self.cx_socket.close()
+        except Exception:
+            pass
+        self.connected_to_broker = False
+        self.cx_socket = usocket.socket(usocket.AF_INET, usocket.SOCK_STREAM)
+        self.frame_decoder.reset()
+        if self.capture:
+            self.capture.flush()
+        for subscription in self.subscriptions.values():
+            subscription.pending_ack_ids.clear()
+        self.frames_since_ack = 0
+
+    def resubscribe(self) -> None:
+        '''
+        Sends every subscription again on a new connection
+        '''
+        for subscription in self.subscriptions.values():
+            logger.info('resubscribing to %s', subscription.topic)
+            self.send_bytes(subscription.frame)
+
     def disconnect(self):
         '''
         Gracefully closes the connection with the server.
         Sets property connected_to_broker to True
         '''
-        print('(info): disconnection initiated...')
+        logger.info('disconnection initiated...')
 
         if not self.connected_to_broker:
-            print('(info): no active connection to close.')
+            logger.info('no active connection to close.')
 
         disconnect_reference = 100200
         disconnect_frame = Frame(
@@ -203,68 +983,393 @@ class MicroSTOMPClient:
             body=''
         ).built_frame
 
-        self.cx_socket.send(disconnect_frame)
+        self.send_bytes(disconnect_frame)
         disconnect_response = self.cx_socket.recv(1024).decode("utf-8")
 
-        print('(info): received response from server ', disconnect_frame)
+        logger.info('received response from server %s', disconnect_frame)
 
         if 'DISCONNECT' in disconnect_response and str(disconnect_reference) in disconnect_response:
-            print('(info): graceful disconnect transaction completed')
+            logger.info('graceful disconnect transaction completed')
             self.cx_socket.close()
             self.connected_to_broker = False
         else:
-            print('(info): could not gracefully disconnect, force closing')
+            logger.warn('could not gracefully disconnect, force closing')
             self.cx_socket.close()
             self.connected_to_broker = False
 
-    def subscribe(self, topic: str, ack: str = 'auto'):
+    def subscribe(self, topic: str, ack: str = 'auto', subscription_id: str | None = None,
+                  headers: dict | None = None):
         '''
         Send subscribe frame to server.
         :params:
         :topic: str - the destination of the topic
-        :ack: str - client acknowledge type, defaults to auto
+        :ack: str - client acknowledge type, auto, client or client-individual,
+            defaults to auto
+        :subscription_id: str - id for the subscription, defaults to the
+            id of an earlier subscription to the topic, else the client id
+            for the first subscription and client id-n after that
+        :headers: dict - extra SUBSCRIBE headers, i.e. an ActiveMQ selector,
+            which brokers without support ignore
+
+        Any number of subscriptions share the connection. Each
+        is kept and replayed on reconnect, including when there
+        is no connection to send it on yet.
 
         :returns:
         :bool: if successful return True
         '''
+        ack = ack.lower()
+        if ack not in ACK_MODES:
+            logger.error('unsupported ack mode %s', ack)
+            return False
+        if ack == 'auto':
+            logger.info('acknowledgment frames will not be sent for %s', topic)
+
+        subscription_id = subscription_id or self.subscription_id_for(topic)
+        logger.info('beginning subscription %s to %s', subscription_id, topic)
+        subscription = Subscription(subscription_id, topic, ack, headers)
+        self.subscriptions[subscription_id] = subscription
+
         if not self.connected_to_broker:
-            print('(error): cannot subscribe when no active cx')
-            return
+            logger.error('cannot subscribe when no active cx, will on reconnect')
+            return False
 
-        if ack.lower != 'auto':
-            self.send_acknowledgment_frame = False
-            print('(info): acknowledgment frames will not be sent')
+        self.send_bytes(subscription.frame)
+        return True
 
-        print('(info): beginning subscription')
+    def subscription_id_for(self, topic: str) -> str:
+        '''
+        Returns the id of an existing subscription to
+        the topic, or a new id for the client
+        '''
+        for subscription in self.subscriptions.values():
+            if subscription.topic == topic:
+                return subscription.subscription_id
+        if not self.subscriptions:
+            return self.cx_client_id
+        return f'{self.cx_client_id}-{len(self.subscriptions)}'
 
-        subscription_frame = Frame(
-            command='SUBSCRIBE',
-            headers = {
-                'id':self.cx_client_id,
-                'destination':topic,
-                'ack':ack
-            },
-            body=''
-        ).built_frame
-        self.cx_socket.send(subscription_frame)
-        self.topic_subscribed_to = topic
+    def subscription_for(self, frame: Frame):
+        '''
+        Returns the Subscription a MESSAGE frame was
+        delivered for, by its subscription header, or
+        the only subscription when the header is absent
+
+        :returns:
+        :Subscription | None:
+        '''
+        subscription = self.subscriptions.get(frame.get_header('subscription'))
+        if subscription is None and len(self.subscriptions) == 1:
+            for subscription in self.subscriptions.values():
+                return subscription
+        return subscription
+
+    def record_received(self, received: int) -> None:
+        '''
+        Counts the bytes just received and writes them
+        to the capture, if recording
+        '''
+        self.bytes_received += received
+        if self.capture:
+            decoder = self.frame_decoder
+            self.capture.write(decoder.buffer_view[decoder.end - received:decoder.end])
+
+    def heartbeat_poll_seconds(self):
+        '''
+        Returns how long a receive may block before heart-beats
+        need checking, None to block until data arrives
+        '''
+        periods = [period for period in (self.heartbeat_send_ms, self.heartbeat_receive_ms) if period]
+        if not periods:
+            return None
+        return min(periods) / 2000
+
+    def receive_timeout_seconds(self):
+        '''
+        Returns how long a receive may block before heart-beats,
+        held back ACKs or on_idle_callback need checking, the
+        heart-beat poll shortened to ack_every_ms while any ACK
+        is held back so a quiet feed still sends it on time, and
+        to idle_poll_ms if set. None to block until data arrives.
+        '''
+        periods = [self.heartbeat_poll_seconds()]
+        if self.frames_since_ack and self.ack_every_ms:
+            periods.append(self.ack_every_ms / 1000)
+        if self.idle_poll_ms:
+            periods.append(self.idle_poll_ms / 1000)
+        periods = [period for period in periods if period is not None]
+        return min(periods) if periods else None
+
+    def check_heartbeats(self) -> bool:
+        '''
+        Sends a heart-beat if nothing has been sent for the
+        negotiated period and checks the server has been heard
+        from within HEARTBEAT_GRACE of its period.
+
+        :returns:
+        :bool: False if the link is considered dead
+        '''
+        now = ticks_ms()
+        if self.heartbeat_send_ms and ticks_diff(now, self.last_sent_ticks) >= self.heartbeat_send_ms:
+            self.send_heartbeat()
+        if self.heartbeat_receive_ms:
+            if ticks_diff(now, self.last_received_ticks) > self.heartbeat_receive_ms * HEARTBEAT_GRACE:
+                logger.error('no heart-beat from server, connection is dead')
+                return False
+        return True
 
     def listen_for_messages(self):
         '''
-        Listens for messages and passes them to the callback function
+        Listens for messages and passes them to the callback function.
+        Returns once the connection is closed, fails or misses
+        heart-beats, leaving reconnection to the caller.
         '''
         if not self.connected_to_broker:
-            print('(error): cannot listen for messages when no active cx')
+            logger.error('cannot listen for messages when no active cx')
             return False
+        timeout = self.receive_timeout_seconds()
+        self.cx_socket.settimeout(timeout)
+        self.last_received_ticks = ticks_ms()
         while True:
+            if self.receive_timeout_seconds() != timeout:
+                timeout = self.receive_timeout_seconds()
+                self.cx_socket.settimeout(timeout)
             try:
-                received_message = self.cx_socket.recv(5120).decode("utf-8")
-                if received_message:
-                    self.on_message_callback(received_message)
+                received = self.frame_decoder.receive_from(self.cx_socket)
+                if not received:
+                    logger.error('connection closed by server')
+                    break
+                self.last_received_ticks = ticks_ms()
+                self.record_received(received)
+                for frame in self.frame_decoder.frames():
+                    self.frames_received += 1
+                    self.on_message_callback(frame)
+            except OSError as e:
+                if not is_socket_timeout(e):
+                    logger.error('exception when listening or receiving %s', e)
+                    break
             except Exception as e:
-                print('(error): exception when listening or receiving, backing off', e)
-                self.exponential_backoff_period *= 2
-                utime.sleep(self.exponential_backoff_period)
+                logger.error('exception when handling frame %s', e)
+            try:
+                if not self.check_heartbeats():
+                    break
+                self.flush_acks_if_due()
+            except OSError as e:
+                logger.error('exception when sending %s', e)
+                break
+            if self.on_idle_callback:
+                self.on_idle_callback()
+        self.connected_to_broker = False
+        return False
+
+    async def listen_for_messages_async(self):
+        '''
+        Event loop version of listen_for_messages. Receives
+        through a non-blocking stream and sends ACKs from
+        a separate task so neither blocks other tasks,
+        such as the web server, on the same loop.
+
+        Relies on uasyncio streams wrapping the socket
+        directly, so is only available on MicroPython.
+        '''
+        if not self.connected_to_broker:
+            logger.error('cannot listen for messages when no active cx')
+            return False
+
+        self.cx_socket.setblocking(False)
+        self.cx_stream = asyncio.StreamReader(self.cx_socket)
+        self.ack_queue = []
+        self.ack_event = asyncio.Event()
+        ack_task = asyncio.create_task(self.send_ack_frames_async())
+        poll_seconds = self.heartbeat_poll_seconds()
+        if self.idle_poll_ms:
+            idle_seconds = self.idle_poll_ms / 1000
+            poll_seconds = min(poll_seconds, idle_seconds) if poll_seconds else idle_seconds
+        self.last_received_ticks = ticks_ms()
+
+        try:
+            while True:
+                try:
+                    receive = self.cx_stream.readinto(self.frame_decoder.free_space())
+                    if poll_seconds:
+                        received = await asyncio.wait_for(receive, poll_seconds)
+                    else:
+                        received = await receive
+                    if not received:
+                        logger.error('connection closed by server')
+                        break
+                    self.last_received_ticks = ticks_ms()
+                    self.frame_decoder.commit(received)
+                    self.record_received(received)
+                    for frame in self.frame_decoder.frames():
+                        self.frames_received += 1
+                        self.on_message_callback(frame)
+                except asyncio.TimeoutError:
+                    pass
+                except OSError as e:
+                    logger.error('exception when listening or receiving %s', e)
+                    break
+                except Exception as e:
+                    logger.error('exception when handling frame %s', e)
+                if not self.check_heartbeats() or ack_task.done():
+                    break
+                if self.on_idle_callback:
+                    self.on_idle_callback()
+        finally:
+            ack_task.cancel()
+            self.ack_queue = None
+            self.ack_event = None
+            self.cx_stream = None
+            self.connected_to_broker = False
+        return False
+
+    async def send_ack_frames_async(self):
+        '''
+        Task that writes ACK frames queued by send_ack_frame
+        while listen_for_messages_async is running, and sends
+        any ACKs held back once ack_every_ms has passed.
+        '''
+        while True:
+            if self.ack_every_ms:
+                try:
+                    await asyncio.wait_for(self.ack_event.wait(), self.ack_every_ms / 1000)
+                except asyncio.TimeoutError:
+                    self.flush_acks_if_due()
+            else:
+                await self.ack_event.wait()
+            self.ack_event.clear()
+            while self.ack_queue:
+                self.cx_stream.write(self.ack_queue.pop(0))
+                await self.cx_stream.drain()
+                self.last_sent_ticks = ticks_ms()
+
+    def acknowledge(self, frame: Frame) -> bool:
+        '''
+        Records a received MESSAGE frame for acknowledgment
+        and sends ACKs once ack_every_frames or ack_every_ms
+        is reached. In client mode ACKs are cumulative so only
+        the latest message is acknowledged, in client-individual
+        mode every message is, in auto mode none are.
+
+        :returns:
+        :bool: True if ACKs were sent
+        '''
+        if frame.command != 'MESSAGE':
+            return False
+        subscription = self.subscription_for(frame)
+        if subscription is None or subscription.ack_mode == 'auto':
+            return False
+
+        # STOMP 1.2 acknowledges the ack header, earlier versions the message-id
+        ack_id = frame.get_header('ack') or frame.get_header('message-id')
+        if ack_id is None:
+            return False
+
+        if subscription.ack_mode == 'client':
+            subscription.pending_ack_ids.clear()
+        subscription.pending_ack_ids.append(ack_id)
+        self.frames_since_ack += 1
+        return self.flush_acks_if_due()
+
+    def flush_acks_if_due(self) -> bool:
+        '''
+        Sends held back ACKs if either ACK threshold is reached
+
+        :returns:
+        :bool: True if ACKs were sent
+        '''
+        if not self.frames_since_ack:
+            return False
+        if self.frames_since_ack < self.ack_every_frames:
+            if not self.ack_every_ms:
+                return False
+            if ticks_diff(ticks_ms(), self.last_ack_ticks) < self.ack_every_ms:
+                return False
+        return self.flush_acks()
+
+    def flush_acks(self) -> bool:
+        '''
+        Sends every held back ACK of every subscription,
+        spliced into the outbound buffer and written together
+
+        :returns:
+        :bool: True if ACKs were sent
+        '''
+        if not self.frames_since_ack:
+            return False
+        sent = True
+        length = 0
+        ack_count = 0
+        for subscription in self.subscriptions.values():
+            prefix = subscription.ack_frame_prefix
+            for ack_id in subscription.pending_ack_ids:
+                end = self.write_ack_frame(ack_id, length, prefix)
+                if end < 0 and length:
+                    sent = self.send_ack_bytes(self.outbound_view[:length]) and sent
+                    length = 0
+                    end = self.write_ack_frame(ack_id, length, prefix)
+                if end < 0:
+                    sent = self.send_ack_bytes(self.build_ack_frame(ack_id, prefix)) and sent
+                    continue
+                length = end
+            ack_count += len(subscription.pending_ack_ids)
+            subscription.pending_ack_ids.clear()
+        if length:
+            sent = self.send_ack_bytes(self.outbound_view[:length]) and sent
+        if sent:
+            self.acks_sent += ack_count
+        self.frames_since_ack = 0
+        self.last_ack_ticks = ticks_ms()
+        return sent
+
+    def write_ack_frame(self, transaction_id: str, position: int = 0,
+                        prefix: bytes | None = None) -> int:
+        '''
+        Splices an ACK frame for the given ack id into the
+        outbound buffer from the cached template
+
+        :params:
+        :prefix: bytes - the subscription's ACK prefix, defaults
+            to that of the client id
+
+        :returns:
+        :int: end of the frame in the buffer, -1 if it does not fit
+        '''
+        prefix = prefix or self.ack_frame_prefix
+        ack_id = escape_header_value(transaction_id).encode("utf-8")
+        prefix_end = position + len(prefix)
+        id_end = prefix_end + len(ack_id)
+        end = id_end + len(ACK_FRAME_SUFFIX)
+        if end > len(self.outbound_buffer):
+            return -1
+        self.outbound_buffer[position:prefix_end] = prefix
+        self.outbound_buffer[prefix_end:id_end] = ack_id
+        self.outbound_buffer[id_end:end] = ACK_FRAME_SUFFIX
+        return end
+
+    def build_ack_frame(self, transaction_id: str, prefix: bytes | None = None) -> bytes:
+        '''
+        Returns an encoded ACK frame for the given ack id
+        '''
+        return ((prefix or self.ack_frame_prefix)
+                + escape_header_value(transaction_id).encode("utf-8") + ACK_FRAME_SUFFIX)
+
+    def send_ack_bytes(self, ack_frames) -> bool:
+        '''
+        Sends encoded ACK frames, through the ACK task
+        when listening on the event loop
+        '''
+        if not self.connected_to_broker:
+            logger.error('cannot send acknowledgment without connection.')
+            return False
+
+        if self.ack_queue is not None:
+            # the outbound buffer is reused before the task writes
+            self.ack_queue.append(bytes(ack_frames))
+            self.ack_event.set()
+            return True
+        self.send_bytes(ack_frames)
+        return True
 
     def send_ack_frame(self, transaction_id: str):
         '''
@@ -272,19 +1377,172 @@ class MicroSTOMPClient:
         This is necessary to provide a level of activity to the server
         that will prevent it from closing the connection to the client.
         '''
+        end = self.write_ack_frame(transaction_id)
+        if end < 0:
+            sent = self.send_ack_bytes(self.build_ack_frame(transaction_id))
+        else:
+            sent = self.send_ack_bytes(self.outbound_view[:end])
+        if sent:
+            self.acks_sent += 1
+        return sent
+
+    def send_heartbeat(self) -> bool:
+        '''
+        Sends a STOMP heart-beat, a single EOL
+        '''
         if not self.connected_to_broker:
-            print('(error): cannot send acknowledgment without connection.')
             return False
-
-        ack_frame = Frame(
-            command = 'ACK',
-            headers = {
-                'subscription': self.cx_client_id,
-                'id' : transaction_id,
-                'transaction' : transaction_id
-            },
-            body = ''
-        ).built_frame
-        #print('(info): sending acknlowedgments')
-        self.cx_socket.send(ack_frame)
+        if self.ack_queue is not None:
+            self.ack_queue.append(HEARTBEAT_FRAME)
+            self.ack_event.set()
+            return True
+        self.send_bytes(HEARTBEAT_FRAME)
         return True
+
+    def send_bytes(self, data) -> int:
+        '''
+        Sends all of data on the connection, noting the
+        time for the heart-beat check
+
+        :returns:
+        :int: number of bytes sent
+        '''
+        sent = send_all(self.cx_socket, data)
+        self.last_sent_ticks = ticks_ms()
+        return sent
+
+class ConnectionSupervisor:
+    '''
+    Keeps a MicroSTOMPClient connected, reconnecting with
+    capped, jittered exponential backoff and replaying its
+    subscription whenever the link fails or goes silent.
+    '''
+    def __init__(self,
+                 client: MicroSTOMPClient,
+                 backoff_base_ms: int = 1000,
+                 backoff_max_ms: int = 60000
+                ):
+        '''
+        :params:
+        :client: MicroSTOMPClient - the client to supervise
+        :backoff_base_ms: int - delay before the first retry
+        :backoff_max_ms: int - the most the delay grows to
+        '''
+        self.client = client
+        self.backoff_base_ms = backoff_base_ms
+        self.backoff_max_ms = backoff_max_ms
+        self.failed_attempts = 0
+        self.reconnect_count = 0
+        self.disconnected_ms = 0
+        self.disconnected_since = None
+
+    def backoff_ms(self) -> int:
+        '''
+        Returns the delay before the next attempt, between half
+        and all of the capped exponential period so many
+        appliances do not retry in step with each other.
+        '''
+        ceiling = min(self.backoff_max_ms, self.backoff_base_ms << min(self.failed_attempts, 16))
+        half = ceiling // 2
+        return half + (random.getrandbits(16) * (ceiling - half) >> 16)
+
+    def mark_disconnected(self) -> None:
+        '''
+        Starts timing a disconnection, if not already
+        '''
+        if self.disconnected_since is None:
+            self.disconnected_since = ticks_ms()
+
+    def mark_connected(self) -> None:
+        '''
+        Adds the disconnection that just ended to the total
+        '''
+        if self.disconnected_since is not None:
+            self.disconnected_ms += ticks_diff(ticks_ms(), self.disconnected_since)
+            self.disconnected_since = None
+
+    def attempt_reconnect(self) -> bool:
+        '''
+        Makes a single reconnection attempt
+
+        :returns:
+        :bool: True if connected
+        '''
+        try:
+            connected = self.client.reconnect()
+        except Exception as e:
+            logger.error('reconnection failed %s', e)
+            connected = False
+        return self.record_attempt(connected)
+
+    def record_attempt(self, connected: bool) -> bool:
+        '''
+        Counts a reconnection attempt and its outcome
+
+        :returns:
+        :bool: connected, as passed in
+        '''
+        if connected:
+            self.failed_attempts = 0
+            self.reconnect_count += 1
+            self.mark_connected()
+        else:
+            self.failed_attempts += 1
+        return connected
+
+    def stats(self) -> dict:
+        '''
+        Returns reconnection statistics, the time disconnected
+        includes any disconnection still in progress
+        '''
+        disconnected_ms = self.disconnected_ms
+        if self.disconnected_since is not None:
+            disconnected_ms += ticks_diff(ticks_ms(), self.disconnected_since)
+        return {
+            'connected': self.client.connected_to_broker,
+            'reconnect_count': self.reconnect_count,
+            'disconnected_ms': disconnected_ms
+        }
+
+    def run(self):
+        '''
+        Listens for messages forever, reconnecting whenever
+        the client stops listening
+        '''
+        while True:
+            if self.client.connected_to_broker:
+                self.client.listen_for_messages()
+            self.mark_disconnected()
+            while not self.attempt_reconnect():
+                delay = self.backoff_ms()
+                logger.info('retrying connection in %s ms', delay)
+                sleep_ms(delay)
+
+    async def attempt_reconnect_async(self) -> bool:
+        '''
+        Event loop version of attempt_reconnect, connecting
+        without blocking so other tasks keep running meanwhile
+
+        :returns:
+        :bool: True if connected
+        '''
+        try:
+            connected = await self.client.reconnect_async()
+        except Exception as e:
+            logger.error('reconnection failed %s', e)
+            connected = False
+        return self.record_attempt(connected)
+
+    async def run_async(self):
+        '''
+        Event loop version of run, reconnecting and waiting
+        out the backoff without blocking other tasks
+        '''
+        while True:
+            if self.client.connected_to_broker:
+                await self.client.listen_for_messages_async()
+            self.mark_disconnected()
+            while not await self.attempt_reconnect_async():
+                delay = self.backoff_ms()
+                logger.info('retrying connection in %s ms', delay)
+                await asyncio.sleep(delay / 1000)
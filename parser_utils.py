@@ -3,9 +3,25 @@ Contains code to simplify the parsing
 and handling of any dignal data 
 that is received.
 '''
+import logger
+import metrics
+
 import os
 import json
 
+# element position 0 is the most significant bit of the SF data byte,
+# matching the order the elements have always been driven in
+ELEMENT_BIT_MASKS = tuple(1 << (7 - position) for position in range(8))
+ELEMENT_STATE_TABLE = tuple(
+    tuple(1 if byte & mask else 0 for mask in ELEMENT_BIT_MASKS)
+    for byte in range(256)
+)
+BIT_COUNTS = bytes(bin(byte).count('1') for byte in range(256))
+
+MESSAGE_SCAN_WINDOW = 1024
+# ends the key of every TD message, {"XX_MSG":{...}}, counted as the body is scanned
+TD_MESSAGE_KEY_END = b'_MSG"'
+
 def signal_data_parser(data_passed: str) -> str:
     '''
     Parses a hexadecimal byte into
@@ -81,6 +97,169 @@ def message_filtering_pass(message: dict,
 
     return True
 
+def build_routing_table(area_container: dict) -> dict:
+    '''
+    Flattens the area container into a single
+    lookup so each message costs one dict lookup
+    however many areas and blocks are configured.
+
+    Keys are upper-cased as the feed sends area
+    codes and addresses in upper case.
+
+    :Arguments:
+    :dict area_container: {area_id: {address: SignalBlock}}
+
+    :Returns:
+    :dict: {(area_id, address): SignalBlock}
+    '''
+    routing_table = {}
+    for area_id, block_map in area_container.items():
+        for address, block in block_map.items():
+            routing_table[(str(area_id).upper(), str(address).upper())] = block
+    return routing_table
+
+def route_message(message: dict,
+                  routing_table: dict,
+                  message_type: str = 'SF_MSG'):
+    '''
+    Finds the block a message is addressed to.
+
+    :Arguments:
+    :dict message: dictionary of individual message from STOMP aggregated message
+    :dict routing_table: as returned by build_routing_table
+    :str message_type: the message class to accept, i.e. SF_MSG
+
+    :Returns:
+    :SignalBlock | None: the block to update or None if not routed
+    '''
+    typed_message = message.get(message_type)
+    if typed_message is None:
+        return None
+    return routing_table.get((typed_message.get('area_id'), typed_message.get('address')))
+
+def _quoted_value_after(element: bytes, key: bytes, start: int = 0, end: int | None = None):
+    '''
+    Returns the string value following a JSON key in an
+    element without decoding it, or None if absent. start
+    and end bound the element within a larger buffer.
+    '''
+    if end is None:
+        end = len(element)
+    key_index = element.find(key, start, end)
+    if key_index < 0:
+        return None
+    value_start = element.find(b'"', key_index + len(key), end) + 1
+    if not value_start:
+        return None
+    value_end = element.find(b'"', value_start, end)
+    if value_end < 0:
+        return None
+    return element[value_start:value_end]
+
+def iter_filtered_messages(body,
+                           area_ids: set,
+                           message_type: str = 'SF_MSG',
+                           window_size: int = MESSAGE_SCAN_WINDOW):
+    '''
+    Generator that scans a raw TD batch body for messages
+    of the given type in the given areas and decodes only
+    those, one at a time.
+
+    The body is copied a window at a time and every element
+    in a window is scanned in place, so each byte is copied
+    about once and peak memory scales with the window rather
+    than the batch. Only kept messages are copied out again.
+    TD messages are a single level {"XX_MSG":{...}} object
+    with string values, which is what the scan relies on.
+
+    :Arguments:
+    :body: bytes, bytearray or memoryview of the JSON array
+    :set area_ids: area codes to keep, as upper-case bytes i.e. b'Y2'
+    :str message_type: the message class to keep, i.e. SF_MSG
+    :int window_size: bytes copied out of the body at a time
+
+    :Yields:
+    :dict: each matching message as json.loads would return it
+    '''
+    body = memoryview(body)
+    body_size = len(body)
+    marker = b'"' + message_type.encode('utf-8') + b'"'
+    span = window_size
+    window_start = 0
+    window = bytes(body[:span])
+    offset = 0
+
+    while True:
+        at_end = window_start + len(window) >= body_size
+        marker_index = window.find(marker, offset)
+        keep = -1
+
+        if marker_index < 0:
+            if at_end:
+                metrics.messages_received += window.count(TD_MESSAGE_KEY_END, offset)
+                break
+            # an element straddling the window starts at the last brace
+            keep = window.rfind(b'{', offset)
+            if keep < 0:
+                keep = len(window)
+        else:
+            element_start = window.rfind(b'{', offset, marker_index)
+            if element_start < 0:
+                metrics.messages_received += window.count(TD_MESSAGE_KEY_END, offset,
+                                                          marker_index + len(marker))
+                offset = marker_index + len(marker)
+                continue
+            inner_end = window.find(b'}', marker_index)
+            element_end = window.find(b'}', inner_end + 1) if inner_end >= 0 else -1
+            if element_end < 0:
+                if at_end:
+                    metrics.messages_received += window.count(TD_MESSAGE_KEY_END, offset)
+                    logger.warn('truncated message at end of body')
+                    break
+                keep = element_start
+
+        if keep >= 0:
+            metrics.messages_received += window.count(TD_MESSAGE_KEY_END, offset, keep)
+            if keep:
+                span = window_size
+            else:
+                # a single element is larger than the window
+                span *= 2
+            window_start += keep
+            window = bytes(body[window_start:window_start + span])
+            offset = 0
+            continue
+
+        metrics.messages_received += window.count(TD_MESSAGE_KEY_END, offset, element_end + 1)
+        offset = element_end + 1
+        area_id = _quoted_value_after(window, b'"area_id"', element_start, offset)
+        if area_id is None or area_id.upper() not in area_ids:
+            metrics.messages_filtered += 1
+            continue
+        element = window[element_start:offset]
+        try:
+            yield json.loads(element)
+        except ValueError:
+            logger.warn('could not decode message %s', element)
+
+def normalise_light_configurations(light_configurations: list) -> list:
+    '''
+    Returns an address's light configurations with only
+    the keys a signal block is built from and the platform
+    as a string, as a compiled configuration holds them,
+    so configurations compare equal however they were loaded
+
+    :Arguments:
+    :list light_configurations: validated light configurations of one address
+
+    :Returns:
+    :list: of dicts with platform, element_position, green_pin and red_pin
+    '''
+    return [{'platform': str(light['platform']),
+             'element_position': light['element_position'],
+             'green_pin': light['green_pin'],
+             'red_pin': light['red_pin']} for light in light_configurations]
+
 def read_configuration_file(file_location: str) -> dict:
     '''
     read configuration file
@@ -96,13 +275,37 @@ def read_configuration_file(file_location: str) -> dict:
         print(f'critical: cannot find file at {file_location}')
         return {}
 
+    return parse_configuration(raw_file)
+
+def parse_configuration(raw_configuration) -> dict:
+    '''
+    parse and validate a configuration, as read
+    from the file or uploaded to the web server
+
+    args:
+        raw_configuration: str or bytes: the JSON document
+    returns:
+        dict: of configuration if valid else empty
+    '''
     try:
-        config_file = json.loads(raw_file)
+        config_file = json.loads(raw_configuration)
         config_file = dict(config_file)
     except Exception as e:
         print('critical: cannot parse the config file into json', e)
         return {}
 
+    return validate_configuration(config_file)
+
+def validate_configuration(config_file: dict) -> dict:
+    '''
+    check a configuration has areas of addresses
+    each holding a list of light configurations
+
+    args:
+        config_file: dict: decoded configuration
+    returns:
+        dict: of configuration if valid else empty
+    '''
     top_level_keys = config_file.keys()
 
     if not top_level_keys:
@@ -126,6 +329,10 @@ def read_configuration_file(file_location: str) -> dict:
                       address {address_key} is not a list''')
                 return {}
 
+            required_light_keys = ['platform', 'element_position',\
+                                   'green_pin',\
+                                   'red_pin']
+
             for light_configuration in address_value:
                 if not isinstance(light_configuration, dict):
                     print(f'''critical: cannot parse config, address
@@ -133,13 +340,21 @@ def read_configuration_file(file_location: str) -> dict:
                           configuration''')
                     return {}
 
-            required_light_keys = ['platform', 'element_position',\
-                                   'green_pin',\
-                                   'red_pin']
+                if not all(rk in light_configuration for rk in required_light_keys):
+                    print(f'''critical: required light configuration is missing
+                             keys, {light_configuration}''')
+                    return {}
 
-            if not all(rk in light_configuration for rk in required_light_keys):
-                print(f'''critical: required light configuration is missing
-                         keys, {light_configuration}''')
-                return {}
+                for integer_key in ('element_position', 'green_pin', 'red_pin'):
+                    value = light_configuration[integer_key]
+                    if not isinstance(value, int) or isinstance(value, bool):
+                        print(f'''critical: cannot parse config, {integer_key} of
+                              address {address_key} is not an integer''')
+                        return {}
+
+                if not 0 <= light_configuration['element_position'] <= 7:
+                    print(f'''critical: cannot parse config, element_position of
+                          address {address_key} is not between 0 and 7''')
+                    return {}
 
-    return config_file
\ No newline at end of file
+    return config_file
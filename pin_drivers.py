@@ -0,0 +1,315 @@
+'''
+Pin Drivers put the LED outputs behind one interface,
+so signal blocks can drive GPIO pins directly, through
+a port register, or through 74HC595 shift registers or
+I2C expanders when the board runs out of pins.
+
+A driver hands out a handle for each pin id, signal
+blocks set handles and the driver pushes every pending
+change in one bulk write on flush. Signal blocks flush
+once per block update, or once per pin transaction so
+a whole frame, every area it touches, is one write.
+
+    setup(pin_id, value) -> handle
+    set(handle, value)
+    flush() -> int: bus writes made
+
+The driver in use is pin_drivers.driver, chosen with
+set_driver before any block is built, as blocks keep
+the handles of the driver that set them up.
+'''
+try:
+    import machine
+except ImportError:
+    machine = None
+
+#GPIO_OUT_SET and GPIO_OUT_CLR of the RP2040 SIO block
+RP2040_SET_REGISTER = 0xD0000014
+RP2040_CLEAR_REGISTER = 0xD0000018
+#GPIO_OUT_W1TS and GPIO_OUT_W1TC of the ESP32, pins 0-31
+ESP32_SET_REGISTER = 0x3FF44008
+ESP32_CLEAR_REGISTER = 0x3FF4400C
+#IODIRA and OLATA of an MCP23017 in its default bank mode
+MCP23017_DIRECTION_REGISTER = 0x00
+MCP23017_OUTPUT_REGISTER = 0x14
+
+class GPIODriver:
+    '''
+    Drives each pin with its own machine.Pin,
+    every set is a write of its own
+    '''
+    def __init__(self):
+        self.write_count = 0
+
+    def setup(self, pin_id, value: int):
+        '''
+        Returns an output machine.Pin showing value
+        '''
+        self.write_count += 1
+        return machine.Pin(pin_id, machine.Pin.OUT, value=value)
+
+    def set(self, handle, value: int) -> None:
+        '''
+        Writes the pin now
+        '''
+        handle.value(value)
+        self.write_count += 1
+
+    def flush(self) -> int:
+        '''
+        Nothing is held back
+        '''
+        return 0
+
+class PortDriver:
+    '''
+    Drives pins 0-31 of one GPIO port through its set
+    and clear registers, every pin changed since the
+    last flush is written in one masked write of each
+    '''
+    def __init__(self, set_register: int = RP2040_SET_REGISTER,
+                 clear_register: int = RP2040_CLEAR_REGISTER):
+        '''
+        args:
+            set_register: int: address where a 1 bit drives its pin high
+            clear_register: int: address where a 1 bit drives its pin low
+        '''
+        self.set_register = set_register
+        self.clear_register = clear_register
+        self.set_mask = 0
+        self.clear_mask = 0
+        self.write_count = 0
+
+    def setup(self, pin_id: int, value: int) -> int:
+        '''
+        Makes the pin an output showing value
+
+        returns:
+            int: the pin's bit in the port registers
+        '''
+        if not 0 <= pin_id < 32:
+            raise ValueError('pin is not on the port', pin_id)
+        machine.Pin(pin_id, machine.Pin.OUT, value=value)
+        self.write_count += 1
+        return 1 << pin_id
+
+    def set(self, handle: int, value: int) -> None:
+        '''
+        Holds the pin's new value until flush
+        '''
+        if value:
+            self.set_mask |= handle
+            self.clear_mask &= ~handle
+        else:
+            self.clear_mask |= handle
+            self.set_mask &= ~handle
+
+    def flush(self) -> int:
+        '''
+        Writes the held pins in one write per register
+        '''
+        writes = 0
+        if self.set_mask:
+            machine.mem32[self.set_register] = self.set_mask
+            self.set_mask = 0
+            writes += 1
+        if self.clear_mask:
+            machine.mem32[self.clear_register] = self.clear_mask
+            self.clear_mask = 0
+            writes += 1
+        self.write_count += writes
+        return writes
+
+class BufferedDriver:
+    '''
+    Holds the output of every pin of a chain of 8 bit
+    ports in a bytearray, pin id n is bit n % 8 of port
+    n // 8, and writes the whole chain on flush when
+    any pin has changed
+    '''
+    def __init__(self, port_count: int, write_ports):
+        '''
+        args:
+            port_count: int: 8 bit ports in the chain
+            write_ports: function(state): sends the bytearray
+                of every port's outputs to the hardware
+        '''
+        self.state = bytearray(port_count)
+        self.write_ports = write_ports
+        self.dirty = False
+        self.write_count = 0
+
+    def setup(self, pin_id: int, value: int) -> int:
+        '''
+        Returns the pin id once checked against the chain
+        '''
+        if not 0 <= pin_id < 8 * len(self.state):
+            raise ValueError('pin is beyond the last port', pin_id)
+        self.set(pin_id, value)
+        # the outputs hold whatever they powered up with until written
+        self.dirty = True
+        return pin_id
+
+    def set(self, handle: int, value: int) -> None:
+        '''
+        Holds the pin's new value until flush
+        '''
+        port, bit = handle >> 3, 1 << (handle & 7)
+        current = self.state[port]
+        new = current | bit if value else current & ~bit
+        if new != current:
+            self.state[port] = new
+            self.dirty = True
+
+    def flush(self) -> int:
+        '''
+        Writes the chain if any pin has changed
+        '''
+        if not self.dirty:
+            return 0
+        self.dirty = False
+        self.write_count += 1
+        self.write_ports(self.state)
+        return 1
+
+class ShiftRegisterDriver(BufferedDriver):
+    '''
+    Drives a chain of 74HC595 shift registers over SPI,
+    pin ids 0-7 are the outputs of the register nearest
+    the board
+    '''
+    def __init__(self, spi, latch_pin, register_count: int = 1):
+        '''
+        args:
+            spi: machine.SPI: wired to SER and SRCLK of the chain
+            latch_pin: machine.Pin: wired to RCLK of every register
+            register_count: int: registers in the chain
+        '''
+        super().__init__(register_count, self.shift_out)
+        self.spi = spi
+        self.latch_pin = latch_pin
+        self.latch_pin.value(0)
+        # shifted out last register first so each byte lands in its register
+        self.shift_order = bytearray(register_count)
+
+    def shift_out(self, state: bytearray) -> None:
+        '''
+        Shifts the chain out and latches it
+        '''
+        count = len(state)
+        for index in range(count):
+            self.shift_order[index] = state[count - 1 - index]
+        self.spi.write(self.shift_order)
+        self.latch_pin.value(1)
+        self.latch_pin.value(0)
+
+class I2CExpanderDriver(BufferedDriver):
+    '''
+    Drives the ports of an I2C expander, an MCP23017 by
+    default, or a PCF8574/PCF8575 with output_register None
+    '''
+    def __init__(self, i2c, address: int = 0x20, port_count: int = 2,
+                 output_register=MCP23017_OUTPUT_REGISTER,
+                 direction_register=MCP23017_DIRECTION_REGISTER):
+        '''
+        args:
+            i2c: machine.I2C: bus the expander is on
+            address: int: expander address
+            port_count: int: 8 bit ports, 2 for an MCP23017 or PCF8575
+            output_register: int: first output latch register, None to
+                write the ports as bare bytes as the PCF857x expects
+            direction_register: int: first direction register, set to
+                all outputs, None if the expander has none
+        '''
+        super().__init__(port_count, self.write_registers)
+        self.i2c = i2c
+        self.address = address
+        self.output_register = output_register
+        if direction_register is not None:
+            self.i2c.writeto_mem(address, direction_register, bytes(port_count))
+
+    def write_registers(self, state: bytearray) -> None:
+        '''
+        Writes every port in one transaction
+        '''
+        if self.output_register is None:
+            self.i2c.writeto(self.address, state)
+        else:
+            self.i2c.writeto_mem(self.address, self.output_register, state)
+
+class FakeDriver:
+    '''
+    Records pin values without hardware, for Linux,
+    counting pin sets and the bulk writes they became
+    '''
+    def __init__(self):
+        #pin id: value
+        self.values = {}
+        self.pending = False
+        #pins set, each a write of its own under GPIODriver
+        self.pin_writes = 0
+        #flushes with changes, each a write of its own under the bulk drivers
+        self.write_count = 0
+
+    def setup(self, pin_id, value: int):
+        '''
+        Returns the pin id as its handle
+        '''
+        self.set(pin_id, value)
+        return pin_id
+
+    def set(self, handle, value: int) -> None:
+        '''
+        Records the pin's new value
+        '''
+        self.values[handle] = value
+        self.pin_writes += 1
+        self.pending = True
+
+    def flush(self) -> int:
+        '''
+        Counts a bulk write if any pin was set
+        '''
+        if not self.pending:
+            return 0
+        self.pending = False
+        self.write_count += 1
+        return 1
+
+def build_driver(name: str = 'gpio', options: dict | None = None):
+    '''
+    Builds a driver from the PIN_DRIVER settings
+
+    args:
+        name: str: gpio, port, shift_register, i2c or fake
+        options: optional dict: for port set_register and
+            clear_register, for shift_register spi_id, baudrate,
+            latch_pin and register_count, for i2c i2c_id, address,
+            port_count, output_register and direction_register
+    returns:
+        a driver, None if the name is not known
+    '''
+    options = dict(options or {})
+    if name == 'gpio':
+        return GPIODriver()
+    if name == 'port':
+        return PortDriver(**options)
+    if name == 'shift_register':
+        spi = machine.SPI(options.pop('spi_id', 1), baudrate=options.pop('baudrate', 1000000))
+        latch_pin = machine.Pin(options.pop('latch_pin'), machine.Pin.OUT)
+        return ShiftRegisterDriver(spi, latch_pin, **options)
+    if name == 'i2c':
+        return I2CExpanderDriver(machine.I2C(options.pop('i2c_id', 0)), **options)
+    if name == 'fake':
+        return FakeDriver()
+    return None
+
+driver = GPIODriver() if hasattr(machine, 'Pin') else FakeDriver()
+
+def set_driver(new_driver) -> None:
+    '''
+    Drives pins through new_driver from now on,
+    call before any block is built
+    '''
+    global driver
+    driver = new_driver
@@ -0,0 +1,110 @@
+'''
+Replays a capture recorded by MicroSTOMPClient
+through the same parse, filter and update path
+as the live feed, to measure end to end throughput
+without a broker.
+
+Usage:
+    micropython replay.py <capture file> [speed] [config file]
+
+speed is a multiple of real time, 1 replays as
+recorded, 10 ten times faster and 0 as fast as
+possible, which is the default.
+'''
+from microstomp import (FrameDecoder, ticks_ms, ticks_diff, sleep_ms,
+                        CAPTURE_MAGIC, CAPTURE_RECORD, CAPTURE_RECORD_SIZE)
+
+import logger
+
+import struct
+import sys
+
+def iter_capture(file_location: str):
+    '''
+    Generator yielding each chunk of a capture file
+
+    args:
+        file_location: str: capture file recorded by MicroSTOMPClient
+    yields:
+        tuple: (ms since the capture started, bytes received)
+    '''
+    offset_ms = 0
+    with open(file_location, 'rb') as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('not a desk-signaller capture file', file_location)
+        while True:
+            record_header = capture_file.read(CAPTURE_RECORD_SIZE)
+            if len(record_header) < CAPTURE_RECORD_SIZE:
+                return
+            interval_ms, length = struct.unpack(CAPTURE_RECORD, record_header)
+            offset_ms += interval_ms
+            chunk = capture_file.read(length)
+            if len(chunk) < length:
+                logger.warn('capture ends part way through a chunk')
+                return
+            yield offset_ms, chunk
+
+def replay(file_location: str, on_frame, speed: float = 0) -> dict:
+    '''
+    Feeds a capture through a frame decoder, passing
+    each complete frame to on_frame as the receive
+    loop would, paced by the recorded arrival times.
+
+    args:
+        file_location: str: capture file recorded by MicroSTOMPClient
+        on_frame: function: called with each frame, returning the
+            number of messages it applied
+        speed: float: multiple of real time, 0 for as fast as possible
+    returns:
+        dict: frames, messages, bytes, elapsed_ms and per second rates
+    '''
+    decoder = FrameDecoder()
+    frames = messages = received_bytes = 0
+    started_ticks = ticks_ms()
+
+    for offset_ms, chunk in iter_capture(file_location):
+        if speed:
+            wait_ms = int(offset_ms / speed) - ticks_diff(ticks_ms(), started_ticks)
+            if wait_ms > 0:
+                sleep_ms(wait_ms)
+        received_bytes += len(chunk)
+        for frame in decoder.decode(chunk):
+            frames += 1
+            messages += on_frame(frame) or 0
+
+    elapsed_ms = max(1, ticks_diff(ticks_ms(), started_ticks))
+    return {
+        'frames': frames,
+        'messages': messages,
+        'bytes': received_bytes,
+        'elapsed_ms': elapsed_ms,
+        'frames_per_second': frames * 1000 / elapsed_ms,
+        'messages_per_second': messages * 1000 / elapsed_ms
+    }
+
+def main(arguments: list) -> dict:
+    '''
+    Loads the configuration and replays a capture
+    through signal_feed.handle_frame
+    '''
+    import parser_utils
+    import signal_feed
+
+    if not arguments:
+        print(__doc__)
+        return {}
+    speed = float(arguments[1]) if len(arguments) > 1 else 0
+    configuration = parser_utils.read_configuration_file(
+        arguments[2] if len(arguments) > 2 else './config.json')
+    if not configuration:
+        print('(critical): configuration is empty')
+        return {}
+    signal_feed.load_configuration(configuration)
+
+    results = replay(arguments[0], signal_feed.handle_frame, speed)
+    for name, value in results.items():
+        print(f'{name}: {value}')
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -19,7 +19,8 @@ Class Properties:
     count_elements_in_block: value between 1-8 inclusive,
     current_bit_status_hex: the last hex status received,
     last_updated: the datetime that the last message was received
-    signal_element_container: list containing signal element objects
+    state_byte: element states packed as the SF data byte,
+    pins: green and red pin of each element position
 
 Functionality:
     Signal Block is a an abstract structure and acts
@@ -40,8 +41,11 @@ Architectural Questions:
     > Can a hex status contain less than 8 bits?
 
 '''
-import machine
-from signal_element import SignalElement
+import common
+import journal
+import pin_drivers
+from signal_element import SignalElement, hold_pin_write
+from parser_utils import ELEMENT_BIT_MASKS, ELEMENT_STATE_TABLE, BIT_COUNTS
 
 class SignalBlock:
     '''
@@ -50,7 +54,17 @@ class SignalBlock:
     represent Signal Elements that
     control the state of the LED
     pins associated with them
+
+    Element states are packed into bytes laid out
+    as the SF data byte, with the green and red
+    pin of each position in one list, so a block
+    costs a few words of heap rather than an
+    object per element.
     '''
+    __slots__ = ('signal_block_address', 'number_elements_in_block', 'configured_mask',
+                 'state_byte', 'pin_byte', 'pins', 'initialised_pins', 'last_byte',
+                 'changed_version', 'element_changes')
+
     def __init__(self,
                  signal_block_address: str,
                  number_elements_in_block: int = 8,
@@ -70,76 +84,258 @@ class SignalBlock:
         '''
         self.signal_block_address = signal_block_address
         self.number_elements_in_block = number_elements_in_block
-        #sort of a bit dirty but allows for positional access to signals
-        self.signal_elements_container = [None for x in range(0,8)]
+        #a bit is set for each configured element position
+        self.configured_mask = 0
+        #element states, and the states currently shown by the pins
+        self.state_byte = 0
+        self.pin_byte = 0
+        #green and red pin of each position, position 0 first, pin ids
+        #until initialise_pins replaces them with pin driver handles
+        self.pins = [None] * 16
+        #a bit is set for each entry of pins that is a driver handle
+        self.initialised_pins = 0
+        #None until the first update so every element is written once
+        self.last_byte = None
+        #common.state_version at the last change of an element
+        self.changed_version = 0
+        #element state changes applied, read by metrics.py
+        self.element_changes = 0
 
     def modify_signal_in_block(self,
                                signal_position: int,
                                signal_platform: str,
-                               signal_green_pin: machine.Pin,
-                               signal_red_pin: machine.Pin,
-                               signal_state: int = 0
+                               signal_green_pin: int,
+                               signal_red_pin: int,
+                               signal_state: int = 0,
+                               initialise_pins: bool = True
                               ) -> int:
         '''
         Called to create or modify a signal at the given position
         in the signal element block.
 
         Position argument must be between 0-7 which represent the 8
-        bits in the byte.
+        bits in the byte. The platform is kept in the configuration
+        rather than the block.
 
         args:
             signal_position: int: the position of the signal from 0-7
             signal_platform: str: the platform that element represents
             signal_state: optional int: default 0, can be 1
+            initialise_pins: optional bool: False only records the pin
+                numbers, for initialise_pins to set up in bulk later
 
         returns:
-            int: number of signal element objects in the block
+            int: 0 represents success, 1 if the position is invalid
 
         '''
         if signal_position > 7:
             return 1
 
-        self.signal_elements_container[signal_position] = SignalElement(\
-                                                                        signal_state,
-                                                                        signal_platform,
-                                                                        machine.Pin(signal_green_pin, machine.Pin.OUT),
-                                                                        machine.Pin(signal_red_pin, machine.Pin.OUT)
-                                                                       )
+        mask = ELEMENT_BIT_MASKS[signal_position]
+        self.pins[2 * signal_position] = signal_green_pin
+        self.pins[2 * signal_position + 1] = signal_red_pin
+        self.initialised_pins &= ~(3 << (2 * signal_position))
+        if initialise_pins:
+            self.initialise_pins()
+            pin_drivers.driver.flush()
+        self.configured_mask |= mask
+        self.pin_byte &= ~mask
+        if signal_state:
+            self.state_byte |= mask
+        else:
+            self.state_byte &= ~mask
+        self.last_byte = None
+        common.state_version += 1
+        self.changed_version = common.state_version
         return 0
 
+    def initialise_pins(self, pin_cache: dict | None = None) -> int:
+        '''
+        Sets up every pin still held as a pin id through the
+        pin driver as an output showing red, green low and
+        red high, leaving the driver to be flushed
+
+        args:
+            pin_cache: optional dict: {pin id: driver handle} shared
+                across blocks so each pin is only set up once
+        returns:
+            int: number of pins set up
+        '''
+        driver = pin_drivers.driver
+        constructed = 0
+        pins = self.pins
+        initialised = self.initialised_pins
+        for index in range(16):
+            if initialised & (1 << index):
+                continue
+            pin_id = pins[index]
+            if pin_id is None:
+                continue
+            pin = pin_cache.get(pin_id) if pin_cache is not None else None
+            if pin is None:
+                # odd indexes are red, lit until the first update
+                pin = driver.setup(pin_id, index & 1)
+                constructed += 1
+                if pin_cache is not None:
+                    pin_cache[pin_id] = pin
+            else:
+                driver.set(pin, index & 1)
+            pins[index] = pin
+            initialised |= 1 << index
+        self.initialised_pins = initialised
+        return constructed
+
+    def element_state(self, position: int):
+        '''
+        Returns the state of the element at a
+        position, None if it is not configured
+        '''
+        mask = ELEMENT_BIT_MASKS[position]
+        if not self.configured_mask & mask:
+            return None
+        return 1 if self.state_byte & mask else 0
+
+    def element_pin_state(self, position: int):
+        '''
+        Returns the state the pins of the element at
+        a position show, None if it is not configured
+        '''
+        mask = ELEMENT_BIT_MASKS[position]
+        if not self.configured_mask & mask:
+            return None
+        return 1 if self.pin_byte & mask else 0
+
+    def element_states(self) -> list:
+        '''
+        Returns the state of each element position,
+        None where no element is configured
+        '''
+        states = ELEMENT_STATE_TABLE[self.state_byte]
+        if self.configured_mask == 0xFF:
+            return list(states)
+        return [states[position] if self.configured_mask & mask else None
+                for position, mask in enumerate(ELEMENT_BIT_MASKS)]
+
+    def element(self, position: int):
+        '''
+        Returns a SignalElement view of the element
+        at a position, None if it is not configured
+        '''
+        if not self.configured_mask & ELEMENT_BIT_MASKS[position]:
+            return None
+        return SignalElement(self, position)
+
+    def set_element_state(self, position: int, signal_state: int) -> None:
+        '''
+        Sets the state of one element, writing its pins
+        unless a pin transaction is holding writes
+        '''
+        mask = ELEMENT_BIT_MASKS[position]
+        if signal_state:
+            self.state_byte |= mask
+        else:
+            self.state_byte &= ~mask
+        if not hold_pin_write(self):
+            self.write_pins()
+
+    def write_pins(self, flush: bool = True) -> int:
+        '''
+        Drives the pins of every element whose state
+        differs from what its pins currently show, in
+        one bulk write unless flush is False
+
+        args:
+            flush: bool: False leaves the write to the caller,
+                to push several blocks in one write
+        returns:
+            int: number of elements written
+        '''
+        to_write = (self.state_byte ^ self.pin_byte) & self.configured_mask
+        if not to_write:
+            return 0
+        written = 0
+        pins = self.pins
+        set_pin = pin_drivers.driver.set
+        for position, mask in enumerate(ELEMENT_BIT_MASKS):
+            if to_write & mask:
+                if self.state_byte & mask:
+                    set_pin(pins[2 * position], 1)
+                    set_pin(pins[2 * position + 1], 0)
+                else:
+                    set_pin(pins[2 * position], 0)
+                    set_pin(pins[2 * position + 1], 1)
+                written += 1
+        self.pin_byte = self.state_byte
+        if flush:
+            pin_drivers.driver.flush()
+        return written
+
+    def release_pins(self, indexes=None) -> None:
+        '''
+        Turns off pins of a block being removed from the
+        configuration, both pins of every configured element
+        unless given the indexes into pins to turn off
+
+        args:
+            indexes: optional iterable of int: pins to turn off,
+                leaving pins other blocks still drive alone
+        '''
+        set_pin = pin_drivers.driver.set
+        if indexes is None:
+            indexes = [index for position, mask in enumerate(ELEMENT_BIT_MASKS)
+                       if self.configured_mask & mask
+                       for index in (2 * position, 2 * position + 1)]
+        for index in indexes:
+            set_pin(self.pins[index], 0)
+        pin_drivers.driver.flush()
+
     def return_little_endian(self, hex_value: str) -> str:
         '''
-        Parse the hex value provided into a little
-        endian representation of the binary  in a string
+        Parse the hex value provided into a string of the
+        element states, element position 0 first
 
         args:
             hex_value: str
         returns:
-            str: string representation of binary value in little endian
+            str: string representation of binary value in element order
         '''
-        signal_data = bin(int(hex_value, 16))[2:]
-        if len(signal_data):
-            _ = 8 - len(signal_data)
-            signal_data = '0' * _ + signal_data
-        signal_data = signal_data[::1]
-        return signal_data
-
+        return ''.join(str(state) for state in ELEMENT_STATE_TABLE[int(hex_value, 16) & 0xFF])
 
     def update_from_hex(self, hex_value) -> int:
         '''
         Update the signal block individual elements
         based on the hex value provided.
 
+        Only elements whose bit differs from the last
+        byte received are written, a repeated byte
+        does nothing.
+
         args:
             hex_value: str: hex value given via the STOMP msg
         returns:
-            int: 0 represent success
+            int: 0 represent success, 1 if the hex value is invalid
         '''
-        signal_state_in_binary = self.return_little_endian(hex_value)
+        try:
+            new_byte = int(hex_value, 16)
+        except (TypeError, ValueError):
+            return 1
+        if new_byte > 0xFF or new_byte < 0:
+            return 1
+
+        if self.last_byte is None:
+            changed_bits = 0xFF
+        else:
+            changed_bits = self.last_byte ^ new_byte
+        if not changed_bits:
+            return 0
 
-        for i, signal_element in enumerate(self.signal_elements_container):
-            if signal_element and isinstance(signal_element, SignalElement):
-                if len(signal_state_in_binary) >= i:
-                    signal_element.update_signal(new_signal_state=int(signal_state_in_binary[i]))
+        self.state_byte = new_byte & self.configured_mask
+        self.element_changes += BIT_COUNTS[changed_bits & self.configured_mask]
+        if not hold_pin_write(self):
+            self.write_pins()
 
+        journal.record(self, self.last_byte, new_byte)
+        self.last_byte = new_byte
+        common.state_version += 1
+        self.changed_version = common.state_version
         return 0
@@ -2,30 +2,87 @@
 Signal Element represents the
 individual signal that is part
 of a block of signals.
+
+The states and pins of every element are held
+packed in their SignalBlock, a SignalElement is
+only a view of one position in a block.
+
+Pin writes can be coalesced per STOMP frame
+by opening a pin transaction, block changes
+are then held until the transaction is committed
+and only the net change of each element is written.
 '''
+import pin_drivers
 
-import machine
+_pending_blocks = set()
+_pin_transaction_open = False
+
+def begin_pin_transaction():
+    '''
+    Starts holding pin writes until
+    commit_pin_transaction is called.
+    '''
+    global _pin_transaction_open
+    _pin_transaction_open = True
+
+def hold_pin_write(block) -> bool:
+    '''
+    Holds a block's pin write until the open
+    transaction is committed.
+
+    Returns:
+        bool: False if no transaction is open and
+            the block should write its pins now
+    '''
+    if not _pin_transaction_open:
+        return False
+    _pending_blocks.add(block)
+    return True
+
+def commit_pin_transaction() -> int:
+    '''
+    Writes the net change of every block updated
+    since begin_pin_transaction, in one bulk write
+    of the pin driver, and stops holding writes.
+
+    Returns:
+        int: the number of elements whose pins were written
+    '''
+    global _pin_transaction_open
+    _pin_transaction_open = False
+    written = 0
+    for block in _pending_blocks:
+        written += block.write_pins(flush=False)
+    _pending_blocks.clear()
+    if written:
+        pin_drivers.driver.flush()
+    return written
 
 class SignalElement:
     '''
-    SignalElement contains
-    the code to change the
-    state of the Signal
-    based on data provided
-    by the STOMP connection.
-    '''
-    def __init__(
-        self,
-        signal_state: int,
-        signal_platform: str,
-        green_signal_pin: machine.Pin,
-        red_signal_pin: machine.Pin
-    ):
-        self.signal_state = signal_state
-        self.signal_platform = signal_platform
-        self.signal_green_pin = green_signal_pin
-        self.signal_red_pin = red_signal_pin
-        self.signal_red_pin.value(1)
+    SignalElement is a view of the
+    element at one position of a
+    SignalBlock, it holds no state itself.
+    '''
+    __slots__ = ('block', 'position')
+
+    def __init__(self, block, position: int):
+        self.block = block
+        self.position = position
+
+    @property
+    def signal_state(self) -> int:
+        '''
+        0 off (red) or 1 on (green)
+        '''
+        return self.block.element_state(self.position)
+
+    @property
+    def pin_state(self) -> int:
+        '''
+        The state currently shown by the pins
+        '''
+        return self.block.element_pin_state(self.position)
 
     def update_signal(self, new_signal_state: int):
         '''
@@ -33,21 +90,15 @@ class SignalElement:
         the state of the signal, 0 off (red) or
         1 on (green)
 
+        Inside a pin transaction the pins are only
+        written when the transaction is committed.
+
         Arguments:
             new_signal_state: int: 0/1 for red/green
         Returns:
-            current_signal_state: int: once the stae
+            current_signal_state: int: once the state is set, 2 if invalid
         '''
         if new_signal_state not in (0, 1):
             return 2
-
-        if new_signal_state == 0:
-            self.signal_green_pin.value(0)
-            self.signal_red_pin.value(1)
-        elif new_signal_state == 1:
-            self.signal_green_pin.value(1)
-            self.signal_red_pin.value(0)
-
-        self.signal_state = new_signal_state
-        return self.signal_state
-
+        self.block.set_element_state(self.position, new_signal_state)
+        return new_signal_state
@@ -0,0 +1,420 @@
+'''
+Signal Feed applies frames received from
+the TD feed to the configured signal blocks.
+
+It is shared by main.py and the replay
+harness so that both exercise exactly the
+same parse, filter and update path.
+'''
+from microstomp import Frame
+from signal_block import SignalBlock
+from signal_element import begin_pin_transaction, commit_pin_transaction
+
+import common
+import logger
+import metrics
+import parser_utils
+import pin_drivers
+
+import json
+import time
+
+#only decode TD messages for configured areas, False decodes whole batches
+streaming_json_decode = True
+
+def build_block(block_address: str, light_configurations: list, initialise_pins: bool = True) -> SignalBlock:
+    '''
+    Builds one signal block, and its pins unless
+    initialise_pins is False, from the light
+    configurations of its address
+    '''
+    _block = SignalBlock(signal_block_address=block_address)
+    [_block.modify_signal_in_block(signal_position = _s['element_position'],
+                                  signal_platform = _s['platform'],
+                                  signal_green_pin = _s['green_pin'],
+                                  signal_red_pin = _s['red_pin'],
+                                  initialise_pins = False) for _s in light_configurations]
+    if initialise_pins:
+        _block.initialise_pins()
+        pin_drivers.driver.flush()
+    return _block
+
+def build_area_container(configuration: dict, initialise_pins: bool = True) -> dict:
+    '''
+    Builds the signal blocks, and their pins,
+    for every area in a validated configuration
+
+    args:
+        configuration: dict: as returned by read_configuration_file
+        initialise_pins: bool: False leaves the pins for initialise_area_pins
+    returns:
+        dict: {area_id: {address: SignalBlock}}
+    '''
+    area_container = {}
+    for area in configuration:
+        logger.info('enumerating area %s', area)
+        area_data = configuration[area]
+        block_map = {}
+        for block_address in area_data:
+            logger.debug('enumerating block address %s', block_address)
+            block_map[block_address] = build_block(block_address, area_data[block_address],
+                                                   initialise_pins)
+        area_container[area] = block_map
+    return area_container
+
+def initialise_area_pins(area_container: dict) -> int:
+    '''
+    Sets up the pins of every block in one pass and
+    one bulk write of the pin driver, setting up each
+    pin once however many elements share it
+
+    returns:
+        int: number of pins set up
+    '''
+    pin_cache = {}
+    constructed = 0
+    for blocks in area_container.values():
+        for block in blocks.values():
+            constructed += block.initialise_pins(pin_cache)
+    pin_drivers.driver.flush()
+    return constructed
+
+#subscription id: (message handler, area ids, routing table) for frames
+#from that subscription, others are routed over the whole configuration
+subscription_routes = {}
+#subscription id: (message handler, area ids as registered, None for all)
+_registered_subscriptions = {}
+
+def load_configuration(configuration: dict, initialise_pins: bool = True) -> None:
+    '''
+    Builds the area container and routing
+    table for a validated configuration, and
+    the routes of registered subscriptions
+
+    args:
+        configuration: dict: as returned by read_configuration_file
+        initialise_pins: bool: False leaves the pins to be set up
+            in bulk by initialise_area_pins before any update
+    '''
+    install_configuration(configuration, build_area_container(configuration, initialise_pins))
+
+def install_configuration(configuration: dict, area_container: dict) -> None:
+    '''
+    Makes a configuration and its blocks current, building
+    the routing table and subscription routes before
+    swapping them in so frames never see a partial table
+    '''
+    global subscription_routes
+    routing_table = parser_utils.build_routing_table(area_container)
+    routed_area_ids = set(area_id.encode('utf-8') for area_id, _ in routing_table)
+    routes = {}
+    for subscription_id, (handler, area_ids) in _registered_subscriptions.items():
+        routes[subscription_id] = build_subscription_route(
+            handler, configuration if area_ids is None else area_ids, routing_table)
+    common.config_current_configuration = configuration
+    common.areas_of_interest = configuration.keys()
+    common.area_container = area_container
+    common.routing_table = routing_table
+    common.routed_area_ids = routed_area_ids
+    subscription_routes = routes
+
+def unsubscribed_areas(configuration: dict) -> list:
+    '''
+    Returns the areas of a configuration that no registered
+    subscription carries, so their blocks are never updated.
+    Empty when no subscription is registered as frames are
+    then routed over the whole configuration.
+    '''
+    if not _registered_subscriptions:
+        return []
+    subscribed = set()
+    for _, area_ids in _registered_subscriptions.values():
+        if area_ids is None:
+            return []
+        subscribed.update(area_id.upper() for area_id in area_ids)
+    return [area for area in configuration if area.upper() not in subscribed]
+
+def light_pins(light_configurations: list):
+    '''
+    Generator of (index into SignalBlock.pins, pin id)
+    for every pin of an address's light configurations
+    '''
+    for light in light_configurations:
+        position = light['element_position']
+        yield 2 * position, light['green_pin']
+        yield 2 * position + 1, light['red_pin']
+
+def same_lights(current: list, new: list) -> bool:
+    '''
+    Returns True if two light configurations build the same
+    block, ignoring keys a block does not use and whether the
+    platform is a string, as a compiled configuration keeps
+    '''
+    normalise = parser_utils.normalise_light_configurations
+    return normalise(current) == normalise(new)
+
+def reload_configuration(configuration: dict) -> dict:
+    '''
+    Applies a new validated configuration while the feed
+    runs. Only blocks whose address was added or whose
+    light configuration changed are rebuilt, compared through
+    parser_utils.normalise_light_configurations, every other
+    block keeps its object, pins and state. A changed block
+    is restored to its last byte, a removed block's pins
+    are turned off unless a block of the new configuration
+    drives them, and blocks sharing a pin with a rebuilt or
+    removed block have their pins written again.
+
+    Every new block is built before any pin is released or
+    table swapped, so a configuration that fails to build
+    raises and leaves the current one installed untouched.
+    Holds common.feed_lock as the web server reloads from
+    its own thread while frames are applied.
+
+    args:
+        configuration: dict: as returned by parse_configuration
+    returns:
+        dict: lists of 'area/address' added, changed and removed,
+            the number of blocks left unchanged and the areas
+            no subscription carries
+    '''
+    with common.feed_lock:
+        summary = _reload_configuration(configuration)
+    for area in summary['unsubscribed']:
+        logger.warn('area %s is not carried by any subscription', area)
+    logger.info('configuration reloaded, %s added %s changed %s removed %s unchanged',
+                len(summary['added']), len(summary['changed']),
+                len(summary['removed']), summary['unchanged'])
+    return summary
+
+def _reload_configuration(configuration: dict) -> dict:
+    '''
+    Does the work of reload_configuration,
+    with common.feed_lock held
+    '''
+    current_configuration = common.config_current_configuration or {}
+    current_container = common.area_container or {}
+    summary = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0}
+
+    area_container = {}
+    built = []
+    surviving = []
+    used_pin_ids = set()
+    touched_pin_ids = set()
+    for area, area_data in configuration.items():
+        current_area = current_configuration.get(area, {})
+        current_blocks = current_container.get(area, {})
+        block_map = {}
+        for block_address, light_configurations in area_data.items():
+            block = current_blocks.get(block_address)
+            pin_ids = set(pin_id for _, pin_id in light_pins(light_configurations))
+            used_pin_ids.update(pin_ids)
+            if block is not None and same_lights(current_area.get(block_address, []),
+                                                 light_configurations):
+                summary['unchanged'] += 1
+                surviving.append((block, pin_ids))
+            else:
+                if block is None:
+                    summary['added'].append(f'{area}/{block_address}')
+                block = build_block(block_address, light_configurations, initialise_pins=False)
+                built.append(block)
+                touched_pin_ids.update(pin_ids)
+            block_map[block_address] = block
+        area_container[area] = block_map
+
+    restore = []
+    for area, blocks in current_container.items():
+        current_area = current_configuration.get(area, {})
+        new_area = configuration.get(area, {})
+        for block_address, block in blocks.items():
+            light_configurations = current_area.get(block_address, [])
+            new_light_configurations = new_area.get(block_address)
+            if new_light_configurations is not None and same_lights(light_configurations,
+                                                                    new_light_configurations):
+                continue
+            # released before the new blocks set up their pins so they can take
+            # them over, pins still driven by another block are left on
+            released = []
+            for index, pin_id in light_pins(light_configurations):
+                touched_pin_ids.add(pin_id)
+                if pin_id not in used_pin_ids:
+                    released.append(index)
+            block.release_pins(released)
+            if block_address in new_area:
+                restore.append((area, block_address, block.last_byte))
+            else:
+                summary['removed'].append(f'{area}/{block_address}')
+
+    pin_cache = {}
+    for block in built:
+        block.initialise_pins(pin_cache)
+
+    for area, block_address, last_byte in restore:
+        summary['changed'].append(f'{area}/{block_address}')
+        if last_byte is not None:
+            block = area_container[area][block_address]
+            block.state_byte = last_byte & block.configured_mask
+            block.last_byte = last_byte
+            block.write_pins(flush=False)
+
+    for block, pin_ids in surviving:
+        if pin_ids & touched_pin_ids:
+            # setting up or releasing a shared pin overwrote what this block showed
+            block.pin_byte = block.state_byte ^ block.configured_mask
+            block.write_pins(flush=False)
+    pin_drivers.driver.flush()
+
+    install_configuration(configuration, area_container)
+    common.state_version += 1
+    for block in built:
+        block.changed_version = common.state_version
+    summary['unsubscribed'] = unsubscribed_areas(configuration)
+    return summary
+
+def build_subscription_route(handler, area_ids, routing_table: dict | None = None) -> tuple:
+    '''
+    Returns the route for a subscription covering the
+    given areas, restricted to the configured blocks of
+    routing_table, by default common.routing_table
+
+    returns:
+        tuple: (handler, area ids as upper-case bytes, routing table)
+    '''
+    area_ids = set(area_id.upper() for area_id in area_ids)
+    if routing_table is None:
+        routing_table = common.routing_table or {}
+    routing_table = {key: block for key, block in routing_table.items()
+                     if key[0] in area_ids}
+    return handler, set(area_id.encode('utf-8') for area_id in area_ids), routing_table
+
+def register_subscription(subscription_id: str, area_ids=None, handler=None) -> None:
+    '''
+    Dispatches frames delivered for a subscription
+    to a handler over only the given areas
+
+    args:
+        subscription_id: str: id the subscription was made with
+        area_ids: iterable of str: areas the topic carries, i.e. ['Y2'],
+            None follows every area of the current configuration,
+            including those added by a reload
+        handler: optional function(body, area_ids, routing_table) -> int,
+            defaults to apply_td_messages
+    '''
+    handler = handler or apply_td_messages
+    configured = set(area_id.upper() for area_id in common.config_current_configuration or {})
+    if area_ids is None:
+        _registered_subscriptions[subscription_id] = (handler, None)
+        area_ids = configured
+    else:
+        for area_id in area_ids:
+            if area_id.upper() not in configured:
+                logger.warn('area %s of subscription %s is not configured', area_id, subscription_id)
+        _registered_subscriptions[subscription_id] = (handler, tuple(area_ids))
+    subscription_routes[subscription_id] = build_subscription_route(handler, area_ids)
+
+def td_selector(area_ids, message_types=('SF',)) -> str:
+    '''
+    Returns an ActiveMQ style selector that keeps only
+    messages for the given areas and TD message types,
+    for brokers that set area_id and msg_type properties
+
+    args:
+        area_ids: iterable of str: i.e. ['Y2', 'N2']
+        message_types: iterable of str: TD types, i.e. ('SF',)
+    returns:
+        str: i.e. "area_id IN ('Y2','N2') AND msg_type IN ('SF')"
+    '''
+    areas = ','.join(f"'{area_id.upper()}'" for area_id in area_ids)
+    types = ','.join(f"'{message_type}'" for message_type in message_types)
+    return f'area_id IN ({areas}) AND msg_type IN ({types})'
+
+def td_subscription_headers(area_ids, extra_headers: dict | None = None) -> dict:
+    '''
+    Returns the SUBSCRIBE headers asking the broker to
+    filter a TD topic to the given areas. The client side
+    filter still runs, so brokers that ignore the selector
+    only cost bandwidth.
+
+    args:
+        area_ids: iterable of str: areas the subscription covers
+        extra_headers: optional dict: further headers, i.e. activemq.prefetchSize
+    returns:
+        dict: of headers for MicroSTOMPClient.subscribe
+    '''
+    headers = {'selector': td_selector(area_ids)}
+    if extra_headers:
+        headers.update(extra_headers)
+    return headers
+
+def handle_frame(frame_data, acknowledge=None) -> int:
+    '''
+    Parses a frame from the feed, acknowledges it and
+    passes it to the handler of its subscription, by
+    default applying each routed SF message to its
+    signal block, with common.feed_lock held.
+
+    args:
+        frame_data: bytes or memoryview of one complete frame
+        acknowledge: optional function called with the parsed Frame
+    returns:
+        int: number of messages applied to a block
+    '''
+    started_us = metrics.ticks_us()
+    frame = Frame.parse_frame(frame_data)
+    metrics.parse_latency_us.observe(metrics.ticks_diff(metrics.ticks_us(), started_us))
+    if not frame:
+        return 0
+    if acknowledge:
+        acknowledge(frame)
+
+    if frame.is_error():
+        logger.error('%s', bytes(frame_data))
+        return 0
+
+    with common.feed_lock:
+        route = None
+        if subscription_routes:
+            route = subscription_routes.get(frame.get_header('subscription'))
+        if route is None:
+            return apply_td_messages(frame.body, common.routed_area_ids, common.routing_table)
+        handler, area_ids, routing_table = route
+        return handler(frame.body, area_ids, routing_table)
+
+def apply_td_messages(body, area_ids: set, routing_table: dict) -> int:
+    '''
+    Applies each SF message of a TD batch that is routed
+    to a signal block, coalescing pin writes across the batch.
+
+    args:
+        body: bytes or memoryview of the frame body
+        area_ids: set: areas to decode, as upper-case bytes
+        routing_table: dict: as returned by build_routing_table
+    returns:
+        int: number of messages applied to a block
+    '''
+    started_us = metrics.ticks_us()
+    if streaming_json_decode:
+        frame_body = parser_utils.iter_filtered_messages(body, area_ids)
+    else:
+        frame_body = json.loads(bytes(body))
+        metrics.messages_received += len(frame_body)
+    common.stat_last_message_received = str(time.localtime())
+    applied = 0
+    begin_pin_transaction()
+    try:
+        for message in frame_body:
+            block = parser_utils.route_message(message, routing_table)
+            if block is None:
+                if 'SF_MSG' in message:
+                    metrics.messages_filtered += 1
+                continue
+            message_data = message['SF_MSG']['data']
+            logger.debug('msg routed to block %s and data is %s', block.signal_block_address, message_data)
+            block.update_from_hex(message_data)
+            common.stat_last_block_change = str(time.localtime())
+            applied += 1
+    finally:
+        commit_pin_transaction()
+        metrics.messages_routed += applied
+        metrics.apply_latency_us.observe(metrics.ticks_diff(metrics.ticks_us(), started_us))
+    return applied
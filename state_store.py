@@ -0,0 +1,170 @@
+'''
+State Store keeps the last byte received for each
+signal block in a small binary file on flash, so the
+desk shows the last known aspects straight after a
+reboot rather than red until each address next changes.
+
+File layout, after the STATE_MAGIC line, one record per
+block that has received a byte:
+    area length (1 byte), area, address length (1 byte),
+    address, last byte (1 byte)
+
+Snapshots are only written when a block has changed,
+at most once per min_interval_ms, and not at all if the
+bytes match the last snapshot, to spare the flash.
+'''
+from microstomp import ticks_ms, ticks_diff
+
+import common
+import logger
+
+import os
+
+STATE_MAGIC = b'DSST1\n'
+
+def pack_states(area_container: dict) -> bytes:
+    '''
+    Returns the last byte of every block that has
+    received one, in the state file layout
+    '''
+    parts = [STATE_MAGIC]
+    for area_id, blocks in area_container.items():
+        area = str(area_id).encode('utf-8')
+        for address, block in blocks.items():
+            if block.last_byte is None:
+                continue
+            address = str(address).encode('utf-8')
+            parts.append(bytes((len(area),)) + area + bytes((len(address),)) + address
+                         + bytes((block.last_byte,)))
+    return b''.join(parts)
+
+def unpack_states(data: bytes) -> dict:
+    '''
+    Reads a state file's contents
+
+    returns:
+        dict: {(area_id, address): last byte}, empty if
+            the data is not a state file or is truncated
+    '''
+    if not data.startswith(STATE_MAGIC):
+        return {}
+    states = {}
+    position = len(STATE_MAGIC)
+    try:
+        while position < len(data):
+            area_end = position + 1 + data[position]
+            area = data[position + 1:area_end].decode('utf-8')
+            address_end = area_end + 1 + data[area_end]
+            address = data[area_end + 1:address_end].decode('utf-8')
+            if address_end >= len(data):
+                raise IndexError('record is truncated')
+            states[(area, address)] = data[address_end]
+            position = address_end + 1
+    except (IndexError, UnicodeError):
+        logger.warn('state file is truncated, ignoring it')
+        return {}
+    return states
+
+def load_states(file_location: str) -> dict:
+    '''
+    Reads the state file, empty if there is none
+    '''
+    try:
+        with open(file_location, 'rb') as state_file:
+            return unpack_states(state_file.read())
+    except OSError:
+        return {}
+
+def restore_states(area_container: dict, states: dict) -> int:
+    '''
+    Applies saved last bytes to the configured blocks,
+    driving their pins, ignoring blocks no longer configured
+
+    returns:
+        int: number of blocks restored
+    '''
+    restored = 0
+    for (area_id, address), last_byte in states.items():
+        block = area_container.get(area_id, {}).get(address)
+        if block is not None and not block.update_from_hex(f'{last_byte:02X}'):
+            restored += 1
+    return restored
+
+class StateSnapshotter:
+    '''
+    Writes the state file when blocks have changed,
+    coalescing changes into at most one write per interval
+    '''
+    def __init__(self, file_location: str, min_interval_ms: int = 60000):
+        '''
+        args:
+            file_location: str: state file path
+            min_interval_ms: int: shortest time between writes
+        '''
+        self.file_location = file_location
+        self.min_interval_ms = min_interval_ms
+        self.saved_version = common.state_version
+        self.last_save_ticks = ticks_ms()
+        self.last_saved = None
+        self.write_count = 0
+
+    def restore(self) -> int:
+        '''
+        Restores the saved states into common.area_container
+
+        returns:
+            int: number of blocks restored
+        '''
+        started = ticks_ms()
+        restored = restore_states(common.area_container, load_states(self.file_location))
+        self.saved_version = common.state_version
+        self.last_saved = pack_states(common.area_container)
+        logger.info('restored %s blocks in %s ms', restored, ticks_diff(ticks_ms(), started))
+        return restored
+
+    def maybe_save(self) -> bool:
+        '''
+        Saves the states if any block has changed and
+        min_interval_ms has passed since the last write
+
+        returns:
+            bool: True if the file was written
+        '''
+        if common.state_version == self.saved_version:
+            return False
+        if ticks_diff(ticks_ms(), self.last_save_ticks) < self.min_interval_ms:
+            return False
+        return self.save()
+
+    def save(self) -> bool:
+        '''
+        Writes the states now, unless they match the last
+        snapshot, replacing the file in one rename. Holds
+        common.feed_lock so blocks are not read mid frame
+        and only one save uses the temporary file at a time.
+
+        returns:
+            bool: True if the file was written
+        '''
+        with common.feed_lock:
+            self.saved_version = common.state_version
+            self.last_save_ticks = ticks_ms()
+            data = pack_states(common.area_container)
+            if data == self.last_saved:
+                return False
+            temporary_location = self.file_location + '.tmp'
+            try:
+                with open(temporary_location, 'wb') as state_file:
+                    state_file.write(data)
+                try:
+                    os.rename(temporary_location, self.file_location)
+                except OSError:
+                    # FAT will not rename over an existing file
+                    os.remove(self.file_location)
+                    os.rename(temporary_location, self.file_location)
+            except OSError as e:
+                logger.error('could not save block states %s', e)
+                return False
+            self.last_saved = data
+            self.write_count += 1
+            return True
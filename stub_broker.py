@@ -0,0 +1,329 @@
+'''
+A stub STOMP 1.2 broker for exercising MicroSTOMPClient
+over a real socket, without a Network Rail account.
+
+It serves one client connection at a time, answers
+CONNECT, records SUBSCRIBE and ACK frames and delivers
+published messages to every subscription of their
+destination whose selector matches the message headers,
+as ActiveMQ does.
+
+With fragment_writes MESSAGE frames are written in random
+sized pieces, splitting frames across writes and merging
+the tail of one with the next, as a real TCP stream may.
+The time from writing the last byte of each message to its
+ACK is recorded for load_test.py, so time a fragment spends
+held back for the next write is not counted.
+
+Only the selectors signal_feed.td_selector generates are
+understood, conditions of the form name IN ('a', 'b') or
+name = 'a' joined by AND. An unparseable selector is
+ignored, as a broker without selector support would.
+'''
+from microstomp import Frame, FrameDecoder, encode_frame, send_all, ticks_ms, ticks_diff, sleep_ms
+from metrics import ticks_us
+
+import random
+import socket
+import _thread
+
+def parse_selector(selector: str):
+    '''
+    Returns the conditions of a selector
+
+    args:
+        selector: str: i.e. "area_id IN ('Y2','N2') AND msg_type = 'SF'"
+    returns:
+        list: of (header name, tuple of accepted values),
+            None if the selector is not understood
+    '''
+    conditions = []
+    for condition in selector.split(' AND '):
+        condition = condition.strip()
+        if ' IN ' in condition:
+            name, values = condition.split(' IN ', 1)
+            values = values.strip()
+            if not (values.startswith('(') and values.endswith(')')):
+                return None
+            values = values[1:-1].split(',')
+        elif '=' in condition:
+            name, value = condition.split('=', 1)
+            values = [value]
+        else:
+            return None
+        accepted = []
+        for value in values:
+            value = value.strip()
+            if len(value) < 2 or value[0] != "'" or value[-1] != "'":
+                return None
+            accepted.append(value[1:-1])
+        conditions.append((name.strip(), tuple(accepted)))
+    return conditions
+
+def selector_matches(conditions, headers: dict) -> bool:
+    '''
+    Returns True if the headers meet every condition,
+    or there are no conditions
+    '''
+    if not conditions:
+        return True
+    for name, accepted in conditions:
+        if headers.get(name) not in accepted:
+            return False
+    return True
+
+class StubBroker:
+    '''
+    Accepts STOMP clients on a local port and
+    publishes messages to their subscriptions
+    '''
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 honour_selectors: bool = True,
+                 fragment_writes: bool = False,
+                 generator=None):
+        '''
+        args:
+            host: str: address to listen on
+            port: int: port to listen on, 0 for any free port
+            honour_selectors: bool: False delivers every message, as
+                a broker without selector support would
+            fragment_writes: bool: write MESSAGE frames in random pieces
+            generator: optional random.Random choosing the pieces
+        '''
+        self.honour_selectors = honour_selectors
+        self.fragment_writes = fragment_writes
+        self.generator = generator or random
+        #MESSAGE bytes held back to be merged with the next write, and
+        #(end within outbound, message number) of each message ending in them
+        self.outbound = b''
+        self.outbound_ends = []
+        #guards outbound and writes, taken by the publishing and serving threads
+        self.write_lock = _thread.allocate_lock()
+        #guards sent_ticks, never held while writing so ACKs are
+        #read while a publish is blocked on a full socket
+        self.ticks_lock = _thread.allocate_lock()
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(socket.getaddrinfo(host, port)[0][-1])
+        self.listen_socket.listen(1)
+        self.port = self.listen_socket.getsockname()[1]
+        self.connection = None
+        self.running = False
+        #subscription id: (destination, selector conditions)
+        self.subscriptions = {}
+        self.acked_ids = []
+        self.message_count = 0
+        self.messages_sent = 0
+        self.messages_filtered = 0
+        self.bytes_sent = 0
+        self.write_count = 0
+        #message number: ticks_us when sent, until acknowledged
+        self.sent_ticks = {}
+        self.ack_round_trips_us = []
+
+    def start(self) -> None:
+        '''
+        Serves clients on a separate thread
+        '''
+        self.running = True
+        _thread.start_new_thread(self.serve, ())
+
+    def serve(self) -> None:
+        '''
+        Accepts a client and handles its frames until it
+        disconnects, then waits for the next client
+        '''
+        while self.running:
+            try:
+                connection, _ = self.listen_socket.accept()
+            except OSError:
+                return
+            self.connection = connection
+            decoder = FrameDecoder()
+            try:
+                while self.running:
+                    received = decoder.receive_from(connection)
+                    if not received:
+                        break
+                    for frame_data in decoder.frames():
+                        frame = Frame.parse_frame(frame_data)
+                        if frame and not self.handle_client_frame(frame):
+                            break
+            except OSError:
+                pass
+            self.close_connection()
+
+    def handle_client_frame(self, frame: Frame) -> bool:
+        '''
+        Answers one frame from the client
+
+        returns:
+            bool: False once the client has disconnected
+        '''
+        if frame.command in ('CONNECT', 'STOMP'):
+            self.send(encode_frame('CONNECTED', {'version': '1.2', 'heart-beat': '0,0'}, escape=False))
+        elif frame.command == 'SUBSCRIBE':
+            selector = frame.get_header('selector')
+            conditions = parse_selector(selector) if selector and self.honour_selectors else None
+            self.subscriptions[frame.get_header('id')] = (frame.get_header('destination'), conditions)
+        elif frame.command == 'UNSUBSCRIBE':
+            self.subscriptions.pop(frame.get_header('id'), None)
+        elif frame.command == 'ACK':
+            self.record_ack(frame.get_header('id'))
+        elif frame.command == 'DISCONNECT':
+            receipt = frame.get_header('receipt')
+            if receipt:
+                self.send(encode_frame('RECEIPT', {'receipt-id': receipt}))
+            return False
+        return True
+
+    def record_ack(self, ack_id: str) -> None:
+        '''
+        Records an ACK and the round trip from sending its
+        message. Client mode ACKs are cumulative, so every
+        earlier message is settled without a round trip.
+        '''
+        self.acked_ids.append(ack_id)
+        try:
+            acked = int(ack_id.split('-')[-1])
+        except (AttributeError, ValueError):
+            return
+        with self.ticks_lock:
+            sent = self.sent_ticks.pop(acked, None)
+            if sent is not None:
+                self.ack_round_trips_us.append(ticks_diff(ticks_us(), sent))
+            for number in [number for number in self.sent_ticks if number < acked]:
+                del self.sent_ticks[number]
+
+    def wait_for_subscriptions(self, count: int = 1, timeout_ms: int = 2000) -> bool:
+        '''
+        Waits until the client has made count subscriptions
+
+        returns:
+            bool: False if the wait timed out
+        '''
+        started = ticks_ms()
+        while len(self.subscriptions) < count:
+            if ticks_diff(ticks_ms(), started) > timeout_ms:
+                return False
+            sleep_ms(5)
+        return True
+
+    def publish(self, destination: str, headers: dict, body) -> int:
+        '''
+        Delivers a message to every subscription of the
+        destination whose selector matches its headers
+
+        args:
+            destination: str: topic the message is sent to
+            headers: dict: message headers, which selectors test
+            body: str or bytes: message body
+        returns:
+            int: number of subscriptions it was delivered to
+        '''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        delivered = 0
+        for subscription_id, (subscribed_destination, conditions) in list(self.subscriptions.items()):
+            if subscribed_destination != destination:
+                continue
+            if not selector_matches(conditions, headers):
+                self.messages_filtered += 1
+                continue
+            self.message_count += 1
+            message_headers = {
+                'destination': destination,
+                'subscription': subscription_id,
+                'message-id': f'ID:stub-broker-{self.message_count}',
+                'ack': f'ack-{self.message_count}'
+            }
+            message_headers.update(headers)
+            self.send_message(encode_frame('MESSAGE', message_headers, body), self.message_count)
+            self.messages_sent += 1
+            delivered += 1
+        return delivered
+
+    def send(self, data) -> None:
+        '''
+        Writes to the current client, if any, after
+        any MESSAGE bytes still held back
+        '''
+        with self.write_lock:
+            if self.connection is None:
+                return
+            self.mark_sent([number for _, number in self.outbound_ends])
+            self.outbound_ends = []
+            if self.outbound:
+                data = self.outbound + data
+                self.outbound = b''
+            self.write(data)
+
+    def send_message(self, data, message_number: int) -> None:
+        '''
+        Writes a MESSAGE frame, with fragment_writes only a
+        random part of what is held back and the frame is
+        written, the rest waits for the next write or flush
+        '''
+        with self.write_lock:
+            if self.connection is None:
+                return
+            pending = self.outbound + data
+            ends = self.outbound_ends + [(len(pending), message_number)]
+            cut = len(pending)
+            if self.fragment_writes:
+                cut = 1 + self.generator.getrandbits(16) % len(pending)
+            self.outbound = pending[cut:]
+            self.outbound_ends = [(end - cut, number) for end, number in ends if end > cut]
+            self.mark_sent([number for end, number in ends if end <= cut])
+            self.write(pending[:cut])
+
+    def mark_sent(self, message_numbers: list) -> None:
+        '''
+        Records the messages about to be completed by a
+        write as sent, before it so an ACK cannot beat it
+        '''
+        if not message_numbers:
+            return
+        now = ticks_us()
+        with self.ticks_lock:
+            for number in message_numbers:
+                self.sent_ticks[number] = now
+
+    def flush(self) -> None:
+        '''
+        Writes any MESSAGE bytes held back
+        '''
+        if self.outbound:
+            self.send(b'')
+
+    def write(self, data) -> None:
+        '''
+        Writes data in one go, counting the write
+        '''
+        self.write_count += 1
+        self.bytes_sent += send_all(self.connection, data)
+
+    def close_connection(self) -> None:
+        '''
+        Closes the current client connection
+        '''
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                # wakes the serving thread, MicroPython sockets have no shutdown
+                shutdown = getattr(connection, 'shutdown', None)
+                if shutdown:
+                    shutdown(socket.SHUT_RDWR)
+                connection.close()
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        '''
+        Stops serving and closes every socket
+        '''
+        self.running = False
+        self.close_connection()
+        self.listen_socket.close()
@@ -3,7 +3,76 @@ Code Tests for all modules within desk-signaller
 '''
 import unittest
 
-from microstomp import Frame
+from microstomp import Frame, FrameDecoder, MicroSTOMPClient
+
+class FakePin:
+    '''
+    Records values written to it in place of a machine.Pin
+    '''
+    def __init__(self):
+        self.writes = []
+
+    def value(self, new_value):
+        '''
+        Records the value written
+        '''
+        self.writes.append(new_value)
+
+class FakeSocket:
+    '''
+    Records bytes sent in place of a socket
+    '''
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        '''
+        Records the data sent
+        '''
+        self.sent.append(bytes(data))
+        return len(data)
+
+def connected_client(**kwargs):
+    '''
+    Returns a MicroSTOMPClient over a FakeSocket as if connected
+    '''
+    client = MicroSTOMPClient('localhost', 61618, 'desk', 'user', 'pass',
+                              on_message_callback=None, **kwargs)
+    client.cx_socket.close()
+    client.cx_socket = FakeSocket()
+    client.connected_to_broker = True
+    return client
+
+def message_frame(ack_id):
+    '''
+    Returns a parsed MESSAGE frame with the given ack header
+    '''
+    return Frame.parse_frame(f'MESSAGE\nmessage-id:m{ack_id}\nack:{ack_id}\n\n[]\x00')
+
+class FakeBlock:
+    '''
+    Stands in for a SignalBlock with elements from position 0
+    '''
+    def __init__(self, address, states):
+        self.signal_block_address = address
+        self.states = list(states) + [None] * (8 - len(states))
+        self.changed_version = 0
+        self.element_changes = 0
+        self.last_byte = None
+
+    def element_states(self):
+        '''
+        Returns the element states
+        '''
+        return self.states
+
+    def update_from_hex(self, hex_value):
+        '''
+        Records the byte received
+        '''
+        self.last_byte = int(hex_value, 16)
+        return 0
+
 class TestFrameClass(unittest.TestCase):
     '''
     Contains all tests for Frame class
@@ -151,9 +220,1125 @@ class TestFrameClass(unittest.TestCase):
 
     def test_parsing_frame(self):
         '''
-        To be implemented, testing frame parsing function.
+        Test that command, headers and body are parsed
+        from bytes, with the body left as a view.
+        '''
+        raw = bytearray(b'MESSAGE\r\nmessage-id:ID\\cabc:1\r\n'
+                        b'destination:/topic/TD\r\nmessage-id:dup\r\n'
+                        b'\r\n[{"SF_MSG":{}}]\x00\n')
+        frame = Frame.parse_frame(memoryview(raw))
+
+        self.assertEqual(frame.command, 'MESSAGE')
+        self.assertEqual(frame.get_header('message-id'), 'ID:abc:1')
+        self.assertIsNone(frame._headers)
+        self.assertEqual(frame.headers, {'message-id': 'ID:abc:1',
+                                         'destination': '/topic/TD'})
+        self.assertIsInstance(frame.body, memoryview)
+        self.assertEqual(bytes(frame.body), b'[{"SF_MSG":{}}]')
+        self.assertIsNone(frame._built_frame)
+
+    def test_parsing_frame_from_string(self):
+        '''
+        Test that a str frame with values containing
+        colons is parsed.
+        '''
+        frame = Frame.parse_frame('CONNECTED\nserver:ActiveMQ:5\n\n\x00')
+        self.assertEqual(frame.command, 'CONNECTED')
+        self.assertEqual(frame.headers['server'], 'ActiveMQ:5')
+        self.assertEqual(bytes(frame.body), b'')
+
+    def test_unparseable_frame_returns_false(self):
+        '''
+        Test that a frame without an end of headers is rejected
+        '''
+        self.assertFalse(Frame.parse_frame(b'MESSAGE\nmessage-id:1'))
+
+class TestFrameDecoder(unittest.TestCase):
+    '''
+    Tests for the incremental STOMP stream decoder
+    '''
+    stream = (b'\n'
+              b'MESSAGE\nmessage-id:1\ncontent-length:5\n\nab\x00cd\x00'
+              b'\r\n'
+              b'MESSAGE\r\nmessage-id:2\r\n\r\n[{}]\x00')
+
+    def test_frames_split_across_every_byte(self):
+        '''
+        Test that frames are reassembled however the
+        stream is split, with heart-beats skipped.
+        '''
+        decoder = FrameDecoder(buffer_size=64)
+        frames = []
+        for i in range(len(self.stream)):
+            frames += [bytes(f) for f in decoder.decode(self.stream[i:i+1])]
+
+        self.assertEqual(len(frames), 2)
+        self.assertTrue(frames[0].endswith(b'\n\nab\x00cd\x00'))
+        self.assertTrue(frames[1].endswith(b'[{}]\x00'))
+
+    def test_frames_merged_in_one_receive(self):
+        '''
+        Test that several frames in one receive are all yielded
+        '''
+        decoder = FrameDecoder(buffer_size=256)
+        frames = [bytes(f) for f in decoder.decode(self.stream * 3)]
+        self.assertEqual(len(frames), 6)
+        self.assertEqual(decoder.start, 0)
+        self.assertEqual(decoder.end, 0)
+
+    def test_frames_found_without_bytearray_find(self):
+        '''
+        Test that the bytes scan used where bytearray has
+        no find, as on MicroPython, cuts the same frames.
+        '''
+        import microstomp
+
+        has_find = microstomp.BYTEARRAY_HAS_FIND
+        microstomp.BYTEARRAY_HAS_FIND = False
+        try:
+            decoder = FrameDecoder(buffer_size=64)
+            frames = [bytes(f) for f in decoder.decode(self.stream[:20])]
+            frames += [bytes(f) for f in decoder.decode(self.stream[20:] + self.stream)]
+        finally:
+            microstomp.BYTEARRAY_HAS_FIND = has_find
+        self.assertEqual(len(frames), 4)
+        self.assertTrue(frames[0].endswith(b'\n\nab\x00cd\x00'))
+        self.assertTrue(frames[3].endswith(b'[{}]\x00'))
+
+    def test_frame_over_many_receives_searched_once(self):
+        '''
+        Test that a large frame received a few bytes at a
+        time has each byte searched about once, not once
+        per receive.
+        '''
+        frame = b'MESSAGE\r\nmessage-id:1\r\n\r\n' + b'x' * 4000 + b'\x00'
+        decoder = FrameDecoder(buffer_size=8192)
+        searched = []
+        find = decoder.find
+
+        def counted_find(pattern, start, end):
+            searched.append(end - start)
+            return find(pattern, start, end)
+
+        decoder.find = counted_find
+        frames = []
+        for i in range(0, len(frame), 16):
+            frames += [bytes(f) for f in decoder.decode(frame[i:i + 16])]
+        self.assertEqual(frames, [frame])
+        self.assertLess(sum(searched), 3 * len(frame))
+
+    def test_oversized_frame_is_discarded(self):
+        '''
+        Test that a frame larger than the buffer is dropped
+        and the following frame is still decoded.
+        '''
+        decoder = FrameDecoder(buffer_size=32)
+        oversized = b'MESSAGE\n\n' + b'x' * 64 + b'\x00'
+        frames = [bytes(f) for f in decoder.decode(oversized + b'MESSAGE\n\nok\x00')]
+        self.assertEqual(frames, [b'MESSAGE\n\nok\x00'])
+        self.assertEqual(len(decoder.buffer), 32)
+
+    def test_receive_into_free_space(self):
+        '''
+        Test that bytes written into free_space are only
+        decoded once committed, as the event loop does.
+        '''
+        decoder = FrameDecoder(buffer_size=32)
+        data = b'MESSAGE\n\nok\x00'
+        decoder.free_space()[:len(data)] = data
+        self.assertEqual(list(decoder.frames()), [])
+        decoder.commit(len(data))
+        self.assertEqual([bytes(f) for f in decoder.frames()], [data])
+
+class TestMicroSTOMPClient(unittest.TestCase):
+    '''
+    Tests for MicroSTOMPClient acknowledgment handling
+    '''
+
+    def test_subscribe_ack_modes(self):
+        '''
+        Test that only client ack modes send ACKs and
+        unknown modes are refused.
+        '''
+        client = connected_client()
+        client.subscribe('/topic/TD', ack='AUTO')
+        self.assertEqual(client.subscriptions['desk'].ack_mode, 'auto')
+        self.assertFalse(client.acknowledge(message_frame(1)))
+
+        client.subscribe('/topic/TD', ack='client')
+        self.assertEqual(list(client.subscriptions), ['desk'])
+        self.assertEqual(client.subscriptions['desk'].ack_mode, 'client')
+        self.assertFalse(client.subscribe('/topic/TD', ack='sometimes'))
+
+    def test_subscriptions_share_connection(self):
+        '''
+        Test that each topic gets its own subscription id
+        and ACKs name the subscription a message came from.
+        '''
+        client = connected_client(ack_every_frames=2)
+        client.subscribe('/topic/TD_A', ack='client')
+        client.subscribe('/topic/TD_B', ack='client-individual')
+        self.assertEqual(list(client.subscriptions), ['desk', 'desk-1'])
+        self.assertIn(b'id:desk-1\r\ndestination:/topic/TD_B', client.cx_socket.sent[1])
+        client.cx_socket.sent.clear()
+
+        for ack_id, subscription_id in (('a1', 'desk'), ('b1', 'desk-1')):
+            client.acknowledge(Frame.parse_frame(
+                f'MESSAGE\nsubscription:{subscription_id}\nack:{ack_id}\n\n[]\x00'))
+        self.assertEqual(len(client.cx_socket.sent), 1)
+        self.assertIn(b'subscription:desk\r\nid:a1\r\n', client.cx_socket.sent[0])
+        self.assertIn(b'subscription:desk-1\r\nid:b1\r\n', client.cx_socket.sent[0])
+        self.assertFalse(client.acknowledge(message_frame('unknown')))
+
+    def test_cumulative_acks_every_n_frames(self):
+        '''
+        Test that client mode acknowledges only the latest
+        message once every N frames.
+        '''
+        client = connected_client(ack_every_frames=3)
+        client.subscribe('/topic/TD', ack='client')
+        client.cx_socket.sent.clear()
+
+        sent = [client.acknowledge(message_frame(i)) for i in range(1, 7)]
+        self.assertEqual(sent, [False, False, True, False, False, True])
+        self.assertEqual(len(client.cx_socket.sent), 2)
+        self.assertIn(b'\nid:3\r\n', client.cx_socket.sent[0])
+        self.assertNotIn(b'id:2', client.cx_socket.sent[0])
+
+    def test_individual_acks_batched(self):
+        '''
+        Test that client-individual mode acknowledges every
+        message, in one write per batch.
+        '''
+        client = connected_client(ack_every_frames=2)
+        client.subscribe('/topic/TD', ack='client-individual')
+        client.cx_socket.sent.clear()
+
+        for i in range(1, 4):
+            client.acknowledge(message_frame(i))
+        self.assertEqual(len(client.cx_socket.sent), 1)
+        self.assertEqual(client.cx_socket.sent[0].count(b'ACK\r\n'), 2)
+        self.assertTrue(client.flush_acks())
+        self.assertIn(b'\nid:3\r\n', client.cx_socket.sent[1])
+
+    def test_ack_template_matches_built_frame(self):
+        '''
+        Test that ACKs spliced from the template parse back
+        to the same headers a built ACK frame has.
+        '''
+        client = connected_client()
+        end = client.write_ack_frame('ID:host-1:1')
+        spliced = Frame.parse_frame(bytes(client.outbound_view[:end]))
+        self.assertEqual(spliced.command, 'ACK')
+        self.assertEqual(spliced.headers, {'subscription': 'desk',
+                                           'id': 'ID:host-1:1',
+                                           'content-length': '0'})
+        self.assertEqual(client.write_ack_frame('x' * 2048), -1)
+
+    def test_send_all_resends_after_short_write(self):
+        '''
+        Test that send_all keeps sending until all bytes are out
+        '''
+        from microstomp import send_all
+
+        class ShortWriteSocket(FakeSocket):
+            '''
+            Accepts at most three bytes per send
+            '''
+            def send(self, data):
+                return super().send(data[:3])
+
+        cx_socket = ShortWriteSocket()
+        self.assertEqual(send_all(cx_socket, b'SUBSCRIBE\r\n'), 11)
+        self.assertEqual(b''.join(cx_socket.sent), b'SUBSCRIBE\r\n')
+
+    def test_acks_due_after_interval(self):
+        '''
+        Test that held back ACKs are sent once ack_every_ms passes
+        '''
+        client = connected_client(ack_every_frames=100, ack_every_ms=50)
+        client.subscribe('/topic/TD', ack='client')
+        self.assertFalse(client.acknowledge(message_frame(1)))
+        client.last_ack_ticks -= 60
+        self.assertTrue(client.flush_acks_if_due())
+
+    def test_held_acks_sent_through_quiet_feed(self):
+        '''
+        Test that with heart-beats off the receive times out
+        after ack_every_ms while ACKs are held back, so
+        they are sent although no further frame arrives.
+        '''
+        client = connected_client(ack_every_frames=100, ack_every_ms=50)
+        client.subscribe('/topic/TD', ack='client')
+        client.on_message_callback = lambda frame_data: client.acknowledge(Frame.parse_frame(frame_data))
+        self.assertIsNone(client.receive_timeout_seconds())
+
+        class QuietSocket(FakeSocket):
+            '''
+            Delivers one frame, goes quiet, then closes
+            '''
+            def __init__(self):
+                super().__init__()
+                self.timeouts = []
+                self.reads = [b'MESSAGE\nsubscription:desk\nack:7\n\n[]\x00']
+
+            def settimeout(self, timeout):
+                '''
+                Records the timeout
+                '''
+                self.timeouts.append(timeout)
+
+            def recv_into(self, buffer):
+                '''
+                Returns the next read, times out once
+                the ACK is due, then reports closed
+                '''
+                if self.reads:
+                    data = self.reads.pop(0)
+                    buffer[:len(data)] = data
+                    return len(data)
+                if not self.sent:
+                    client.last_ack_ticks -= 60
+                    raise OSError(110)
+                return 0
+
+        client.cx_socket = QuietSocket()
+        client.listen_for_messages()
+        self.assertEqual(client.cx_socket.timeouts, [None, 0.05, None])
+        self.assertEqual(len(client.cx_socket.sent), 1)
+        self.assertIn(b'id:7', client.cx_socket.sent[0])
+
+    def test_idle_callback_runs_through_quiet_feed(self):
+        '''
+        Test that with heart-beats off the receive times out
+        after idle_poll_ms and on_idle_callback runs although
+        no frame arrives.
+        '''
+        idle_calls = []
+        client = connected_client(on_idle_callback=lambda: idle_calls.append(1),
+                                  idle_poll_ms=500)
+        self.assertEqual(client.receive_timeout_seconds(), 0.5)
+
+        class QuietSocket(FakeSocket):
+            '''
+            Times out twice, then closes
+            '''
+            def __init__(self):
+                super().__init__()
+                self.timeouts = []
+
+            def settimeout(self, timeout):
+                '''
+                Records the timeout
+                '''
+                self.timeouts.append(timeout)
+
+            def recv_into(self, buffer):
+                '''
+                Times out until the callback has run twice
+                '''
+                if len(idle_calls) < 2:
+                    raise OSError(110)
+                return 0
+
+        client.cx_socket = QuietSocket()
+        client.listen_for_messages()
+        self.assertEqual(client.cx_socket.timeouts, [0.5])
+        self.assertEqual(len(idle_calls), 2)
+
+class TestConnectionSupervisor(unittest.TestCase):
+    '''
+    Tests for heart-beat negotiation and reconnection
+    '''
+
+    def test_negotiate_heartbeats(self):
+        '''
+        Test that each direction uses the slower period
+        and is disabled when either side offers 0.
+        '''
+        client = connected_client(heart_beat=(10000, 5000))
+        client.negotiate_heartbeats('20000,0')
+        self.assertEqual((client.heartbeat_send_ms, client.heartbeat_receive_ms), (0, 20000))
+        client.negotiate_heartbeats('1000,1000')
+        self.assertEqual((client.heartbeat_send_ms, client.heartbeat_receive_ms), (10000, 5000))
+        client.negotiate_heartbeats('nonsense')
+        self.assertEqual((client.heartbeat_send_ms, client.heartbeat_receive_ms), (0, 0))
+
+    def test_check_heartbeats(self):
+        '''
+        Test that a heart-beat is sent when due and a
+        silent server marks the link dead.
+        '''
+        client = connected_client(heart_beat=(1000, 1000))
+        client.negotiate_heartbeats('1000,1000')
+        self.assertTrue(client.check_heartbeats())
+        self.assertEqual(client.cx_socket.sent, [])
+
+        client.last_sent_ticks -= 1000
+        client.last_received_ticks -= 2001
+        self.assertFalse(client.check_heartbeats())
+        self.assertEqual(client.cx_socket.sent, [b'\n'])
+
+    def test_backoff_is_jittered_and_capped(self):
+        '''
+        Test that backoff doubles per failure within
+        half and all of the period, up to the cap.
+        '''
+        from microstomp import ConnectionSupervisor
+
+        supervisor = ConnectionSupervisor(connected_client(), backoff_base_ms=100, backoff_max_ms=1000)
+        for failed_attempts, ceiling in ((0, 100), (1, 200), (3, 800), (4, 1000), (40, 1000)):
+            supervisor.failed_attempts = failed_attempts
+            for _ in range(20):
+                with self.subTest():
+                    self.assertTrue(ceiling // 2 <= supervisor.backoff_ms() <= ceiling)
+
+    def test_reconnect_statistics(self):
+        '''
+        Test that reconnects are counted and the time
+        disconnected accumulates.
+        '''
+        from microstomp import ConnectionSupervisor
+
+        class FlakyClient:
+            '''
+            Fails to reconnect once then succeeds
+            '''
+            connected_to_broker = False
+            attempts = 0
+
+            def reconnect(self):
+                '''
+                Succeeds on the second attempt
+                '''
+                self.attempts += 1
+                self.connected_to_broker = self.attempts > 1
+                return self.connected_to_broker
+
+        supervisor = ConnectionSupervisor(FlakyClient())
+        supervisor.mark_disconnected()
+        supervisor.disconnected_since -= 250
+        self.assertFalse(supervisor.attempt_reconnect())
+        self.assertEqual(supervisor.failed_attempts, 1)
+        self.assertTrue(supervisor.attempt_reconnect())
+
+        stats = supervisor.stats()
+        self.assertEqual(stats['reconnect_count'], 1)
+        self.assertTrue(stats['connected'])
+        self.assertTrue(stats['disconnected_ms'] >= 250)
+        self.assertEqual(supervisor.failed_attempts, 0)
+
+    def test_connect_times_out_on_silent_broker(self):
+        '''
+        Test that a broker which accepts but never answers
+        fails the connect within its timeout.
+        '''
+        import socket
+        from microstomp import ticks_ms, ticks_diff
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = MicroSTOMPClient('127.0.0.1', listener.getsockname()[1], 'desk', 'user', 'pass',
+                                  on_message_callback=None, connect_timeout_ms=200)
+        started = ticks_ms()
+        try:
+            self.assertFalse(client.connect())
+        finally:
+            client.cx_socket.close()
+            listener.close()
+        self.assertLess(ticks_diff(ticks_ms(), started), 2000)
+        self.assertFalse(client.connected_to_broker)
+
+    def test_async_reconnect_leaves_loop_running(self):
+        '''
+        Test that other tasks run while a reconnect waits
+        on a slow broker, and that a silent broker still
+        fails the attempt within the connect timeout.
+        '''
+        import _thread
+        import socket
+        from microstomp import ConnectionSupervisor, asyncio, sleep_ms
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(2)
+        accepted = []
+
+        def serve():
+            connection, _ = listener.accept()
+            accepted.append(connection)
+            connection.recv(1024)
+            sleep_ms(300)
+            connection.send(b'CONNECTED\nversion:1.2\n\n\x00')
+            accepted.append(listener.accept()[0])
+
+        _thread.start_new_thread(serve, ())
+        client = MicroSTOMPClient('127.0.0.1', listener.getsockname()[1], 'desk', 'user', 'pass',
+                                  on_message_callback=None, connect_timeout_ms=1000)
+        client.subscribe('/topic/TD_ALL_SIG_AREA', ack='client', subscription_id='0')
+        supervisor = ConnectionSupervisor(client)
+        ticks = []
+
+        async def count_ticks():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        async def reconnect():
+            ticker = asyncio.create_task(count_ticks())
+            connected = await supervisor.attempt_reconnect_async()
+            ticker.cancel()
+            return connected
+
+        try:
+            self.assertTrue(asyncio.run(reconnect()))
+            self.assertGreater(len(ticks), 5)
+            self.assertEqual(supervisor.reconnect_count, 1)
+            self.assertTrue(client.connected_to_broker)
+            self.assertIn(b'SUBSCRIBE', accepted[0].recv(1024))
+
+            client.connect_timeout_ms = 200
+            ticks.clear()
+            self.assertFalse(asyncio.run(reconnect()))
+            self.assertGreater(len(ticks), 5)
+            self.assertEqual(supervisor.failed_attempts, 1)
+        finally:
+            client.cx_socket.close()
+            for connection in accepted:
+                connection.close()
+            listener.close()
+
+class TestSignalFeed(unittest.TestCase):
+    '''
+    Tests for dispatching frames by subscription
+    '''
+
+    def setUp(self):
+        import pin_drivers
+        self.driver = pin_drivers.driver
+        pin_drivers.set_driver(pin_drivers.FakeDriver())
+
+    def tearDown(self):
+        import pin_drivers
+        import signal_feed
+        signal_feed.subscription_routes.clear()
+        signal_feed._registered_subscriptions.clear()
+        pin_drivers.set_driver(self.driver)
+
+    def test_frames_dispatched_by_subscription(self):
+        '''
+        Tests that a frame goes to the handler and areas
+        registered for its subscription header.
+        '''
+        import common
+        import signal_feed
+
+        common.config_current_configuration = {'Y2': {}, 'N2': {}}
+        common.routing_table = {('Y2', '5A'): FakeBlock('5A', [0]),
+                                ('N2', '01'): FakeBlock('01', [0])}
+        calls = []
+
+        def handler(body, area_ids, routing_table):
+            calls.append((bytes(body), area_ids, list(routing_table)))
+            return 1
+
+        signal_feed.register_subscription('desk', ['Y2'], handler)
+        signal_feed.register_subscription('desk-1', ['n2'], handler)
+        frame = b'MESSAGE\nsubscription:desk-1\nack:1\n\n[]\x00'
+        self.assertEqual(signal_feed.handle_frame(frame), 1)
+        self.assertEqual(calls, [(b'[]', {b'N2'}, [('N2', '01')])])
+
+    def test_td_selector(self):
+        '''
+        Tests the selector generated for a subscription's areas
+        '''
+        import signal_feed
+
+        headers = signal_feed.td_subscription_headers(['Y2', 'n2'], {'activemq.prefetchSize': 10})
+        self.assertEqual(headers, {'selector': "area_id IN ('Y2','N2') AND msg_type IN ('SF')",
+                                   'activemq.prefetchSize': 10})
+
+    def test_reload_rebuilds_only_changed_blocks(self):
+        '''
+        Tests that a reload keeps unchanged blocks and their
+        state, rebuilds a changed block at its last byte,
+        adds new blocks and drops removed ones.
+        '''
+        import common
+        import signal_feed
+
+        def lights(green_pin):
+            return [{'platform': '1', 'element_position': 0,
+                     'green_pin': green_pin, 'red_pin': green_pin + 1}]
+
+        signal_feed.load_configuration({'Y2': {'5A': lights(2), '5B': lights(4), '5C': lights(6)}})
+        signal_feed.register_subscription('sub-0')
+        signal_feed.register_subscription('sub-1', ['Y2'])
+        kept = common.area_container['Y2']['5A']
+        kept.update_from_hex('80')
+        common.area_container['Y2']['5B'].update_from_hex('80')
+
+        summary = signal_feed.reload_configuration(
+            {'Y2': {'5A': lights(2), '5B': lights(8)}, 'N2': {'01': lights(10)}})
+        self.assertEqual(summary, {'added': ['N2/01'], 'changed': ['Y2/5B'],
+                                   'removed': ['Y2/5C'], 'unchanged': 1,
+                                   'unsubscribed': []})
+        _, area_ids, routing_table = signal_feed.subscription_routes['sub-0']
+        self.assertEqual(area_ids, {b'Y2', b'N2'})
+        self.assertEqual(sorted(routing_table), [('N2', '01'), ('Y2', '5A'), ('Y2', '5B')])
+        _, area_ids, routing_table = signal_feed.subscription_routes['sub-1']
+        self.assertEqual(area_ids, {b'Y2'})
+        self.assertEqual(sorted(routing_table), [('Y2', '5A'), ('Y2', '5B')])
+        self.assertIs(common.area_container['Y2']['5A'], kept)
+        self.assertEqual(kept.element_states()[0], 1)
+        self.assertEqual(common.area_container['Y2']['5B'].last_byte, 0x80)
+        self.assertEqual(common.area_container['Y2']['5B'].element_states()[0], 1)
+        self.assertNotIn('5C', common.area_container['Y2'])
+        self.assertIn(('N2', '01'), common.routing_table)
+        self.assertEqual(common.routed_area_ids, {b'Y2', b'N2'})
+
+        del signal_feed._registered_subscriptions['sub-0']
+        summary = signal_feed.reload_configuration(
+            {'Y2': {'5A': lights(2)}, 'N2': {'01': lights(10)}})
+        self.assertEqual(summary['unsubscribed'], ['N2'])
+
+    def test_reload_leaves_shared_pins_lit(self):
+        '''
+        Tests that removing a block only turns off pins no
+        remaining block drives, and that a changed block is
+        restored without journalling or counting a change.
+        '''
+        import common
+        import journal
+        import pin_drivers
+        import signal_feed
+
+        def light(position, green_pin):
+            return {'platform': '1', 'element_position': position,
+                    'green_pin': green_pin, 'red_pin': green_pin + 1}
+
+        signal_feed.load_configuration({'Y2': {'5A': [light(0, 2)],
+                                               '5B': [light(0, 2), light(1, 4)],
+                                               '5C': [light(0, 6)]}})
+        common.area_container['Y2']['5A'].update_from_hex('80')
+        common.area_container['Y2']['5C'].update_from_hex('80')
+        journal.allocate(8)
+
+        summary = signal_feed.reload_configuration({'Y2': {'5A': [light(0, 2)],
+                                                           '5C': [light(0, 8)]}})
+        self.assertEqual(summary['removed'], ['Y2/5B'])
+        self.assertEqual(summary['changed'], ['Y2/5C'])
+        values = pin_drivers.driver.values
+        self.assertEqual((values[2], values[3]), (1, 0))
+        self.assertEqual((values[4], values[5]), (0, 0))
+        self.assertEqual((values[6], values[7]), (0, 0))
+        self.assertEqual((values[8], values[9]), (1, 0))
+        changed = common.area_container['Y2']['5C']
+        self.assertEqual((changed.last_byte, changed.element_changes), (0x80, 0))
+        self.assertEqual(journal.entry_count, 0)
+
+    def test_reload_while_frames_applied(self):
+        '''
+        Tests that reloading from another thread while frames
+        are applied neither raises nor leaves a block behind.
+        '''
+        import _thread
+        import common
+        import signal_feed
+        import time
+
+        def configuration(red_pin):
+            return {'Y2': {address: [{'platform': '1', 'element_position': 0,
+                                      'green_pin': 2, 'red_pin': red_pin}]
+                           for address in ('5A', '5B', '5C', '5D')}}
+
+        signal_feed.load_configuration(configuration(3))
+
+        def apply_slowly(body, area_ids, routing_table):
+            container = common.area_container
+            applied = signal_feed.apply_td_messages(body, area_ids, routing_table)
+            time.sleep(0.001)
+            if common.area_container is not container:
+                raise AssertionError('configuration reloaded mid frame')
+            return applied
+
+        signal_feed.register_subscription('0', None, apply_slowly)
+        body = ','.join('{"SF_MSG":{"area_id":"Y2","address":"%s","data":"%s"}}'
+                        % (address, data) for data in ('80', '00')
+                        for address in ('5A', '5B', '5C', '5D'))
+        frame = b'MESSAGE\nsubscription:0\n\n[' + body.encode('utf-8') + b']\x00'
+        errors = []
+        done = []
+
+        def apply_frames():
+            try:
+                for _ in range(100):
+                    signal_feed.handle_frame(frame)
+            except Exception as e:
+                errors.append(e)
+            done.append(True)
+
+        _thread.start_new_thread(apply_frames, ())
+        red_pin = 3
+        while not done:
+            red_pin = 5 if red_pin == 3 else 3
+            signal_feed.reload_configuration(configuration(red_pin))
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(common.routing_table),
+                         [('Y2', '5A'), ('Y2', '5B'), ('Y2', '5C'), ('Y2', '5D')])
+
+    def test_failed_reload_keeps_current_configuration(self):
+        '''
+        Tests that a configuration whose blocks fail to build
+        leaves the current blocks installed with their pins lit.
+        '''
+        import common
+        import pin_drivers
+        import signal_feed
+
+        configuration = {'Y2': {'5A': [{'platform': '1', 'element_position': 0,
+                                        'green_pin': 2, 'red_pin': 3}]}}
+        signal_feed.load_configuration(configuration)
+        block = common.area_container['Y2']['5A']
+        block.update_from_hex('80')
+        routing_table = common.routing_table
+
+        broken = {'Y2': {'5A': [{'platform': '1', 'element_position': '0',
+                                 'green_pin': 4, 'red_pin': 5}]}}
+        with self.assertRaises(TypeError):
+            signal_feed.reload_configuration(broken)
+        self.assertIs(common.config_current_configuration, configuration)
+        self.assertIs(common.area_container['Y2']['5A'], block)
+        self.assertIs(common.routing_table, routing_table)
+        self.assertEqual(pin_drivers.driver.values, {2: 1, 3: 0})
+
+class TestStubBroker(unittest.TestCase):
+    '''
+    Tests against the local stub broker
+    '''
+
+    def bytes_per_kept_message(self, honour_selectors):
+        '''
+        Publishes TD messages for several areas and types
+        through the stub broker and returns the bytes the
+        client received per message its filter kept.
+        '''
+        import json
+        from parser_utils import iter_filtered_messages
+        from stub_broker import StubBroker
+
+        broker = StubBroker(honour_selectors=honour_selectors)
+        broker.start()
+        kept = []
+
+        def keep_messages(frame_data):
+            kept.extend(iter_filtered_messages(Frame.parse_frame(frame_data).body, {b'Y2'}))
+
+        client = MicroSTOMPClient('127.0.0.1', broker.port, 'desk', 'user', 'pass',
+                                  on_message_callback=keep_messages)
+        self.assertTrue(client.connect())
+        client.subscribe('/topic/TD', ack='client', headers={
+            'selector': "area_id IN ('Y2') AND msg_type IN ('SF')"})
+        self.assertTrue(broker.wait_for_subscriptions())
+        for area_id in ('Y2', 'N2', 'XY'):
+            for message_type in ('SF', 'CA', 'CB', 'CC'):
+                message = {f'{message_type}_MSG': {'area_id': area_id, 'address': '5A',
+                                                   'msg_type': message_type, 'data': '01'}}
+                broker.publish('/topic/TD', {'area_id': area_id, 'msg_type': message_type},
+                               json.dumps([message]))
+        broker.close()
+        client.listen_for_messages()
+        client.cx_socket.close()
+        self.assertEqual(len(kept), 1)
+        return client.bytes_received / len(kept)
+
+    def test_selector_cuts_bytes_per_kept_message(self):
+        '''
+        Tests that a broker honouring the selector sends
+        fewer bytes per kept message, and the client side
+        filter keeps the same messages when it does not.
+        '''
+        filtered = self.bytes_per_kept_message(honour_selectors=True)
+        unfiltered = self.bytes_per_kept_message(honour_selectors=False)
+        self.assertLess(filtered * 10, unfiltered)
+
+    def test_fragmented_writes_deliver_every_frame(self):
+        '''
+        Tests that frames split and merged across writes
+        all reach the client intact, and ACKs round trip.
+        '''
+        import random
+        import _thread
+        from microstomp import ticks_ms, ticks_diff, sleep_ms
+        from stub_broker import StubBroker
+
+        broker = StubBroker(fragment_writes=True, generator=random.Random(7))
+        broker.start()
+        bodies = []
+        client = MicroSTOMPClient('127.0.0.1', broker.port, 'desk', 'user', 'pass',
+                                  on_message_callback=None, ack_every_frames=5)
+
+        def receive(frame_data):
+            frame = Frame.parse_frame(frame_data)
+            bodies.append(bytes(frame.body))
+            client.acknowledge(frame)
+
+        client.on_message_callback = receive
+        self.assertTrue(client.connect())
+        client.subscribe('/topic/TD', ack='client')
+        self.assertTrue(broker.wait_for_subscriptions())
+
+        def publish():
+            for i in range(40):
+                broker.publish('/topic/TD', {}, f'[{i}]' * (i % 7 + 1))
+            broker.flush()
+            started = ticks_ms()
+            while len(broker.acked_ids) < 8 and ticks_diff(ticks_ms(), started) < 2000:
+                sleep_ms(5)
+            broker.close()
+
+        _thread.start_new_thread(publish, ())
+        client.listen_for_messages()
+        client.cx_socket.close()
+
+        self.assertNotEqual(broker.write_count, 40)
+        self.assertEqual(bodies, [f'[{i}]'.encode() * (i % 7 + 1) for i in range(40)])
+        self.assertEqual(len(broker.ack_round_trips_us), 8)
+
+    def test_held_back_message_timed_from_its_last_byte(self):
+        '''
+        Tests that a fragmented message's round trip starts
+        when its tail is written, not when it was published.
+        '''
+        import random
+        from stub_broker import StubBroker
+
+        broker = StubBroker(fragment_writes=True, generator=random.Random(3))
+        broker.connection = FakeSocket()
+        broker.subscriptions['desk'] = ('/topic/TD', None)
+        try:
+            while True:
+                broker.publish('/topic/TD', {}, b'[]')
+                if broker.outbound_ends:
+                    break
+            held = [number for _, number in broker.outbound_ends]
+            self.assertFalse(any(number in broker.sent_ticks for number in held))
+            broker.flush()
+            self.assertEqual(broker.outbound, b'')
+            self.assertTrue(all(number in broker.sent_ticks for number in held))
+            self.assertEqual(sorted(broker.sent_ticks), list(range(1, broker.message_count + 1)))
+        finally:
+            broker.connection = None
+            broker.close()
+
+    def test_parse_selector(self):
+        '''
+        Tests the selector subset the stub broker understands
+        '''
+        from stub_broker import parse_selector, selector_matches
+
+        conditions = parse_selector("area_id IN ('Y2','N2') AND msg_type = 'SF'")
+        self.assertEqual(conditions, [('area_id', ('Y2', 'N2')), ('msg_type', ('SF',))])
+        self.assertTrue(selector_matches(conditions, {'area_id': 'N2', 'msg_type': 'SF'}))
+        self.assertFalse(selector_matches(conditions, {'area_id': 'N2', 'msg_type': 'CA'}))
+        self.assertIsNone(parse_selector('area_id LIKE Y%'))
+
+class TestStateStore(unittest.TestCase):
+    '''
+    Tests for warm start block state persistence
+    '''
+    state_file = 'test_block_states.bin'
+
+    def tearDown(self):
+        import os
+        for location in (self.state_file, self.state_file + '.tmp'):
+            try:
+                os.remove(location)
+            except OSError:
+                pass
+
+    def test_states_round_trip(self):
+        '''
+        Tests that saved last bytes are restored to the
+        same blocks and unchanged blocks are left alone.
+        '''
+        from state_store import pack_states, unpack_states, restore_states
+
+        saved = {'Y2': {'5A': FakeBlock('5A', [1]), '5B': FakeBlock('5B', [0])}}
+        saved['Y2']['5A'].last_byte = 0x81
+        data = pack_states(saved)
+        self.assertEqual(len(data), len(b'DSST1\n') + 7)
+        self.assertEqual(unpack_states(data), {('Y2', '5A'): 0x81})
+        self.assertEqual(unpack_states(data[:-1]), {})
+
+        booted = {'Y2': {'5A': FakeBlock('5A', [0]), '5B': FakeBlock('5B', [0])}}
+        self.assertEqual(restore_states(booted, unpack_states(data)), 1)
+        self.assertEqual(booted['Y2']['5A'].last_byte, 0x81)
+        self.assertIsNone(booted['Y2']['5B'].last_byte)
+
+    def test_snapshots_are_coalesced(self):
+        '''
+        Tests that changes are written at most once per
+        interval and identical snapshots are not rewritten.
+        '''
+        import common
+        from state_store import StateSnapshotter, load_states
+
+        block = FakeBlock('5A', [0])
+        common.area_container = {'Y2': {'5A': block}}
+        snapshotter = StateSnapshotter(self.state_file, min_interval_ms=60000)
+        self.assertEqual(snapshotter.restore(), 0)
+
+        for byte in range(1, 10):
+            block.last_byte = byte
+            common.state_version += 1
+            snapshotter.maybe_save()
+        self.assertEqual(snapshotter.write_count, 0)
+
+        snapshotter.last_save_ticks -= 60000
+        self.assertTrue(snapshotter.maybe_save())
+        self.assertEqual(load_states(self.state_file), {('Y2', '5A'): 9})
+
+        common.state_version += 1
+        snapshotter.last_save_ticks -= 60000
+        self.assertFalse(snapshotter.maybe_save())
+        self.assertEqual(snapshotter.write_count, 1)
+
+class TestConfigCompiler(unittest.TestCase):
+    '''
+    Tests for the compiled boot configuration
+    '''
+    compiled_file = 'test_config.bin'
+    source_file = 'test_config.json'
+
+    def tearDown(self):
+        import os
+        for location in (self.compiled_file, self.source_file):
+            try:
+                os.remove(location)
+            except OSError:
+                pass
+
+    def test_configuration_round_trip(self):
+        '''
+        Tests that a compiled configuration reads back as
+        the dict read_configuration_file returns, and a
+        truncated one is ignored.
+        '''
+        from config_compiler import compile_configuration, decompile_configuration
+
+        configuration = {'Y2': {'5A': [{'platform': '1', 'element_position': 0,
+                                        'green_pin': 2, 'red_pin': 3},
+                                       {'platform': '2', 'element_position': 7,
+                                        'green_pin': 4, 'red_pin': 5}]},
+                         'N2': {'01': [{'platform': 'Up Main', 'element_position': 3,
+                                        'green_pin': 6, 'red_pin': 7}]}}
+        data = compile_configuration(configuration)
+        self.assertEqual(decompile_configuration(data), configuration)
+        self.assertEqual(decompile_configuration(data[:-1]), {})
+        configuration['N2']['01'][0]['green_pin'] = 0x10000
+        self.assertEqual(compile_configuration(configuration), b'')
+
+    def test_edited_source_is_read_instead(self):
+        '''
+        Tests that the compiled file is only used while
+        config.json holds what it was compiled from, even
+        after an edit that keeps its size.
+        '''
+        import json
+        import os
+        from config_compiler import main, load_compiled_configuration
+
+        configuration = {'Y2': {'5A': [{'platform': '1', 'element_position': 0,
+                                        'green_pin': 2, 'red_pin': 3}]}}
+        with open(self.source_file, 'w') as source:
+            json.dump(configuration, source)
+        self.assertEqual(main([self.source_file, self.compiled_file]), 0)
+        self.assertEqual(load_compiled_configuration(self.compiled_file, self.source_file),
+                         configuration)
+
+        size = os.stat(self.source_file)[6]
+        configuration['Y2']['5A'][0]['green_pin'] = 4
+        with open(self.source_file, 'w') as source:
+            json.dump(configuration, source)
+        self.assertEqual(os.stat(self.source_file)[6], size)
+        self.assertEqual(load_compiled_configuration(self.compiled_file, self.source_file), {})
+
+    def test_reload_after_compiled_boot_changes_nothing(self):
+        '''
+        Tests that reloading the JSON a compiled boot was made
+        from, with a numeric platform and a key blocks do not
+        use, reports every block unchanged.
+        '''
+        import json
+        import pin_drivers
+        import signal_feed
+        from config_compiler import main, load_compiled_configuration
+        from parser_utils import parse_configuration
+
+        raw_configuration = json.dumps(
+            {'Y2': {'5A': [{'platform': 1, 'element_position': 0, 'green_pin': 2,
+                            'red_pin': 3, 'description': 'Up Main'}],
+                    '5B': [{'platform': '2', 'element_position': 7, 'green_pin': 4,
+                            'red_pin': 5}]}})
+        with open(self.source_file, 'w') as source:
+            source.write(raw_configuration)
+        self.assertEqual(main([self.source_file, self.compiled_file]), 0)
+
+        driver = pin_drivers.driver
+        pin_drivers.set_driver(pin_drivers.FakeDriver())
+        try:
+            signal_feed.load_configuration(
+                load_compiled_configuration(self.compiled_file, self.source_file))
+            summary = signal_feed.reload_configuration(parse_configuration(raw_configuration))
+        finally:
+            pin_drivers.set_driver(driver)
+        self.assertEqual(summary, {'added': [], 'changed': [], 'removed': [], 'unchanged': 2,
+                                   'unsubscribed': []})
+
+class TestJournal(unittest.TestCase):
+    '''
+    Tests for the change journal and /api/history
+    '''
+
+    def tearDown(self):
+        import journal
+        journal.allocate()
+
+    def test_ring_keeps_latest_changes(self):
+        '''
+        Tests that the ring overwrites its oldest entries
+        and pages continue from the since sequence.
+        '''
+        import journal
+
+        block = FakeBlock('5A', [0])
+        journal.allocate(4)
+        journal.record(block, None, 1)
+        for byte in range(2, 7):
+            journal.record(block, byte - 1, byte)
+        self.assertEqual(journal.oldest_sequence(), 3)
+
+        page = journal.entries(0, 2, {'Y2': {'5A': block}})
+        self.assertEqual([entry['seq'] for entry in page], [3, 4])
+        self.assertEqual(page[0]['area'], 'Y2')
+        self.assertEqual((page[0]['old'], page[0]['new']), ('02', '03'))
+        self.assertEqual([entry['seq'] for entry in journal.entries(4)], [5, 6])
+
+    def test_history_endpoint_pages(self):
+        '''
+        Tests that /api/history returns a page and the
+        sequence to continue from.
+        '''
+        import json
+        import common
+        import journal
+        import web_server
+
+        block = FakeBlock('5A', [0])
+        common.area_container = {'Y2': {'5A': block}}
+        journal.allocate(8)
+        journal.record(block, None, 0x81)
+        journal.record(block, 0x81, 0x80)
+        journal.record(block, 0x80, 0x00)
+
+        path, headers = web_server.parse_request(b'GET /api/history?since=1&limit=1 HTTP/1.1\r\n\r\n')
+        history = json.loads(web_server.http_response(path, headers).split(b'\r\n\r\n', 1)[1])
+        self.assertEqual([(entry['old'], entry['new']) for entry in history['entries']], [('81', '80')])
+        self.assertEqual((history['next'], history['more']), (2, True))
+
+        path, headers = web_server.parse_request(b'GET /api/history?since=x HTTP/1.1\r\n\r\n')
+        self.assertTrue(web_server.http_response(path, headers).startswith(b'HTTP/1.1 400'))
+
+class TestReplay(unittest.TestCase):
+    '''
+    Tests for recording and replaying raw traffic
+    '''
+    capture_file_location = 'test_capture.bin'
+
+    def tearDown(self):
+        import os
+        try:
+            os.remove(self.capture_file_location)
+        except OSError:
+            pass
+
+    def test_capture_replays_same_frames(self):
+        '''
+        Test that chunks recorded as received replay into
+        the same frames, however they were split.
+        '''
+        from microstomp import CaptureWriter
+        from replay import iter_capture, replay
+
+        frame = b'MESSAGE\nmessage-id:1\n\n[{"SF_MSG":{}}]\x00\n'
+        chunks = [frame[:5], frame[5:] + frame[:20], frame[20:] + frame]
+        capture = CaptureWriter(self.capture_file_location)
+        capture.write(chunks[0])
+        capture.last_ticks -= 250
+        capture.write(chunks[1])
+        # a wrapped ticks_ms reads as a negative interval
+        capture.last_ticks += 1 << 30
+        capture.write(chunks[2])
+        capture.close()
+
+        recorded = list(iter_capture(self.capture_file_location))
+        self.assertEqual([chunk for _, chunk in recorded], chunks)
+        self.assertTrue(250 <= recorded[1][0] == recorded[2][0] < 1000)
+
+        replayed = []
+        def on_frame(frame_data):
+            replayed.append(bytes(frame_data))
+            return 2
+
+        results = replay(self.capture_file_location, on_frame)
+        self.assertEqual(replayed, [frame[:-1]] * 3)
+        self.assertEqual(results['frames'], 3)
+        self.assertEqual(results['messages'], 6)
+        self.assertEqual(results['bytes'], len(frame) * 3)
+
+class TestBenchmarks(unittest.TestCase):
+    '''
+    Tests for the benchmark suite's options and regression check
+    '''
+
+    def test_compare_results_flags_regressions(self):
+        '''
+        Tests that only timings and heap sizes past the
+        threshold are flagged, and ratios are skipped.
         '''
-        pass
+        from benchmarks import compare_results
+
+        baseline = {'results': {'parse_frame_us': 10.0, 'boot_heap_bytes': 1000.0,
+                                'ack_speedup': 2.0, 'handle_frame_us': 100.0,
+                                'removed_us': 5.0}}
+        current = {'results': {'parse_frame_us': 11.5, 'boot_heap_bytes': 1050.0,
+                               'ack_speedup': 1.0, 'handle_frame_us': 80.0}}
+        self.assertEqual(compare_results(current, baseline, 10),
+                         [('parse_frame_us', 10.0, 11.5, 15.0)])
+        self.assertEqual(compare_results(current, baseline, 20), [])
+
+    def test_arguments_and_area_mix(self):
+        '''
+        Tests that an option without a value is refused and
+        the area mix reaches the generated batches.
+        '''
+        import random
+        from benchmarks import (parse_arguments, parse_area_mix, generate_configuration,
+                                generate_td_batch)
+
+        options = parse_arguments(['--batch-size', '10', '--area-mix', 'n2:1'])
+        self.assertEqual(options['batch-size'], '10')
+        self.assertEqual(parse_area_mix(options['area-mix']), {'N2': 1})
+        with self.assertRaises(ValueError):
+            parse_arguments(['--batch-size', '10', '--iterations'])
+        with self.assertRaises(ValueError):
+            parse_area_mix('Y2')
+
+        batch = generate_td_batch(generate_configuration(('Y2',)), 50, area_mix={'N2': 1},
+                                  hit_rate=0, generator=random.Random(4))
+        self.assertEqual(set(next(iter(message.values()))['area_id'] for message in batch), {'N2'})
 
 class TestParserUtils(unittest.TestCase):
     '''
@@ -213,6 +1398,607 @@ class TestParserUtils(unittest.TestCase):
                 signals_of_interest={'00':''}
             )
         )
+    def test_route_message(self):
+        '''
+        Tests that messages are routed by area and address
+        and anything else is dropped.
+        '''
+        from parser_utils import build_routing_table, route_message
+
+        block = object()
+        routing_table = build_routing_table({'y2': {'5a': block}, 'N2': {}})
+        self.assertEqual(routing_table, {('Y2', '5A'): block})
+
+        message = {"SF_MSG": {"area_id": "Y2", "address": "5A", "data": "ED"}}
+        self.assertIs(route_message(message, routing_table), block)
+
+        for unrouted in ({"SF_MSG": {"area_id": "N2", "address": "5A", "data": "ED"}},
+                         {"SF_MSG": {"area_id": "Y2", "address": "71", "data": "ED"}},
+                         {"CA_MSG": {"area_id": "Y2", "from": "0101", "to": "0103"}}):
+            with self.subTest():
+                self.assertIsNone(route_message(unrouted, routing_table))
+
+    def test_element_state_table(self):
+        '''
+        Tests that the lookup table matches the binary
+        representation of every byte, position 0 first.
+        '''
+        from parser_utils import ELEMENT_STATE_TABLE
+
+        self.assertEqual(len(ELEMENT_STATE_TABLE), 256)
+        for byte in range(256):
+            expected = tuple(int(bit) for bit in '{:08b}'.format(byte))
+            with self.subTest():
+                self.assertEqual(ELEMENT_STATE_TABLE[byte], expected)
+
+    def test_iter_filtered_messages(self):
+        '''
+        Tests that only SF messages in the given areas are
+        decoded, including when they straddle scan windows.
+        '''
+        import metrics
+        from parser_utils import iter_filtered_messages
+
+        body = (b'[{"CA_MSG":{"area_id":"Y2","from":"0101","to":"0103"}},'
+                b'{"SF_MSG":{"area_id":"N2","address":"5A","data":"01"}},'
+                b'{"SF_MSG": {"time": "1741800445000", "area_id": "Y2", '
+                b'"address": "5A", "data": "ED"}}]')
+        expected = [{"SF_MSG": {"time": "1741800445000", "area_id": "Y2",
+                                "address": "5A", "data": "ED"}}]
+
+        for window_size in (8, 32, 1024):
+            with self.subTest():
+                self.assertEqual(list(iter_filtered_messages(memoryview(body), {b'Y2'},
+                                                             window_size=window_size)),
+                                 expected)
+
+        # many elements per window, straddling each boundary somewhere
+        batch = b'[' + b','.join([body[1:-1]] * 40) + b']'
+        for window_size in (64, 200, 1024):
+            with self.subTest():
+                received = metrics.messages_received
+                self.assertEqual(list(iter_filtered_messages(batch, {b'Y2'},
+                                                             window_size=window_size)),
+                                 expected * 40)
+                self.assertEqual(metrics.messages_received - received, 120)
+
+class TestWebServer(unittest.TestCase):
+    '''
+    Tests for the web server
+    '''
+
+    def test_async_request_is_answered_and_closed(self):
+        '''
+        Tests that the event loop handler responds with
+        the landing page and closes the connection.
+        '''
+        import common
+        from web_server import handle_web_request, asyncio
+
+        class FakeStream:
+            '''
+            Stands in for both halves of a client connection
+            '''
+            def __init__(self):
+                self.written = b''
+                self.closed = False
+
+            async def read(self, size):
+                '''
+                Returns a request
+                '''
+                return b'GET / HTTP/1.1\r\n\r\n'
+
+            def write(self, data):
+                '''
+                Records the response
+                '''
+                self.written += data
+
+            async def drain(self):
+                '''
+                Nothing to flush
+                '''
+
+            def close(self):
+                '''
+                Records the close
+                '''
+                self.closed = True
+
+            async def wait_closed(self):
+                '''
+                Nothing to wait for
+                '''
+
+        common.area_container = {}
+        stream = FakeStream()
+        asyncio.run(handle_web_request(stream, stream))
+        self.assertTrue(stream.written.startswith(b'HTTP/1.1 200 OK'))
+        self.assertTrue(stream.closed)
+
+    def test_config_upload_read_across_packets(self):
+        '''
+        Tests that a configuration posted in several reads is
+        read to its Content-Length, validated and applied,
+        and an invalid one is refused.
+        '''
+        import json
+        import web_server
+        from web_server import handle_web_request, asyncio
+
+        class FakeStream:
+            '''
+            Returns a request in the given pieces
+            '''
+            def __init__(self, pieces):
+                self.pieces = list(pieces)
+                self.written = b''
+
+            async def read(self, size):
+                '''
+                Returns the next piece, empty once all are read
+                '''
+                return self.pieces.pop(0)[:size] if self.pieces else b''
+
+            def write(self, data):
+                '''
+                Records the response
+                '''
+                self.written += data
+
+            async def drain(self):
+                '''
+                Nothing to flush
+                '''
+
+            def close(self):
+                '''
+                Nothing to close
+                '''
+
+            async def wait_closed(self):
+                '''
+                Nothing to wait for
+                '''
+
+        configuration = {'Y2': {'5A': [{'platform': '1', 'element_position': 0,
+                                        'green_pin': 2, 'red_pin': 3}]}}
+        body = json.dumps(configuration).encode()
+        headers = f'POST /api/config HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+        applied = []
+        web_server.configuration_reloader = lambda c: applied.append(c) or {'added': ['Y2/5A']}
+        try:
+            stream = FakeStream([headers + body[:10], body[10:30], body[30:]])
+            asyncio.run(handle_web_request(stream, stream))
+            self.assertEqual(applied, [configuration])
+            self.assertTrue(stream.written.startswith(b'HTTP/1.1 200 OK'))
+            self.assertTrue(stream.written.endswith(b'{"added": ["Y2/5A"]}'))
+
+            for invalid in (b'{"Y2": {"5A": [{"platform": "1"}]}}',
+                            body.replace(b'"element_position": 0', b'"element_position": "0"')):
+                stream = FakeStream([f'POST /api/config HTTP/1.1\r\nContent-Length: {len(invalid)}\r\n\r\n'.encode() + invalid])
+                asyncio.run(handle_web_request(stream, stream))
+                self.assertTrue(stream.written.startswith(b'HTTP/1.1 400'))
+            self.assertEqual(len(applied), 1)
+
+            def failing_reloader(configuration):
+                raise TypeError('cannot build block')
+            web_server.configuration_reloader = failing_reloader
+            stream = FakeStream([headers + body])
+            asyncio.run(handle_web_request(stream, stream))
+            self.assertTrue(stream.written.startswith(b'HTTP/1.1 400'))
+        finally:
+            web_server.configuration_reloader = None
+
+    def test_landing_page_cached_until_state_version_changes(self):
+        '''
+        Tests that signal states are only re-rendered when
+        the state version moves on, while stats stay live.
+        '''
+        import common
+        import web_server
+
+        common.config_current_configuration = {'Y2': {}}
+        common.area_container = {'Y2': {'5A': FakeBlock('5A', [0])}}
+        common.state_version += 1
+        common.stat_last_message_received = 'first'
+        page = web_server.landing_page_content()
+        self.assertIn(b"{'5A': 'RED'}", page)
+        self.assertIn(b'first', page)
+
+        common.area_container['Y2']['5A'].states[0] = 1
+        common.stat_last_message_received = 'second'
+        page = web_server.landing_page_content()
+        self.assertIn(b"{'5A': 'RED'}", page)
+        self.assertIn(b'second', page)
+
+        common.state_version += 1
+        self.assertIn(b"{'5A': 'GREEN'}", web_server.landing_page_content())
+
+    def test_state_api_etag(self):
+        '''
+        Tests that /api/state returns element states with an
+        ETag and a 304 when If-None-Match is current.
+        '''
+        import json
+        import common
+        import web_server
+
+        block = FakeBlock('5A', [1, 0])
+        common.area_container = {'Y2': {'5A': block}}
+        common.state_version += 1
+
+        path, headers = web_server.parse_request(b'GET /api/state HTTP/1.1\r\nHost: x\r\n\r\n')
+        response = web_server.http_response(path, headers)
+        head, body = response.split(b'\r\n\r\n', 1)
+        etag = f'"{common.state_version}"'
+        self.assertIn(f'ETag: {etag}'.encode(), head)
+        self.assertEqual(json.loads(body)['areas'], {'Y2': {'5A': [1, 0, None, None, None, None, None, None]}})
+
+        path, headers = web_server.parse_request(
+            f'GET /api/state HTTP/1.1\r\nIf-None-Match: {etag}\r\n\r\n'.encode())
+        self.assertTrue(web_server.http_response(path, headers).startswith(b'HTTP/1.1 304'))
+
+    def test_changed_blocks_event(self):
+        '''
+        Tests that events carry every block for a new client
+        and only changed blocks after that.
+        '''
+        import json
+        import common
+        import web_server
+
+        quiet = FakeBlock('5A', [1])
+        busy = FakeBlock('5B', [0])
+        common.area_container = {'Y2': {'5A': quiet, '5B': busy}}
+        common.state_version += 1
+
+        since, event = web_server.changed_blocks_event(None)
+        self.assertEqual(since, common.state_version)
+        self.assertEqual(json.loads(event.split(b'data: ')[1]),
+                         {'Y2': {'5A': [1] + [None] * 7, '5B': [0] + [None] * 7}})
+        self.assertEqual(web_server.changed_blocks_event(since), (since, None))
+
+        common.state_version += 1
+        busy.changed_version = common.state_version
+        busy.states[0] = 1
+        since, event = web_server.changed_blocks_event(since)
+        self.assertTrue(event.startswith(f'id: {since}\n'.encode()))
+        self.assertEqual(json.loads(event.split(b'data: ')[1]), {'Y2': {'5B': [1] + [None] * 7}})
+
+class TestMetrics(unittest.TestCase):
+    '''
+    Tests for the metrics counters and their rendering
+    '''
+
+    def test_histogram_buckets(self):
+        '''
+        Tests that values land in the first bucket they
+        fit and render as cumulative counts.
+        '''
+        from metrics import Histogram
+
+        histogram = Histogram('test_us', 'Test.', bounds=(10, 100))
+        for value in (5, 10, 50, 1000):
+            histogram.observe(value)
+        self.assertEqual(histogram.bucket_counts, [2, 1, 1])
+
+        lines = []
+        histogram.render(lines)
+        self.assertIn('desk_signaller_test_us_bucket{le="100"} 3', lines)
+        self.assertIn('desk_signaller_test_us_bucket{le="+Inf"} 4', lines)
+        self.assertIn('desk_signaller_test_us_sum 1065', lines)
+
+    def test_boot_phases_rendered_in_order(self):
+        '''
+        Tests that each boot phase is timed from the end
+        of the one before and rendered as a gauge.
+        '''
+        import metrics
+
+        metrics.start_boot_timing()
+        metrics.mark_boot_phase('config')
+        metrics.mark_boot_phase('pins')
+        self.assertEqual([phase for phase, _ in metrics.boot_phases_ms], ['config', 'pins'])
+        self.assertIn('desk_signaller_boot_phase_ms{phase="pins"}',
+                      metrics.render_prometheus().decode())
+        metrics.boot_phases_ms.clear()
+
+    def test_metrics_endpoint(self):
+        '''
+        Tests that /metrics serves client, feed and
+        per block counters in Prometheus text format.
+        '''
+        import common
+        import metrics
+        import web_server
+
+        client = connected_client(ack_every_frames=2)
+        client.subscribe('/topic/TD', ack='client-individual')
+        client.acknowledge(message_frame('1'))
+        client.acknowledge(message_frame('2'))
+        block = FakeBlock('5A', [1])
+        block.element_changes = 3
+        common.area_container = {'Y2': {'5A': block}}
+        common.stomp_client = client
+        routed = metrics.messages_routed
+        metrics.messages_routed += 2
+
+        path, headers = web_server.parse_request(b'GET /metrics HTTP/1.1\r\n\r\n')
+        head, body = web_server.http_response(path, headers).split(b'\r\n\r\n', 1)
+        common.stomp_client = None
+        self.assertIn(b'text/plain', head)
+        self.assertIn(b'desk_signaller_acks_sent_total 2\n', body)
+        self.assertIn(f'desk_signaller_messages_routed_total {routed + 2}\n'.encode(), body)
+        self.assertIn(b'# TYPE desk_signaller_td_messages_received_total counter\n', body)
+        self.assertIn(b'desk_signaller_element_changes_total{area="Y2",block="5A"} 3\n', body)
+        self.assertIn(b'# TYPE desk_signaller_parse_latency_us histogram\n', body)
+
+class TestLogger(unittest.TestCase):
+    '''
+    Tests for the ring buffer logger
+    '''
+
+    def tearDown(self):
+        import logger
+        logger.configure()
+        logger.clear()
+
+    def test_disabled_level_is_never_formatted(self):
+        '''
+        Tests that a level below both thresholds
+        neither formats its arguments nor records.
+        '''
+        import logger
+
+        class Unformattable:
+            '''
+            Fails the test if it is ever formatted
+            '''
+            def __str__(self):
+                raise AssertionError('disabled level was formatted')
+
+        logger.configure('info', 'critical')
+        logger.clear()
+        self.assertIs(logger.debug, logger._discard)
+        logger.debug('routed %s', Unformattable())
+        self.assertEqual(logger.entries(), [])
+
+        logger.info('routed %s to %s', '5A', 'Y2')
+        self.assertEqual(logger.entries()[0][1:], ('info', 'routed 5A to Y2'))
+
+    def test_ring_keeps_latest_entries(self):
+        '''
+        Tests that the ring wraps, keeping the
+        newest RING_SIZE entries oldest first.
+        '''
+        import logger
+
+        logger.configure('debug', 'critical')
+        logger.clear()
+        for i in range(logger.RING_SIZE + 3):
+            logger.debug('entry %d', i)
+        messages = [message for _, _, message in logger.entries()]
+        self.assertEqual(len(messages), logger.RING_SIZE)
+        self.assertEqual(messages[0], 'entry 3')
+        self.assertEqual(messages[-1], f'entry {logger.RING_SIZE + 2}')
+
+class TestSignalBlock(unittest.TestCase):
+    '''
+    Tests for SignalBlock element states and pin writes
+    '''
+
+    def setUp(self):
+        import pin_drivers
+        self.driver = pin_drivers.driver
+        pin_drivers.set_driver(pin_drivers.GPIODriver())
+
+    def tearDown(self):
+        import pin_drivers
+        pin_drivers.set_driver(self.driver)
+
+    def fake_pin_block(self, positions):
+        '''
+        Returns a SignalBlock with elements at the given
+        positions, its pins replaced with FakePins
+        '''
+        from signal_block import SignalBlock
+
+        block = SignalBlock('5A')
+        for position in positions:
+            block.modify_signal_in_block(position, str(position), 2 * position, 2 * position + 1,
+                                         initialise_pins=False)
+        block.pins = [FakePin() for _ in range(16)]
+        block.initialised_pins = 0xFFFF
+        return block
+
+    def test_pins_initialised_in_bulk(self):
+        '''
+        Tests that deferred pins are set up in one pass
+        and one write showing red, each shared pin set up once.
+        '''
+        import common
+        import pin_drivers
+        import signal_feed
+
+        driver = pin_drivers.FakeDriver()
+        pin_drivers.set_driver(driver)
+        lights = [{'platform': '1', 'element_position': 0, 'green_pin': 2, 'red_pin': 3}]
+        signal_feed.load_configuration({'Y2': {'5A': lights, '5B': lights}}, initialise_pins=False)
+        self.assertEqual(driver.pin_writes, 0)
+
+        self.assertEqual(signal_feed.initialise_area_pins(common.area_container), 2)
+        self.assertEqual(driver.values, {2: 0, 3: 1})
+        self.assertEqual(driver.write_count, 1)
+
+    def test_pin_transaction_writes_net_change_once(self):
+        '''
+        Tests that inside a transaction only the net
+        change of each element is written, on commit.
+        '''
+        from signal_element import begin_pin_transaction, commit_pin_transaction
+
+        block = self.fake_pin_block((0, 1))
+        flipped = block.element(0)
+        flipped_back = block.element(1)
+
+        begin_pin_transaction()
+        for state in (1, 0, 1):
+            flipped.update_signal(state)
+        flipped_back.update_signal(1)
+        flipped_back.update_signal(0)
+        self.assertEqual(block.pins[0].writes, [])
+
+        self.assertEqual(commit_pin_transaction(), 1)
+        self.assertEqual(block.pins[0].writes, [1])
+        self.assertEqual(block.pins[1].writes, [0])
+        self.assertEqual(block.pins[2].writes, [])
+
+        flipped.update_signal(0)
+        self.assertEqual(block.pins[0].writes, [1, 0])
+
+    def test_update_from_hex_writes_changed_elements(self):
+        '''
+        Tests that only configured elements whose
+        bit changed are written and counted.
+        '''
+        block = self.fake_pin_block((0, 7))
+        self.assertEqual(block.update_from_hex('81'), 0)
+        self.assertEqual(block.element_states(), [1, None, None, None, None, None, None, 1])
+        self.assertEqual(block.element_changes, 2)
+
+        self.assertEqual(block.update_from_hex('C1'), 0)
+        self.assertEqual(block.update_from_hex('80'), 0)
+        self.assertEqual(block.element_states(), [1, None, None, None, None, None, None, 0])
+        self.assertEqual(block.pins[0].writes, [1])
+        self.assertEqual(block.pins[14].writes, [1, 0])
+        self.assertEqual(block.element_changes, 3)
+        self.assertEqual(block.update_from_hex('XYZ'), 1)
+
+    def test_repeated_byte_writes_no_pins(self):
+        '''
+        Tests that a repeated SF byte writes no pins and a
+        single changed bit writes only the one element.
+        '''
+        block = self.fake_pin_block(range(8))
+        block.update_from_hex('10')
+        writes = [len(pin.writes) for pin in block.pins]
+
+        block.update_from_hex('10')
+        self.assertEqual([len(pin.writes) for pin in block.pins], writes)
+
+        block.update_from_hex('18')
+        changed = [index for index, pin in enumerate(block.pins) if len(pin.writes) != writes[index]]
+        self.assertEqual(changed, [8, 9])
+        self.assertEqual((block.pins[8].writes[-1], block.pins[9].writes[-1]), (1, 0))
+        self.assertEqual(block.element_states()[4], 1)
+
+class TestPinDrivers(unittest.TestCase):
+    '''
+    Tests for the bulk pin drivers
+    '''
+
+    def setUp(self):
+        import pin_drivers
+        self.driver = pin_drivers.driver
+
+    def tearDown(self):
+        import pin_drivers
+        pin_drivers.set_driver(self.driver)
+
+    def test_pin_transaction_is_one_bulk_write(self):
+        '''
+        Tests that every block changed by a frame is
+        pushed to the driver in a single write.
+        '''
+        import pin_drivers
+        import signal_feed
+        from signal_element import begin_pin_transaction, commit_pin_transaction
+
+        driver = pin_drivers.FakeDriver()
+        pin_drivers.set_driver(driver)
+        lights = [{'platform': str(position), 'element_position': position,
+                   'green_pin': 2 * position, 'red_pin': 2 * position + 1} for position in range(8)]
+        blocks = [signal_feed.build_block(address, lights) for address in ('5A', '5B')]
+        self.assertEqual(driver.write_count, 2)
+
+        begin_pin_transaction()
+        for block in blocks:
+            block.update_from_hex('FF')
+        self.assertEqual(commit_pin_transaction(), 16)
+        self.assertEqual(driver.write_count, 3)
+        self.assertEqual(driver.values[0], 1)
+        self.assertEqual(driver.values[1], 0)
+
+        blocks[0].update_from_hex('7F')
+        self.assertEqual(driver.write_count, 4)
+        self.assertEqual(driver.values[0], 0)
+
+    def test_shift_register_chain(self):
+        '''
+        Tests that the chain is shifted out last register
+        first and latched, only when a pin has changed.
+        '''
+        from pin_drivers import ShiftRegisterDriver
+
+        class FakeSPI:
+            '''
+            Records the bytes shifted out
+            '''
+            def __init__(self):
+                self.written = []
+
+            def write(self, data):
+                '''
+                Records a write
+                '''
+                self.written.append(bytes(data))
+
+        spi = FakeSPI()
+        latch = FakePin()
+        driver = ShiftRegisterDriver(spi, latch, register_count=2)
+        red = driver.setup(9, 1)
+        green = driver.setup(8, 0)
+        self.assertEqual(driver.flush(), 1)
+        self.assertEqual(spi.written, [b'\x02\x00'])
+        self.assertEqual(latch.writes, [0, 1, 0])
+
+        driver.set(red, 1)
+        self.assertEqual(driver.flush(), 0)
+        driver.set(red, 0)
+        driver.set(green, 1)
+        driver.set(0, 1)
+        self.assertEqual(driver.flush(), 1)
+        self.assertEqual(spi.written[-1], b'\x01\x01')
+
+    def test_i2c_expander_ports(self):
+        '''
+        Tests that an MCP23017 is set to outputs and
+        both ports are written in one transaction.
+        '''
+        from pin_drivers import I2CExpanderDriver
+
+        class FakeI2C:
+            '''
+            Records register writes
+            '''
+            def __init__(self):
+                self.written = []
+
+            def writeto_mem(self, address, register, data):
+                '''
+                Records a write
+                '''
+                self.written.append((address, register, bytes(data)))
+
+        i2c = FakeI2C()
+        driver = I2CExpanderDriver(i2c, address=0x21)
+        self.assertEqual(i2c.written, [(0x21, 0x00, b'\x00\x00')])
+        driver.set(driver.setup(0, 1), 1)
+        driver.set(driver.setup(15, 1), 1)
+        self.assertEqual(driver.flush(), 1)
+        self.assertEqual(i2c.written[-1], (0x21, 0x14, b'\x01\x80'))
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,16 +5,72 @@ and change the configuration
 of the light appliance
 '''
 import common
+import journal
+import logger
+import metrics
+import parser_utils
 
 import socket
 import time
+import json
 
-def landing_page_content():
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+WEB_SERVER_PORT = 80
+SSE_RETRY_MS = 1000
+SSE_POLL_INTERVAL = 0.1
+SSE_KEEPALIVE_POLLS = 150
+HISTORY_PAGE_SIZE = 50
+#largest configuration accepted by POST /api/config
+MAX_CONFIGURATION_BYTES = 16384
+#function(configuration) -> dict applying an uploaded
+#configuration, set by main.py, /api/config is read only without it
+configuration_reloader = None
+
+HTTP_HTML_HEADER = b'HTTP/1.1 200 OK\r\nContent-type: text/html\r\n\r\n'
+METRICS_HEADER = b'HTTP/1.1 200 OK\r\nContent-type: text/plain; version=0.0.4\r\n\r\n'
+SSE_HEADER = b'HTTP/1.1 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n'
+
+LANDING_PAGE_STATS_ROW = b'''</td>
+    </tr>
+    <tr style="height: 13.21875px;">
+    <td style="width: 409.671875px; height: 13.21875px;"><strong>Last Message Received</strong></td>
+    <td style="width: 243.328125px; height: 13.21875px;">'''
+
+LANDING_PAGE_BLOCK_CHANGE_ROW = b'''</td>
+    </tr>
+    <tr style="height: 13px;">
+    <td style="width: 409.671875px; height: 13px;"><strong>Last Signal Block Change</strong></td>
+    <td style="width: 243.328125px; height: 13px;">'''
+
+LANDING_PAGE_LOG_ROW = b'''</td>
+    </tr>
+    <tr style="height: 13px;">
+    <td style="width: 409.671875px; height: 13px;"><strong>Recent Log</strong></td>
+    <td style="width: 243.328125px; height: 13px;">'''
+
+_configuration_cache_source = None
+_configuration_cache = (b'', b'')
+_signal_state_cache_version = None
+_signal_state_cache = b''
+_state_api_cache_version = None
+_state_api_cache = b''
+
+def configuration_fragments():
     '''
-    Returns landing page content
+    Returns the parts of the landing page that only
+    change with the configuration, as encoded bytes.
+    Rendered once per loaded configuration.
     '''
-    sanitised_signal_state = return_area_signal_states(common.area_container)
-    landing_page_html = f'''<html>
+    global _configuration_cache_source, _configuration_cache
+    if _configuration_cache_source is common.config_current_configuration:
+        return _configuration_cache
+
+    area_codes = ', '.join(common.area_container or {})
+    head = f'''<html>
     <title>Desktop Signaller {common.appliance_name}</title>
     <h2>DESKTOP SIGNALLER APPLIANCE INTERFACE</h2>
     <table style="height: 417px; width: 670px;" border="1">
@@ -28,20 +84,13 @@ def landing_page_content():
     </tr>
     <tr style="height: 13px;">
     <td style="width: 409.671875px; height: 13px;"><strong>Signal Area Codes Monitored</strong></td>
-    <td style="width: 243.328125px; height: 13px;">{common.area_container}</td>
+    <td style="width: 243.328125px; height: 13px;">{area_codes}</td>
     </tr>
     <tr style="height: 13px;">
     <td style="width: 409.671875px; height: 13px;"><strong>Current Signal States</strong></td>
     
-    <td style="width: 243.328125px; height: 13px;">{sanitised_signal_state}</td>
-    </tr>
-    <tr style="height: 13.21875px;">
-    <td style="width: 409.671875px; height: 13.21875px;"><strong>Last Message Received</strong></td>
-    <td style="width: 243.328125px; height: 13.21875px;">{common.stat_last_message_received}</td>
-    </tr>
-    <tr style="height: 13px;">
-    <td style="width: 409.671875px; height: 13px;"><strong>Last Signal Block Change</strong></td>
-    <td style="width: 243.328125px; height: 13px;">{common.stat_last_block_change}</td>
+    <td style="width: 243.328125px; height: 13px;">'''
+    tail = f'''</td>
     </tr>
     <tr style="height: 13px;">
     <td style="width: 409.671875px; height: 13px; background-color: #afeeee;" colspan="2"><strong>Current Configuration File</strong></td>
@@ -51,34 +100,345 @@ def landing_page_content():
     </tr>
     </tbody>
     </table></html>'''
-    return landing_page_html
+    _configuration_cache = (head.encode(), tail.encode())
+    _configuration_cache_source = common.config_current_configuration
+    return _configuration_cache
+
+def signal_state_fragment():
+    '''
+    Returns the encoded signal states, only
+    rebuilt when common.state_version has moved on.
+    '''
+    global _signal_state_cache_version, _signal_state_cache
+    if _signal_state_cache_version != common.state_version:
+        _signal_state_cache_version = common.state_version
+        _signal_state_cache = str(return_area_signal_states(common.area_container)).encode()
+    return _signal_state_cache
+
+def log_fragment() -> bytes:
+    '''
+    Returns the entries in the log ring, oldest
+    first, as escaped lines for the landing page
+    '''
+    return '<br>'.join(
+        f'{ticks} ({level}): ' + message.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        for ticks, level, message in logger.entries()
+    ).encode()
+
+def landing_page_content() -> bytes:
+    '''
+    Returns landing page content
+    '''
+    head, tail = configuration_fragments()
+    return b''.join((
+        head,
+        signal_state_fragment(),
+        LANDING_PAGE_STATS_ROW,
+        str(common.stat_last_message_received).encode(),
+        LANDING_PAGE_BLOCK_CHANGE_ROW,
+        str(common.stat_last_block_change).encode(),
+        LANDING_PAGE_LOG_ROW,
+        log_fragment(),
+        tail
+    ))
+
+def parse_request(request: bytes):
+    '''
+    Splits a raw HTTP request into its path
+    and a dict of lower-cased header names
+
+    returns:
+        tuple: (path, headers)
+    '''
+    lines = request.split(b'\r\n')
+    request_line = lines[0].split(b' ')
+    path = request_line[1].decode() if len(request_line) > 1 else '/'
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            break
+        separator = line.find(b':')
+        if separator > 0:
+            headers[line[:separator].strip().lower().decode()] = line[separator + 1:].strip().decode()
+    return path, headers
+
+def request_method(request: bytes) -> str:
+    '''
+    Returns the method of a raw HTTP request, i.e. GET
+    '''
+    return request.split(b' ', 1)[0].decode().upper()
+
+def request_body(request: bytes) -> bytes:
+    '''
+    Returns the part of the body read with the headers
+    '''
+    separator = request.find(b'\r\n\r\n')
+    return request[separator + 4:] if separator >= 0 else b''
+
+def content_length(headers: dict) -> int:
+    '''
+    Returns the Content-Length of a request, 0 if it has none
+    '''
+    try:
+        return int(headers.get('content-length', 0))
+    except ValueError:
+        return 0
+
+def body_bytes_remaining(headers: dict, body: bytes) -> int:
+    '''
+    Returns how much more of the body Content-Length says
+    to read, 0 when there is none or it is too large to accept
+    '''
+    length = content_length(headers)
+    if length > MAX_CONFIGURATION_BYTES:
+        return 0
+    return max(0, length - len(body))
+
+def state_api_body():
+    '''
+    Returns the JSON document of every block's element
+    states and the version it was rendered at, only
+    rebuilt when common.state_version has moved on.
+
+    returns:
+        tuple: (version, encoded JSON)
+    '''
+    global _state_api_cache_version, _state_api_cache
+    version = common.state_version
+    if _state_api_cache_version != version:
+        areas = {}
+        for area, blocks in (common.area_container or {}).items():
+            areas[area] = {address: block.element_states() for address, block in blocks.items()}
+        _state_api_cache = json.dumps({'version': version, 'areas': areas}).encode()
+        _state_api_cache_version = version
+    return _state_api_cache_version, _state_api_cache
+
+def state_api_response(headers: dict) -> bytes:
+    '''
+    Returns the response for /api/state, a 304
+    when the client already holds the current version
+    '''
+    version, body = state_api_body()
+    etag = f'"{version}"'
+    if headers.get('if-none-match') == etag:
+        return f'HTTP/1.1 304 Not Modified\r\nETag: {etag}\r\n\r\n'.encode()
+    return (f'HTTP/1.1 200 OK\r\nContent-type: application/json\r\nETag: {etag}\r\n'
+            f'Cache-Control: no-cache\r\nContent-Length: {len(body)}\r\n\r\n').encode() + body
+
+def query_parameters(path: str) -> dict:
+    '''
+    Returns the query string of a path as a dict
+    '''
+    parameters = {}
+    if '?' not in path:
+        return parameters
+    for pair in path.split('?', 1)[1].split('&'):
+        name, _, value = pair.partition('=')
+        if name:
+            parameters[name] = value
+    return parameters
+
+def history_api_response(path: str) -> bytes:
+    '''
+    Returns a page of the change journal after the
+    since sequence, with the sequence to ask for next
+    '''
+    parameters = query_parameters(path)
+    try:
+        since = max(0, int(parameters.get('since', 0)))
+        limit = min(HISTORY_PAGE_SIZE, max(1, int(parameters.get('limit', HISTORY_PAGE_SIZE))))
+    except ValueError:
+        return b'HTTP/1.1 400 Bad Request\r\n\r\n'
+    page = journal.entries(since, limit, common.area_container)
+    next_since = page[-1]['seq'] if page else max(since, journal.oldest_sequence() - 1)
+    body = json.dumps({
+        'entries': page,
+        'next': next_since,
+        'oldest': journal.oldest_sequence(),
+        'more': next_since < journal.entry_count
+    }).encode()
+    return (f'HTTP/1.1 200 OK\r\nContent-type: application/json\r\n'
+            f'Cache-Control: no-cache\r\nContent-Length: {len(body)}\r\n\r\n').encode() + body
+
+def config_api_response(method: str, headers: dict, body: bytes) -> bytes:
+    '''
+    Returns the current configuration for GET, for POST
+    validates the body as a configuration and applies it
+    through configuration_reloader, answering with which
+    blocks were added, changed and removed
+    '''
+    if method == 'GET':
+        response_body = json.dumps(common.config_current_configuration or {}).encode()
+    elif method != 'POST':
+        return b'HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, POST\r\n\r\n'
+    elif configuration_reloader is None:
+        return b'HTTP/1.1 503 Service Unavailable\r\n\r\n'
+    elif content_length(headers) > MAX_CONFIGURATION_BYTES:
+        return b'HTTP/1.1 413 Payload Too Large\r\n\r\n'
+    else:
+        configuration = parser_utils.parse_configuration(body)
+        if not configuration:
+            return b'HTTP/1.1 400 Bad Request\r\n\r\n'
+        try:
+            summary = configuration_reloader(configuration)
+        except Exception as e:
+            # the reloader builds every block before swapping, so the current configuration stands
+            logger.error('could not apply the uploaded configuration %s', e)
+            return b'HTTP/1.1 400 Bad Request\r\n\r\n'
+        response_body = json.dumps(summary).encode()
+    return (f'HTTP/1.1 200 OK\r\nContent-type: application/json\r\n'
+            f'Cache-Control: no-cache\r\nContent-Length: {len(response_body)}\r\n\r\n'
+           ).encode() + response_body
+
+def last_event_id(headers: dict) -> int | None:
+    '''
+    Returns the state version an event stream
+    client last received, None if it has none
+    '''
+    try:
+        return int(headers['last-event-id'])
+    except (KeyError, ValueError):
+        return None
+
+def changed_blocks_event(since: int | None):
+    '''
+    Builds a server-sent event holding the element
+    states of each block changed after the given
+    state version, or of every block if None.
+
+    returns:
+        tuple: (version to resume from, event bytes or None if nothing changed)
+    '''
+    version = common.state_version
+    if since is not None and since > version:
+        # the appliance restarted since the client last connected
+        since = None
+    if since == version:
+        return since, None
+
+    changed = {}
+    for area, blocks in (common.area_container or {}).items():
+        for address, block in blocks.items():
+            if since is None or block.changed_version > since:
+                changed.setdefault(area, {})[address] = block.element_states()
+    if not changed:
+        return version, None
+    return version, f'id: {version}\ndata: {json.dumps(changed)}\n\n'.encode()
+
+def http_response(path: str, headers: dict, method: str = 'GET', body: bytes = b'') -> bytes:
+    '''
+    Returns the complete response for any
+    request other than the event stream
+    '''
+    route = path.split('?')[0]
+    if route == '/api/config':
+        return config_api_response(method, headers, body)
+    if route == '/api/state':
+        return state_api_response(headers)
+    if route == '/metrics':
+        return METRICS_HEADER + metrics.render_prometheus()
+    if route == '/api/history':
+        return history_api_response(path)
+    return HTTP_HTML_HEADER + landing_page_content()
 
 def web_server():
     '''
     Web server accepts and responds
     to web requests on the bound port
 
+    As only one connection is served at a time the
+    event stream sends the changes since the client's
+    Last-Event-ID and closes, the client reconnects
+    after SSE_RETRY_MS.
     '''
-    addr = socket.getaddrinfo('0.0.0.0', 80)[0][-1]
+    addr = socket.getaddrinfo('0.0.0.0', WEB_SERVER_PORT)[0][-1]
     web_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     web_socket.bind(addr)
     web_socket.listen(1)
-    print(f'(info): web server is bound to {addr}')
+    logger.info('web server is bound to %s', addr)
     while True:
         conn, addr = web_socket.accept()
         try:
-            conn.recv(1024)
-            print(f'(info): web cx received from {str(addr)}')
-            response = landing_page_content()
-            conn.send('HTTP/1.1 200 OK\r\nContent-type: text/html\r\n\r\n'.encode())
-            conn.send(response.encode())
-            print('(info): all responses sent')
+            request = conn.recv(1024)
+            path, headers = parse_request(request)
+            logger.debug('web cx received from %s', addr)
+            body = request_body(request)
+            remaining = body_bytes_remaining(headers, body)
+            while remaining > 0:
+                chunk = conn.recv(min(remaining, 1024))
+                if not chunk:
+                    break
+                body += chunk
+                remaining -= len(chunk)
+            if path.split('?')[0] == '/api/events':
+                _, event = changed_blocks_event(last_event_id(headers))
+                conn.send(SSE_HEADER)
+                conn.send(f'retry: {SSE_RETRY_MS}\n\n'.encode())
+                if event:
+                    conn.send(event)
+            else:
+                conn.send(http_response(path, headers, request_method(request), body))
+            logger.debug('all responses sent')
             time.sleep(0.1)
             conn.close()
-            print('(info): connection closed')
+            logger.debug('connection closed')
         except:
             conn.close()
-            print('(web-error): connection force closed')
+            logger.error('web connection force closed')
+
+async def stream_events_async(writer, since: int | None):
+    '''
+    Keeps an event stream open, sending each
+    change of block state until the client leaves
+    '''
+    writer.write(SSE_HEADER)
+    idle_polls = 0
+    while True:
+        since, event = changed_blocks_event(since)
+        if event or idle_polls >= SSE_KEEPALIVE_POLLS:
+            # the keepalive lets a departed client be noticed when nothing changes
+            writer.write(event or b': keepalive\n\n')
+            await writer.drain()
+            idle_polls = 0
+        else:
+            idle_polls += 1
+        await asyncio.sleep(SSE_POLL_INTERVAL)
+
+async def handle_web_request(reader, writer):
+    '''
+    Responds to a single web request on
+    the event loop without blocking it
+    '''
+    try:
+        request = await reader.read(1024)
+        path, headers = parse_request(request)
+        body = request_body(request)
+        remaining = body_bytes_remaining(headers, body)
+        while remaining > 0:
+            chunk = await reader.read(remaining)
+            if not chunk:
+                break
+            body += chunk
+            remaining -= len(chunk)
+        if path.split('?')[0] == '/api/events':
+            await stream_events_async(writer, last_event_id(headers))
+        else:
+            writer.write(http_response(path, headers, request_method(request), body))
+            await writer.drain()
+    except Exception as e:
+        logger.error('web connection force closed %s', e)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+async def web_server_async(port: int = WEB_SERVER_PORT):
+    '''
+    Starts serving web requests as tasks on
+    the running event loop and returns the server
+    '''
+    server = await asyncio.start_server(handle_web_request, '0.0.0.0', port)
+    logger.info('web server is serving on port %s', port)
+    return server
 
 def return_area_signal_states(area_container: dict):
     '''
@@ -91,12 +451,11 @@ def return_area_signal_states(area_container: dict):
         block_states = {}
         area_data = area_container[area]
         for signal_block in area_data:
-            print('(debug): signal block is', signal_block) 
             block = area_data[signal_block]
             sig_state = ''
-            for signal in block.signal_elements_container:
-                if signal:
-                    if signal.signal_state:
+            for signal_state in block.element_states():
+                if signal_state is not None:
+                    if signal_state:
                         sig_state += 'GREEN'
                     else:
                         sig_state += 'RED'